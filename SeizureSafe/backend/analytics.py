@@ -0,0 +1,173 @@
+"""Vectorized heart-rate statistics over time windows.
+
+A window of readings is loaded once into contiguous NumPy arrays; every
+per-window aggregate is then computed with reduceat over the sorted
+timestamps instead of looping over reading dicts in Python.
+"""
+import math
+import re
+from datetime import datetime
+
+import numpy as np
+
+from data_store import now_ms
+
+# Upper bound on the number of windows one /api/stats request can ask for
+MAX_WINDOWS = 10000
+
+_ROW_DTYPE = np.dtype([
+    ('ts', 'i8'),
+    ('heart_rate', 'f8'),
+    ('previous_heart_rate', 'f8'),
+    ('fall', 'u1'),
+    ('seizure', 'u1'),
+])
+
+_UNITS = {'s': 1000, 'm': 60 * 1000, 'h': 3600 * 1000}
+
+
+def parse_window(window):
+    """Parse a window width such as '30s', '5m' or '1h' into milliseconds."""
+    match = re.fullmatch(r'(\d+)([smh])', str(window).strip())
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid window: {window!r} (expected e.g. '30s', '5m', '1h')")
+    return int(match.group(1)) * _UNITS[match.group(2)]
+
+
+class ReadingArrays:
+    """Columns of a window of readings, sorted by timestamp."""
+
+    def __init__(self, rows):
+        self.ts = np.ascontiguousarray(rows['ts'])
+        self.heart_rate = np.ascontiguousarray(rows['heart_rate'])
+        # NaN where the device did not report a previous heart rate
+        self.previous_heart_rate = np.ascontiguousarray(rows['previous_heart_rate'])
+        self.fall = rows['fall'].astype(bool)
+        self.seizure = rows['seizure'].astype(bool)
+
+    def __len__(self):
+        return len(self.ts)
+
+    @classmethod
+    def load(cls, store, start_ms, end_ms=None, device_id=None):
+        """Read rows with start_ms <= ts_ms < end_ms straight into arrays."""
+        rows = ((row[1], row[3], math.nan if row[4] is None else row[4], row[5], row[6])
+                for row in store.iter_rows(start_ms, device_id=device_id, chunk_size=5000))
+        arrays = cls(np.fromiter(rows, dtype=_ROW_DTYPE))
+        if end_ms is not None:
+            arrays = arrays[:np.searchsorted(arrays.ts, end_ms)]
+        return arrays
+
+    def __getitem__(self, index):
+        rows = np.empty(len(self.ts[index]), dtype=_ROW_DTYPE)
+        rows['ts'] = self.ts[index]
+        rows['heart_rate'] = self.heart_rate[index]
+        rows['previous_heart_rate'] = self.previous_heart_rate[index]
+        rows['fall'] = self.fall[index]
+        rows['seizure'] = self.seizure[index]
+        return ReadingArrays(rows)
+
+
+def _timestamp(ts):
+    return str(datetime.fromtimestamp(ts / 1000))
+
+
+def window_stats(arrays, start_ms, end_ms, width_ms):
+    """Aggregate readings into [start_ms, end_ms) windows of width_ms.
+
+    Returns one dict per window that holds readings, in time order, with
+    the heart rate mean/min/max, the mean and largest absolute change from
+    the previous heart rate, and the seizure and fall counts.
+    """
+    n_windows = -(-(end_ms - start_ms) // width_ms)
+    if n_windows > MAX_WINDOWS:
+        raise ValueError(f"At most {MAX_WINDOWS} windows per request, asked for {n_windows}")
+    edges = start_ms + width_ms * np.arange(n_windows + 1, dtype=np.int64)
+    bounds = np.searchsorted(arrays.ts, edges)
+    counts = np.diff(bounds)
+    present = np.flatnonzero(counts)
+    if not len(present):
+        return []
+    # Empty windows hold no rows, so each segment between the starts of two
+    # consecutive non-empty windows is exactly the earlier window's rows
+    starts = bounds[present]
+    counts = counts[present]
+    last = bounds[present[-1] + 1]
+    heart_rate = arrays.heart_rate[:last]
+
+    change = np.abs(heart_rate - arrays.previous_heart_rate[:last])
+    has_change = ~np.isnan(change)
+    change_counts = np.add.reduceat(has_change.astype(np.int64), starts)
+    change_sums = np.add.reduceat(np.where(has_change, change, 0.0), starts)
+    with np.errstate(invalid='ignore'):
+        change_means = change_sums / change_counts
+        change_max = np.fmax.reduceat(change, starts)
+
+    columns = zip(
+        edges[present].tolist(),
+        counts.tolist(),
+        (np.add.reduceat(heart_rate, starts) / counts).tolist(),
+        np.minimum.reduceat(heart_rate, starts).tolist(),
+        np.maximum.reduceat(heart_rate, starts).tolist(),
+        change_means.tolist(),
+        change_max.tolist(),
+        np.add.reduceat(arrays.seizure[:last].astype(np.int64), starts).tolist(),
+        np.add.reduceat(arrays.fall[:last].astype(np.int64), starts).tolist(),
+    )
+    return [{
+        'timestamp': _timestamp(ts),
+        'count': count,
+        'heart_rate_mean': mean,
+        'heart_rate_min': low,
+        'heart_rate_max': high,
+        'heart_rate_change_mean': None if math.isnan(change_mean) else change_mean,
+        'heart_rate_change_max': None if math.isnan(change_max) else change_max,
+        'seizure_count': seizures,
+        'fall_count': falls,
+    } for ts, count, mean, low, high, change_mean, change_max, seizures, falls in columns]
+
+
+def summary_stats(arrays, now=None):
+    """Whole-window statistics and the time since the last seizure and fall."""
+    now = now_ms() if now is None else now
+    summary = {'count': len(arrays)}
+    if len(arrays):
+        summary.update({
+            'heart_rate_mean': float(arrays.heart_rate.mean()),
+            'heart_rate_min': float(arrays.heart_rate.min()),
+            'heart_rate_max': float(arrays.heart_rate.max()),
+            'heart_rate_std': float(arrays.heart_rate.std()),
+        })
+    for name, flags in (('seizure', arrays.seizure), ('fall', arrays.fall)):
+        hits = np.flatnonzero(flags)
+        summary[f'{name}_count'] = len(hits)
+        if len(hits):
+            last = int(arrays.ts[hits[-1]])
+            summary[f'last_{name}'] = _timestamp(last)
+            summary[f'seconds_since_last_{name}'] = (now - last) / 1000
+        else:
+            summary[f'last_{name}'] = None
+            summary[f'seconds_since_last_{name}'] = None
+    return summary
+
+
+def stats(store, hours, window='1h', device_id=None, now=None):
+    """The /api/stats payload: a summary plus per-window aggregates of the
+    last hours of readings. Raises ValueError for invalid parameters."""
+    if hours <= 0:
+        raise ValueError("hours must be positive")
+    width = parse_window(window)
+    end = now_ms() if now is None else now
+    start = end - int(hours * 3600 * 1000)
+    # Align windows to the width so consecutive requests line up
+    start -= start % width
+    if -(-(end - start) // width) > MAX_WINDOWS:
+        raise ValueError(f"At most {MAX_WINDOWS} windows per request")
+    arrays = ReadingArrays.load(store, start, end + 1, device_id)
+    return {
+        'hours': hours,
+        'window': window,
+        'device_id': device_id,
+        'summary': summary_stats(arrays, end),
+        'windows': window_stats(arrays, start, end + 1, width),
+    }
@@ -1,18 +1,40 @@
-from flask import Flask, jsonify
-from flask_cors import CORS
-from data_store import DataStore
-
-app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
-data_store = DataStore()
-
-@app.route('/api/history/<int:hours>', methods=['GET'])
-def get_history(hours):
-    try:
-        data = data_store.get_historical_data(hours)
-        return jsonify(data)
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+"""Read-only API entry point for running several worker processes.
+
+Ingestion runs separately in ingestd.py; every worker serves the same
+routes as app.py from a read-only store and receives live events from the
+daemon over INGEST_SOCKET:
+
+    python ingestd.py
+    gunicorn -w 4 -b 0.0.0.0:5000 api:app
+
+The same routes are also served asynchronously (see asgi.py), with
+database reads on ASGI_DB_WORKERS threads and at most ASGI_MAX_PENDING
+requests queued for them:
+
+    python api.py --asgi
+    uvicorn api:application
+"""
+import os
+import sys
+
+os.environ.setdefault('INGEST_MODE', 'external')
+
+from app import create_app  # noqa: E402
+from asgi import AsgiApp, serve  # noqa: E402
+
+app = create_app()
+services = app.extensions['seizuresafe']
+
+application = AsgiApp(
+    app,
+    inline=services.served_from_memory,
+    db_workers=int(os.getenv('ASGI_DB_WORKERS', services.store.max_readers)),
+    max_pending=int(os.getenv('ASGI_MAX_PENDING', 64))
+)
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5000) 
\ No newline at end of file
+    if '--asgi' in sys.argv[1:]:
+        import asyncio
+        asyncio.run(serve(application, port=5000))
+    else:
+        app.run(debug=True, port=5000)
@@ -1,13 +1,22 @@
-from flask import Flask, jsonify, request
+from flask import Blueprint, Flask, Response, current_app, jsonify, request
+from flask.json import JSONEncoder
 from flask_cors import CORS
-import paho.mqtt.client as mqtt
-import ssl
-import time
+from functools import wraps
+import hmac
 import logging
-import json
 from data_store import DataStore
 from dotenv import load_dotenv
 import os
+import atexit
+from ring_buffer import HotCache
+from response_cache import ResponseCache
+from history import history_response
+from events import EventBroker, format_sse
+from analytics import stats
+from storage import SLOW_QUERY_MS, STORAGE_BACKEND, create_store
+from ipc import INGEST_SOCKET, EventSubscriber
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Counter, Gauge, Registry
+from tracing import TracingMiddleware, current as current_trace, serializing
 
 # Load environment variables
 load_dotenv()
@@ -17,19 +26,33 @@ logging.basicConfig(level=logging.INFO,
                    format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Initialize Flask app
-app = Flask(__name__)
-CORS(app, resources={r"/api/*": {"origins": "*"}})
+class TimedJSONEncoder(JSONEncoder):
+    """Counts the time jsonify() spends encoding as serialization."""
 
-# Initialize data store
-store = DataStore()
+    def encode(self, o):
+        with serializing():
+            return super().encode(o)
 
-# MQTT settings from environment variables
-BROKER = os.getenv('MQTT_BROKER')
-PORT = int(os.getenv('MQTT_PORT', 8084))
-TOPIC = os.getenv('MQTT_TOPIC')
-USERNAME = os.getenv('MQTT_USERNAME')
-PASSWORD = os.getenv('MQTT_PASSWORD')
+# Requests slower than this are logged with their time split (see tracing.py)
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 1000)) or None
+
+# Bearer token for the /api/admin routes, which are disabled without one
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+PROFILE_MAX_SECONDS = 60
+
+# INGEST_MODE=embedded (default) runs MQTT ingestion inside this process,
+# which must then be the only one. INGEST_MODE=external leaves ingestion
+# to ingestd.py and serves read-only, so the API can run in any number of
+# worker processes; live events then arrive over INGEST_SOCKET.
+# INGEST_MODE=off serves the store as it is, e.g. for benchmarks.
+INGEST_MODE = os.getenv('INGEST_MODE', 'embedded')
+INGEST_MODES = ('embedded', 'external', 'off')
+
+SSE_HEARTBEAT_SECONDS = float(os.getenv('SSE_HEARTBEAT_SECONDS', 15))
+SSE_MAX_BUFFER = int(os.getenv('SSE_MAX_BUFFER', 100))
+
+# Point budget used by /api/history?resolution=auto
+HISTORY_MAX_POINTS = int(os.getenv('HISTORY_MAX_POINTS', 1000))
 
 # User database (replace with proper database in production)
 USERS = {
@@ -37,76 +60,191 @@ USERS = {
     'admin': 'admin123'
 }
 
-def on_connect(client, userdata, flags, rc):
-    if rc == 0:
-        logger.info("Connected successfully to MQTT broker")
-        client.subscribe(TOPIC)
-    else:
-        logger.error(f"Connection failed with code {rc}")
+class Services:
+    """The store of one app and everything serving it: the caches, the
+    live event broker, the metrics and, depending on ingest_mode, the
+    embedded IngestService or the subscriber to ingestd.py's events."""
 
-def on_message(client, userdata, msg):
-    try:
-        data = json.loads(msg.payload.decode())
-        logger.info(f"Received data: {data}")
-        store.save_data(data)
-    except Exception as e:
-        logger.error(f"Error processing message: {e}")
-
-def setup_mqtt():
-    client = mqtt.Client(transport="websockets")
-    client.on_connect = on_connect
-    client.on_message = on_message
-    
-    # Set credentials
-    client.username_pw_set(USERNAME, PASSWORD)
-    
-    # Set up secure TLS configuration
-    try:
-        logger.info("Configuring TLS security...")
-        client.tls_set(
-            cert_reqs=ssl.CERT_REQUIRED,  # Require certificate verification
-            tls_version=ssl.PROTOCOL_TLS,  # Use latest TLS protocol
-            ciphers='ECDHE-ECDSA-AES256-GCM-SHA384:ECDHE-RSA-AES256-GCM-SHA384'  # Specify secure cipher suite
+    def __init__(self, store, ingest_mode):
+        self.store = store
+
+        # Hot tier: the last HOT_CACHE_MINUTES of readings, kept in memory so
+        # that /api/latest and short history windows never touch the store
+        self.cache = HotCache(
+            window_minutes=int(os.getenv('HOT_CACHE_MINUTES', 60)),
+            capacity=int(os.getenv('HOT_CACHE_CAPACITY', 2048)),
+            max_devices=int(os.getenv('HOT_CACHE_MAX_DEVICES', 10000))
         )
-        client.tls_insecure_set(False)  # Enforce secure connections
-        
-        logger.info("TLS security configured successfully")
-        logger.info(f"Attempting to connect to broker {BROKER}:{PORT}")
-        
-        
-        client.enable_logger(logger)
-        
-        # Connect with 30 second keepalive
-        client.connect(BROKER, PORT, keepalive=30)
-        client.loop_start()
-        
-        # Wait connection
-        time.sleep(2)
-        if not client.is_connected():
-            logger.error("Failed to establish connection within timeout")
-            return None
-            
-        logger.info("Successfully connected and started MQTT loop")
-        return client
-        
-    except ssl.SSLError as ssl_err:
-        logger.error(f"SSL/TLS configuration error: {ssl_err}")
-        return None
-    except Exception as e:
-        logger.error(f"Failed to connect to MQTT broker: {e}")
-        return None
+        self.cache.load(store)
+
+        # Rendered /api/history responses and the data set version behind
+        # the history ETags, both kept current by the ingest path
+        self.responses = ResponseCache(
+            max_entries=int(os.getenv('HISTORY_CACHE_ENTRIES', 256)),
+            ttl_seconds=float(os.getenv('HISTORY_CACHE_TTL_SECONDS', 5))
+        )
+        self.responses.reset(store.last_row_id())
+
+        # Live push to dashboards over /api/stream
+        self.events = EventBroker()
+
+        # Prometheus metrics of this process at /metrics; with external
+        # ingestion the ingest pipeline's own are served by ingestd.py on
+        # METRICS_PORT
+        self.metrics = Registry()
+        self.metrics.register(Counter('seizuresafe_history_cache_hits_total',
+                                      'History requests answered from the response cache',
+                                      function=lambda: self.responses.hits))
+        self.metrics.register(Counter('seizuresafe_history_cache_misses_total',
+                                      'History requests that had to be rendered',
+                                      function=lambda: self.responses.misses))
+        self.metrics.register(Gauge('seizuresafe_stream_subscribers',
+                                    'Open /api/stream connections',
+                                    function=lambda: self.events.subscriber_count()))
+        # Set by create_app() once the WSGI app is wrapped
+        self.tracer = None
+
+        self.ingest = None
+        self.subscriber = None
+        if ingest_mode == 'embedded':
+            # Only embedded ingestion needs the MQTT client
+            from ingestd import IngestService
+            self.ingest = IngestService(store)
+            for metric in self.ingest.metrics():
+                self.metrics.register(metric)
+            # Bump the version before the rows become visible in the hot cache
+            self.ingest.add_listener(
+                lambda rows: self.responses.invalidate(rows, store.last_row_id()))
+            self.ingest.add_listener(lambda rows: self.cache.add_rows(rows))
+            # Seizure and fall alerts are pushed before their write, not after
+            self.ingest.add_alert_listener(self.events.publish_alert)
+            self.ingest.add_listener(lambda rows: self.events.publish_rows(rows, alerts=False))
+            self.ingest.add_detection_listener(self.events.publish_detections)
+        elif ingest_mode == 'external':
+            # Reload the caches on every (re)connect, since readings
+            # committed while disconnected were never received
+            def resync():
+                self.responses.reset(store.last_row_id())
+                self.cache.load(store)
+            self.subscriber = EventSubscriber(INGEST_SOCKET, self.on_live_event,
+                                              on_connect=resync).start()
+
+    def on_live_event(self, message):
+        """Apply a message from the ingestion daemon (see ipc.py)."""
+        if message['type'] == 'rows':
+            self.responses.invalidate(message['rows'], message.get('last_id'))
+            self.cache.add_rows(message['rows'])
+            self.events.publish_rows(message['rows'], alerts=False)
+        elif message['type'] == 'alert':
+            self.events.publish_alert(message['alert'])
+        elif message['type'] == 'detections':
+            self.events.publish_detections(message['detections'])
+
+    def served_from_memory(self, path):
+        """Whether a request for path is answered without the store, so an
+        async server can run it on its event loop (see asgi.py)."""
+        if path in ('/api/login', '/metrics'):
+            return True
+        if path == '/api/latest':
+            return self.cache.latest() is not None
+        if path.startswith('/api/devices/') and path.endswith('/latest'):
+            return self.cache.latest(path[len('/api/devices/'):-len('/latest')]) is not None
+        return False
+
+    def start_ingest(self):
+        """Start embedded ingestion; the MQTT client, or None on failure."""
+        return self.ingest.start()
+
+    def shutdown(self):
+        """Stop ingestion (draining the queue to the store), then close."""
+        if self.ingest is not None:
+            self.ingest.stop()
+        if self.subscriber is not None:
+            self.subscriber.stop(timeout=1)
+        self.store.close()
+
+def create_app(store=None, ingest_mode=None):
+    """A Flask app serving store, a StorageBackend (see data_store.py).
+
+    Without a store, one is opened as configured: read-only on the SQLite
+    database for external ingestion, else create_store()'s, which honours
+    STORAGE_BACKEND. ingest_mode defaults to INGEST_MODE. The app's
+    Services are app.extensions['seizuresafe'].
+    """
+    ingest_mode = INGEST_MODE if ingest_mode is None else ingest_mode
+    if ingest_mode not in INGEST_MODES:
+        raise ValueError(f"Unknown INGEST_MODE: {ingest_mode}")
+    if store is None:
+        if ingest_mode == 'external':
+            if STORAGE_BACKEND != 'sqlite':
+                raise ValueError("INGEST_MODE=external needs the sqlite storage backend, "
+                                 "shared with ingestd.py")
+            store = DataStore(read_only=True, slow_query_ms=SLOW_QUERY_MS)
+        else:
+            store = create_store()
+
+    app = Flask(__name__)
+    CORS(app, resources={r"/api/*": {"origins": "*"}}, expose_headers=['X-Resolution', 'X-Next-Cursor', 'X-Cursor', 'ETag', 'Server-Timing'])
+    app.json_encoder = TimedJSONEncoder
+    services = Services(store, ingest_mode)
+    # Every request is timed, split into database, serialization and
+    # total time (see tracing.py)
+    services.tracer = TracingMiddleware(app.wsgi_app, slow_request_ms=SLOW_REQUEST_MS)
+    app.wsgi_app = services.tracer
+    for metric in services.tracer.metrics():
+        services.metrics.register(metric)
+    app.extensions['seizuresafe'] = services
+    app.register_blueprint(routes)
+    return app
+
+def __getattr__(name):
+    # `app`, the app as configured by the environment, is only created when
+    # first asked for (e.g. by `gunicorn app:app`), so importing this module
+    # opens no store
+    if name == 'app':
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def services():
+    """The Services of the app handling the current request."""
+    return current_app.extensions['seizuresafe']
+
+routes = Blueprint('seizuresafe', __name__)
+
+def admin_only(view):
+    """Answer 403 unless the request carries 'Authorization: Bearer <ADMIN_TOKEN>'."""
+    @wraps(view)
+    def guarded(*args, **kwargs):
+        supplied = request.headers.get('Authorization', '').encode()
+        if not ADMIN_TOKEN or not hmac.compare_digest(supplied, f'Bearer {ADMIN_TOKEN}'.encode()):
+            return jsonify({"error": "Admin token required"}), 403
+        return view(*args, **kwargs)
+    return guarded
+
+@routes.before_app_request
+def name_trace():
+    # Traces and profiles are grouped by route rather than by URL
+    trace = current_trace()
+    if trace is not None and request.url_rule is not None:
+        trace.route = request.url_rule.rule
 
 # API endpoints
-@app.route('/api/history/<int:hours>', methods=['GET'])
+@routes.route('/api/history/<int:hours>', methods=['GET'])
 def get_history(hours):
+    app_services = services()
     try:
-        data = store.get_historical_data(hours)
-        return jsonify(data)
+        return history_response(app_services.store, hours, request.args,
+                                cache=app_services.cache, max_points=HISTORY_MAX_POINTS,
+                                responses=app_services.responses, request=request)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error getting historical data: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/login', methods=['POST'])
+@routes.route('/api/login', methods=['POST'])
 def login():
     try:
         data = request.get_json()
@@ -135,22 +273,143 @@ def login():
         logger.error(f"Login error: {str(e)}")
         return jsonify({"success": False, "message": "Internal server error"}), 500
 
-@app.route('/api/latest', methods=['GET'])
+def latest_response(device_id=None):
+    # Served from memory; the store is only asked if the cache is empty
+    app_services = services()
+    latest_data = app_services.cache.latest(device_id) or \
+        app_services.store.get_latest_data(device_id)
+    if latest_data:
+        return jsonify(latest_data)
+    else:
+        return jsonify({"message": "No data available"}), 404
+
+@routes.route('/api/latest', methods=['GET'])
 def get_latest_data():
     try:
-        # Get the latest data from the store
-        latest_data = store.get_latest()
-        if latest_data:
-            return jsonify(latest_data)
-        else:
-            return jsonify({"message": "No data available"}), 404
+        return latest_response()
     except Exception as e:
         logger.error(f"Error getting latest data: {str(e)}")
         return jsonify({"message": "Internal server error"}), 500
 
+@routes.route('/api/devices', methods=['GET'])
+def get_devices():
+    try:
+        return jsonify(services().store.list_devices())
+    except Exception as e:
+        logger.error(f"Error listing devices: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@routes.route('/api/devices/<device_id>/history', defaults={'hours': 24}, methods=['GET'])
+@routes.route('/api/devices/<device_id>/history/<int:hours>', methods=['GET'])
+def get_device_history(device_id, hours):
+    app_services = services()
+    try:
+        return history_response(app_services.store, hours, request.args,
+                                cache=app_services.cache, max_points=HISTORY_MAX_POINTS,
+                                device_id=device_id, responses=app_services.responses,
+                                request=request)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error getting history for device {device_id}: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@routes.route('/api/stats', methods=['GET'])
+def get_stats():
+    """Heart rate statistics per window: ?hours=24&window=1h[&device=<id>]."""
+    try:
+        return jsonify(stats(services().store,
+                             request.args.get('hours', 24, type=float),
+                             request.args.get('window', '1h'),
+                             device_id=request.args.get('device')))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error computing stats: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@routes.route('/api/devices/<device_id>/latest', methods=['GET'])
+def get_device_latest(device_id):
+    try:
+        return latest_response(device_id)
+    except Exception as e:
+        logger.error(f"Error getting latest data for device {device_id}: {e}")
+        return jsonify({"message": "Internal server error"}), 500
+
+@routes.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of the metrics registry."""
+    return Response(services().metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@routes.route('/api/admin/profile', methods=['POST'])
+@admin_only
+def start_profile():
+    """Sample the stacks of live requests every ?interval_ms=5 for
+    ?seconds=10; GET /api/admin/profile returns the hot stacks."""
+    seconds = request.args.get('seconds', 10, type=float)
+    interval_ms = request.args.get('interval_ms', 5, type=float)
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        return jsonify({"error": f"seconds must be between 0 and {PROFILE_MAX_SECONDS}"}), 400
+    if not 1 <= interval_ms <= 1000:
+        return jsonify({"error": "interval_ms must be between 1 and 1000"}), 400
+    profiler = services().tracer.profiler
+    if not profiler.start(seconds, interval_ms / 1000):
+        return jsonify({"error": "A profile is already running"}), 409
+    return jsonify(profiler.report()), 202
+
+@routes.route('/api/admin/profile', methods=['GET'])
+@admin_only
+def get_profile():
+    """The most sampled stacks and functions of the last profile."""
+    return jsonify(services().tracer.profiler.report(request.args.get('limit', 25, type=int)))
+
+@routes.route('/api/admin/slow-queries', methods=['GET'])
+@admin_only
+def get_slow_queries():
+    """Statements that took SLOW_QUERY_MS or more, newest first."""
+    return jsonify(list(reversed(services().store.slow_queries)))
+
+@routes.route('/api/stream', methods=['GET'])
+def stream():
+    """Server-Sent Events feed of new readings, seizure/fall alerts and
+    server-side detections (see detector.py).
+
+    ?device=<id> (repeatable) limits the feed to those devices. A client that
+    falls more than SSE_MAX_BUFFER events behind is sent a 'dropped' event
+    and disconnected; EventSource reconnects on its own.
+    """
+    events = services().events
+    subscription = events.subscribe(request.args.getlist('device'),
+                                    max_events=SSE_MAX_BUFFER)
+
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                event = subscription.get(timeout=SSE_HEARTBEAT_SECONDS)
+                if subscription.dropped:
+                    yield 'event: dropped\ndata: {}\n\n'
+                    break
+                if event is None:
+                    yield ': heartbeat\n\n'
+                else:
+                    yield format_sse(event)
+        finally:
+            events.unsubscribe(subscription)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 if __name__ == '__main__':
-    mqtt_client = setup_mqtt()
-    if mqtt_client:
+    app = create_app()
+    app_services = app.extensions['seizuresafe']
+    if app_services.ingest is None:
+        atexit.register(app_services.shutdown)
         app.run(host='0.0.0.0', port=5000, debug=True)
     else:
-        logger.error("Failed to start application due to MQTT connection failure") 
\ No newline at end of file
+        mqtt_client = app_services.start_ingest()
+        if mqtt_client:
+            atexit.register(app_services.shutdown)
+            app.run(host='0.0.0.0', port=5000, debug=True)
+        else:
+            logger.error("Failed to start application due to MQTT connection failure")
@@ -0,0 +1,83 @@
+"""Compressed archive files for expired seizure_data partitions.
+
+An archive holds one day of readings as gzip-compressed fixed-width records,
+sorted by (ts_ms, id), preceded by a small header and the list of device ids
+the records refer to:
+
+    magic b'SSAR' | version u8 | record count u32 | device table length u32
+    device table (JSON list of device ids, utf-8)
+    records: id i64 | ts_ms i64 | heart_rate f64 | previous_heart_rate f64 |
+             fall u8 | seizure u8 | device index u32
+
+Archives are read back with read_archive(), which yields the same row tuples
+as DataStore.iter_rows(), so archived days can still be queried.
+"""
+import gzip
+import json
+import os
+import struct
+from datetime import datetime
+
+MAGIC = b'SSAR'
+VERSION = 1
+HEADER = struct.Struct('<4sBII')
+RECORD = struct.Struct('<qqddBBI')
+
+# Records decoded per read() call while scanning an archive
+READ_RECORDS = 4096
+
+
+def write_archive(path, rows):
+    """Write (id, ts_ms, timestamp, heart_rate, previous_heart_rate, fall,
+    seizure, device_id) rows, already sorted by (ts_ms, id), to path.
+
+    The file is written under a temporary name and renamed into place, so a
+    crash never leaves a truncated archive behind.
+    """
+    devices = {}
+    records = bytearray()
+    for row_id, ts, _, heart_rate, previous, fall, seizure, device_id in rows:
+        index = devices.setdefault(device_id, len(devices))
+        records += RECORD.pack(row_id, ts, heart_rate,
+                               previous if previous is not None else float('nan'),
+                               fall, seizure, index)
+    device_table = json.dumps(list(devices)).encode()
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records) // RECORD.size,
+                            len(device_table)))
+        f.write(device_table)
+        f.write(records)
+    os.replace(tmp_path, path)
+    return len(records) // RECORD.size
+
+
+def read_archive(path, start_ms=None, device_id=None, after=None):
+    """Yield rows with ts_ms >= start_ms (and after the (ts_ms, id) keyset
+    cursor), optionally for one device, in (ts_ms, id) order."""
+    with gzip.open(path, 'rb') as f:
+        magic, version, count, table_length = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} seizure_data archive")
+        devices = json.loads(f.read(table_length))
+        wanted = None
+        if device_id is not None:
+            if device_id not in devices:
+                return
+            wanted = devices.index(device_id)
+
+        remaining = count
+        while remaining:
+            n = min(remaining, READ_RECORDS)
+            remaining -= n
+            for row_id, ts, heart_rate, previous, fall, seizure, index in \
+                    RECORD.iter_unpack(f.read(n * RECORD.size)):
+                if start_ms is not None and ts < start_ms:
+                    continue
+                if after is not None and (ts, row_id) <= after:
+                    continue
+                if wanted is not None and index != wanted:
+                    continue
+                yield (row_id, ts, str(datetime.fromtimestamp(ts / 1000)), heart_rate,
+                       None if previous != previous else previous,  # NaN -> None
+                       fall, seizure, devices[index])
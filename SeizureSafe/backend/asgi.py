@@ -0,0 +1,429 @@
+"""Asyncio serving mode: the Flask routes behind an ASGI front end.
+
+AsgiApp wraps the Flask (WSGI) app so that no request ever blocks the
+event loop on the database:
+
+  * requests a predicate says are answered from memory (the latest reading
+    from the hot cache, /api/login, /metrics) run inline on the loop;
+  * everything else runs on a bounded pool of db_workers threads, with at
+    most max_pending requests queued or running on it; beyond that a
+    request is turned away with a 503 and Retry-After instead of queueing
+    without limit;
+  * identical GET requests that arrive while one is in flight are
+    coalesced: they wait for that request and get a copy of its response,
+    streamed to each of them as the worker produces it. Credentials are
+    part of the identity, so a request only ever shares a response
+    produced for the same Authorization and Cookie headers, and the admin
+    routes are never coalesced at all;
+  * a response is buffered up to buffer_bytes ahead of its slowest
+    reader, after which the worker waits for the readers to catch up.
+    Only a response still within buffer_bytes can be joined; a request
+    arriving later runs on its own.
+
+So a burst of slow history queries occupies at most db_workers reader
+connections, while /api/latest keeps answering from memory. The
+/api/stream Server-Sent Events feed would hold a worker for as long as a
+dashboard stays connected, so it is left to the WSGI server.
+
+AsgiApp runs under any ASGI server (`uvicorn api:application`); serve()
+is a small HTTP/1.1 server for it that needs nothing beyond the standard
+library, used by `python api.py --asgi`.
+"""
+import asyncio
+import collections
+import io
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+logger = logging.getLogger(__name__)
+
+# Headers that change the response to an otherwise identical request,
+# credentials included, so an anonymous request never gets a copy of an
+# authorized one
+COALESCE_HEADERS = (b'origin', b'if-none-match', b'if-modified-since', b'authorization',
+                    b'cookie')
+
+# Largest request body read, e.g. for /api/login
+MAX_BODY_BYTES = 1 << 20
+
+# Response bytes a worker may produce ahead of the slowest reader
+STREAM_BUFFER_BYTES = 256 << 10
+
+STATUS_REASONS = {
+    200: 'OK', 204: 'No Content', 304: 'Not Modified', 400: 'Bad Request',
+    401: 'Unauthorized', 404: 'Not Found', 405: 'Method Not Allowed',
+    413: 'Payload Too Large', 500: 'Internal Server Error', 501: 'Not Implemented',
+    503: 'Service Unavailable',
+}
+
+
+def wsgi_environ(scope, body):
+    """The WSGI environ for an ASGI http scope and its request body."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+class SharedResponse:
+    """A WSGI response produced on a worker thread, replayable on the loop
+    to every request coalesced onto it.
+
+    With max_buffered set, the worker blocks while it is more than
+    max_buffered bytes ahead of the slowest reader. The response stays
+    joinable, keeping every chunk for readers still to come, only until
+    it grows past max_buffered; after that a chunk is dropped once every
+    reader has sent it.
+    """
+
+    def __init__(self, loop, max_buffered=None):
+        self._loop = loop
+        self.max_buffered = max_buffered
+        self.status = None
+        self.headers = None
+        self.chunks = collections.deque()
+        self.done = False
+        self.joinable = True
+        self._changed = loop.create_future()
+        self._dropped = 0      # chunks no longer kept, from the start
+        self._produced = 0     # bytes handed to the loop
+        self._readers = {}     # reader -> number of chunks it has sent
+        self._buffered = 0     # bytes produced and not yet dropped
+        self._room = threading.Condition()
+
+    def _notify(self):
+        changed, self._changed = self._changed, self._loop.create_future()
+        changed.set_result(None)
+
+    def _start(self, status, headers):
+        self.status, self.headers = status, headers
+        self._notify()
+
+    def _push(self, chunk):
+        self.chunks.append(chunk)
+        self._produced += len(chunk)
+        if self.max_buffered is not None and self._produced > self.max_buffered:
+            self.joinable = False
+            self._release()
+        self._notify()
+
+    def _release(self):
+        """Drop the chunks every reader has sent, once no one can join."""
+        if self.joinable:
+            return
+        first = min(self._readers.values(), default=self._dropped + len(self.chunks))
+        freed = 0
+        while self._dropped < first:
+            freed += len(self.chunks.popleft())
+            self._dropped += 1
+        if freed:
+            with self._room:
+                self._buffered -= freed
+                self._room.notify()
+
+    def _push_and_wait(self, chunk):
+        """Hand chunk to the loop, then wait until the readers have room."""
+        with self._room:
+            self._buffered += len(chunk)
+            self._loop.call_soon_threadsafe(self._push, chunk)
+            while self._buffered > self.max_buffered and not self._loop.is_closed():
+                self._room.wait(1)
+
+    def _finish(self):
+        self.done = True
+        self._notify()
+
+    def produce(self, wsgi_app, environ):
+        """Run wsgi_app, handing its output to the loop. Called on a worker
+        thread, or on the loop itself for inline requests."""
+        call = self._loop.call_soon_threadsafe
+        response = []
+        announced = False
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [int(status.split(' ', 1)[0]),
+                           [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers]]
+
+        try:
+            body = wsgi_app(environ, start_response)
+            try:
+                for chunk in body:
+                    if not announced:
+                        call(self._start, *response)
+                        announced = True
+                    if not chunk:
+                        continue
+                    if self.max_buffered is None:
+                        call(self._push, bytes(chunk))
+                    else:
+                        self._push_and_wait(bytes(chunk))
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+            if not announced:
+                call(self._start, *response)
+                announced = True
+        except Exception as e:
+            logger.error(f"Error serving {environ['PATH_INFO']}: {e}")
+            if not announced:
+                call(self._start, 500, [(b'content-type', b'text/plain; charset=utf-8')])
+        finally:
+            call(self._finish)
+
+    async def send_to(self, send):
+        reader = object()
+        self._readers[reader] = sent = self._dropped
+        try:
+            while self.status is None and not self.done:
+                await self._changed
+            await send({'type': 'http.response.start', 'status': self.status,
+                        'headers': self.headers})
+            while True:
+                while sent < self._dropped + len(self.chunks):
+                    chunk = self.chunks[sent - self._dropped]
+                    await send({'type': 'http.response.body', 'body': chunk,
+                                'more_body': True})
+                    sent += 1
+                    self._readers[reader] = sent
+                    self._release()
+                if self.done:
+                    break
+                await self._changed
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            del self._readers[reader]
+            self._release()
+
+
+class AsgiApp:
+    """ASGI application serving wsgi_app without blocking the event loop.
+
+    inline(path) says whether a request can be answered from memory and
+    so run directly on the loop. Paths in unsupported are answered with a
+    501. Paths starting with one of the uncoalesced prefixes always get a
+    response of their own, so diagnostics describe the moment they were
+    asked for. buffer_bytes bounds how far a worker runs ahead of the
+    slowest client it is streaming to.
+    """
+
+    def __init__(self, wsgi_app, inline=None, db_workers=8, max_pending=64,
+                 unsupported=('/api/stream',), uncoalesced=('/api/admin/',),
+                 buffer_bytes=STREAM_BUFFER_BYTES):
+        self.wsgi_app = wsgi_app
+        self.inline = inline or (lambda path: False)
+        self.max_pending = max_pending
+        self.buffer_bytes = buffer_bytes
+        self.unsupported = frozenset(unsupported)
+        self.uncoalesced = tuple(uncoalesced)
+        self._executor = ThreadPoolExecutor(db_workers, thread_name_prefix='asgi-db')
+        self._in_flight = {}
+        self._pending = 0
+
+        # Simple counters, only ever incremented
+        self.inline_requests = 0
+        self.offloaded = 0
+        self.coalesced = 0
+        self.rejected = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        path = scope['path']
+        if path in self.unsupported:
+            await self._respond(send, 501, f'{path} is only served by the WSGI server')
+            return
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > MAX_BODY_BYTES:
+                await self._respond(send, 413, 'Request body too large')
+                return
+            if not message.get('more_body'):
+                break
+        environ = wsgi_environ(scope, bytes(body))
+        loop = asyncio.get_running_loop()
+
+        if self.inline(path):
+            self.inline_requests += 1
+            response = SharedResponse(loop)
+            response.produce(self.wsgi_app, environ)
+            # produce() hands everything to the loop with call_soon
+            await response.send_to(send)
+            return
+
+        key = None
+        if scope['method'] in ('GET', 'HEAD') and not path.startswith(self.uncoalesced):
+            # Every value of a repeated header counts
+            key = (scope['method'], path, scope.get('query_string', b''),
+                   tuple(tuple(value for header, value in scope['headers'] if header == name)
+                         for name in COALESCE_HEADERS))
+            response = self._in_flight.get(key)
+            if response is not None and response.joinable:
+                self.coalesced += 1
+                await response.send_to(send)
+                return
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            await self._respond(send, 503, 'Too many requests waiting for the database',
+                                [(b'retry-after', b'1')])
+            return
+        self.offloaded += 1
+        response = SharedResponse(loop, self.buffer_bytes)
+        if key is not None:
+            self._in_flight[key] = response
+        self._pending += 1
+        work = loop.run_in_executor(self._executor, response.produce, self.wsgi_app, environ)
+
+        def finished(_):
+            self._pending -= 1
+            if key is not None and self._in_flight.get(key) is response:
+                del self._in_flight[key]
+        work.add_done_callback(finished)
+        await response.send_to(send)
+
+    async def _respond(self, send, status, message, headers=()):
+        body = message.encode()
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                                (b'content-length', str(len(body)).encode()), *headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+async def _serve_connection(app, reader, writer):
+    server = writer.get_extra_info('sockname')
+    client = writer.get_extra_info('peername')
+    try:
+        while True:
+            try:
+                head = await reader.readuntil(b'\r\n\r\n')
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ', 2)
+            headers = []
+            for line in lines[1:]:
+                if line:
+                    name, _, value = line.partition(':')
+                    headers.append((name.strip().lower().encode('latin-1'),
+                                    value.strip().encode('latin-1')))
+            fields = dict(headers)
+            length = int(fields.get(b'content-length', 0))
+            if length > MAX_BODY_BYTES:
+                return
+            body = await reader.readexactly(length)
+            connection = fields.get(b'connection', b'').lower()
+            keep_alive = connection != b'close' if version == 'HTTP/1.1' \
+                else connection == b'keep-alive'
+            path, _, query = target.partition('?')
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'},
+                'http_version': version[5:], 'method': method, 'scheme': 'http',
+                'path': unquote(path), 'raw_path': path.encode('latin-1'),
+                'query_string': query.encode('latin-1'), 'root_path': '',
+                'headers': headers, 'server': server[:2], 'client': client[:2],
+            }
+            received = False
+
+            async def receive():
+                nonlocal received
+                if not received:
+                    received = True
+                    return {'type': 'http.request', 'body': body, 'more_body': False}
+                await asyncio.Future()  # only a disconnect would come next
+
+            chunked = False
+
+            async def send(message):
+                nonlocal chunked, keep_alive
+                if message['type'] == 'http.response.start':
+                    status = message['status']
+                    names = {name.lower() for name, _ in message['headers']}
+                    chunked = b'content-length' not in names and method != 'HEAD' and \
+                        status not in (204, 304)
+                    if chunked and version != 'HTTP/1.1':
+                        chunked, keep_alive = False, False
+                    lines = [f"HTTP/1.1 {status} {STATUS_REASONS.get(status, '')}".encode()]
+                    lines += [name + b': ' + value for name, value in message['headers']]
+                    if chunked:
+                        lines.append(b'transfer-encoding: chunked')
+                    lines.append(b'connection: ' + (b'keep-alive' if keep_alive else b'close'))
+                    writer.write(b'\r\n'.join(lines) + b'\r\n\r\n')
+                    return
+                data = message.get('body', b'')
+                if method == 'HEAD':
+                    data = b''
+                if chunked:
+                    if data:
+                        writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+                    if not message.get('more_body'):
+                        writer.write(b'0\r\n\r\n')
+                elif data:
+                    writer.write(data)
+                await writer.drain()
+
+            await app(scope, receive, send)
+            if not keep_alive:
+                return
+    except (ConnectionError, ValueError) as e:
+        logger.debug(f"Dropping connection from {client}: {e}")
+    finally:
+        writer.close()
+
+
+async def serve(app, host='0.0.0.0', port=5000, started=None):
+    """Serve app over HTTP/1.1 until cancelled. started, if given, is
+    called with the bound port."""
+    server = await asyncio.start_server(
+        lambda reader, writer: _serve_connection(app, reader, writer), host, port)
+    bound = server.sockets[0].getsockname()[1]
+    logger.info(f"Serving ASGI app on {host}:{bound}")
+    if started is not None:
+        started(bound)
+    async with server:
+        await server.serve_forever()
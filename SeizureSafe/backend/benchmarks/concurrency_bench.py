@@ -0,0 +1,156 @@
+"""Concurrency benchmark of the Flask and asyncio (ASGI) serving modes.
+
+Each mode serves a generated database (see datastore_bench.database()) from
+a child process: 'flask' is the threaded Werkzeug server behind
+`python app.py`, 'asgi' is AsgiApp under asgi.serve(), as run by
+`python api.py --asgi`. --clients concurrent dashboard clients then send
+requests for --duration seconds: --slow-share of them ask for --slow-hours
+of raw history, the rest for /api/latest. The response cache is off, so
+every history request does the full work; identical in-flight requests
+are still coalesced in asgi mode.
+
+Reported per mode and route: latency percentiles, requests per second and
+errors (anything but a 200, e.g. a 503 from a full ASGI executor):
+
+    python -m benchmarks.concurrency_bench --size 1M --clients 50 --output concurrency.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import time
+
+from benchmarks.datastore_bench import database, environment, latency_stats, parse_size
+from data_store import DataStore
+
+logger = logging.getLogger(__name__)
+
+MODES = ('flask', 'asgi')
+
+
+def _serve(mode, db_path, conn):
+    """Child process: serve db_path in mode and send the bound port back."""
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # a line per request
+    from app import create_app
+    app = create_app(DataStore(db_path, read_only=True), ingest_mode='off')
+    services = app.extensions['seizuresafe']
+    services.responses = None
+    if mode == 'flask':
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        conn.send(server.server_port)
+        server.serve_forever()
+    else:
+        from asgi import AsgiApp, serve
+        application = AsgiApp(app, inline=services.served_from_memory,
+                              db_workers=services.store.max_readers)
+        asyncio.run(serve(application, '127.0.0.1', 0, started=conn.send))
+
+
+def start_server(mode, db_path):
+    """(port, process) of a server for db_path in a child process."""
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_serve, args=(mode, db_path, sender), daemon=True)
+    process.start()
+    if not receiver.poll(60):
+        process.terminate()
+        raise RuntimeError(f"{mode} server did not start")
+    return receiver.recv(), process
+
+
+async def _get(port, path):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: localhost\r\n'
+                     f'Connection: close\r\n\r\n'.encode())
+        response = await reader.read()
+    finally:
+        writer.close()
+    return int(response[9:12]) if response[:5] == b'HTTP/' else 0
+
+
+async def load(port, clients, duration, slow_hours, slow_share, seed=0):
+    """({route: ([latency seconds], errors)}, elapsed seconds) from clients
+    sending requests for duration, and waiting for the last responses."""
+    routes = {'/api/history': ([], [0]), '/api/latest': ([], [0])}
+    started = time.perf_counter()
+    stop_at = started + duration
+
+    async def client(rng):
+        while time.perf_counter() < stop_at:
+            slow = rng.random() < slow_share
+            route = '/api/history' if slow else '/api/latest'
+            sent = time.perf_counter()
+            try:
+                status = await _get(port, f'/api/history/{slow_hours}' if slow else route)
+            except OSError:
+                status = 0
+            latencies, errors = routes[route]
+            latencies.append(time.perf_counter() - sent)
+            if status != 200:
+                errors[0] += 1
+
+    await asyncio.gather(*(client(random.Random(seed + i)) for i in range(clients)))
+    return ({route: (latencies, errors[0]) for route, (latencies, errors) in routes.items()},
+            time.perf_counter() - started)
+
+
+def run(size, data_dir, clients=50, duration=10.0, slow_hours=168, slow_share=0.2,
+        modes=MODES, regenerate=False, devices=100, days=30):
+    path = database(data_dir, size, regenerate, devices=devices, days=days)
+    # Servers open it read-only, so migrate a database cached by an older version
+    DataStore(path).close()
+    results = []
+    for mode in modes:
+        port, process = start_server(mode, path)
+        try:
+            routes, elapsed = asyncio.run(load(port, clients, duration, slow_hours,
+                                               slow_share))
+        finally:
+            process.terminate()
+            process.join()
+        for route, (latencies, errors) in routes.items():
+            if not latencies:
+                continue
+            results.append(dict(latency_stats(latencies), name=route, mode=mode,
+                                size=size, clients=clients, errors=errors,
+                                requests_per_second=len(latencies) / elapsed))
+        logger.info(f"Finished {mode} with {clients} clients")
+    return {'meta': environment(), 'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Flask vs asyncio serving under concurrency.')
+    parser.add_argument('--size', default='1M', help='reading count, e.g. 1M')
+    parser.add_argument('--data-dir', default=os.path.join('benchmarks', 'data'))
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--slow-hours', type=int, default=168)
+    parser.add_argument('--slow-share', type=float, default=0.2)
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--regenerate', action='store_true')
+    parser.add_argument('--output', help='write the JSON results here')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    report = run(parse_size(args.size), args.data_dir, args.clients, args.duration,
+                 args.slow_hours, args.slow_share, args.modes.split(','),
+                 args.regenerate, args.devices, args.days)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""DataStore and HTTP API benchmarks at production data sizes.
+
+For each size a database of synthetic readings is generated once and kept
+in --data-dir. Each database holds `devices` bracelets reporting
+regularly over the last --days days. Against each database the suite
+measures:
+
+  save_data            single-reading inserts per second
+  save_batch           batched inserts per second, for several batch sizes
+  get_historical_data  latency per window size
+  get_latest_data      latency
+  /api/history, /api/latest
+                       request latency through the Flask test client
+
+--backends memory runs the same benchmarks against a MemoryStore copy of
+each database as well (results carry "backend": "memory"), which leaves
+the API's own overhead once the SQLite time is taken out:
+
+    python -m benchmarks.datastore_bench --sizes 1M --backends sqlite,memory
+
+Results are written as JSON (--output), and --baseline compares them with
+an earlier run and exits non-zero if anything regressed by more than
+--threshold:
+
+    python -m benchmarks.datastore_bench --sizes 1M,10M,50M --output bench.json
+    python -m benchmarks.datastore_bench --sizes 1M --baseline bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime
+from unittest import mock
+
+from data_store import DataStore, now_ms
+from memory_store import MemoryStore
+
+logger = logging.getLogger(__name__)
+
+WINDOW_HOURS = (1, 6, 24, 168)
+BATCH_SIZES = (100, 1000, 10000)
+
+# Rows handed to save_batch() per call while generating a database
+GENERATE_CHUNK = 50000
+
+
+def parse_size(text):
+    """'1M' -> 1000000, '500K' -> 500000, '2000' -> 2000."""
+    text = text.strip().upper()
+    scale = {'K': 1000, 'M': 1000 ** 2}.get(text[-1:], 1)
+    return int(float(text.rstrip('KM')) * scale)
+
+
+def format_size(size):
+    for suffix, scale in (('M', 1000 ** 2), ('K', 1000)):
+        if size >= scale and size % scale == 0:
+            return f'{size // scale}{suffix}'
+    return str(size)
+
+
+def reading(rng, device):
+    return {
+        "heart_rate": float(rng.randint(60, 120)),
+        "previous_heart_rate": float(rng.randint(60, 120)),
+        "fall_detected": rng.random() < 0.001,
+        "seizure_detected": rng.random() < 0.002,
+        "client_id": device
+    }
+
+
+def generate(path, size, devices=100, days=30, seed=0):
+    """Fill a new database at path with size readings ending now."""
+    rng = random.Random(seed)
+    end = now_ms()
+    step = days * 24 * 3600 * 1000 / size
+    names = [f'bracelet-{i}' for i in range(devices)]
+    started = time.perf_counter()
+    with DataStore(path) as store:
+        for offset in range(0, size, GENERATE_CHUNK):
+            rows = []
+            for i in range(offset, min(size, offset + GENERATE_CHUNK)):
+                ts = int(end - (size - i) * step)
+                row = store.prepare_row(reading(rng, names[i % devices]))
+                rows.append((datetime.fromtimestamp(ts / 1000), ts) + row[2:])
+            store.save_batch(rows)
+            logger.info(f"Generated {offset + len(rows)}/{size} readings")
+    with open(path + '.json', 'w') as f:
+        json.dump({'size': size, 'devices': devices, 'days': days, 'end_ms': end,
+                   'seconds': time.perf_counter() - started}, f)
+
+
+def database(data_dir, size, regenerate=False, **options):
+    """Path of the cached database with size readings, generated if needed."""
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f'bench_{format_size(size)}.db')
+    if regenerate or not os.path.exists(path + '.json'):
+        for suffix in ('', '-wal', '-shm', '.json'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        generate(path, size, **options)
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    age_hours = (now_ms() - meta['end_ms']) / 3600000
+    if age_hours > 1:
+        logger.warning(f"{path} was generated {age_hours:.1f} hours ago; recent windows "
+                       "hold fewer readings than at generation time (--regenerate)")
+    return path
+
+
+def latency_stats(samples):
+    """Latency percentiles in milliseconds from a list of seconds."""
+    samples = sorted(samples)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000
+    return {
+        'runs': len(samples),
+        'p50_ms': percentile(50),
+        'p99_ms': percentile(99),
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+
+def timed(fn, repeats):
+    samples = []
+    result = None
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - started)
+    return samples, result
+
+
+def bench_writes(store, single=2000, batched=50000, seed=1):
+    rng = random.Random(seed)
+    results = []
+    started = time.perf_counter()
+    for i in range(single):
+        store.save_data(reading(rng, f'bracelet-{i % 100}'))
+    elapsed = time.perf_counter() - started
+    results.append({'name': 'save_data', 'rows': single,
+                    'rows_per_second': single / elapsed})
+    for batch_size in BATCH_SIZES:
+        batches = max(1, batched // batch_size)
+        rows = [[store.prepare_row(reading(rng, f'bracelet-{i % 100}'))
+                 for i in range(batch_size)] for _ in range(batches)]
+        started = time.perf_counter()
+        for batch in rows:
+            store.save_batch(batch)
+        elapsed = time.perf_counter() - started
+        results.append({'name': 'save_batch', 'batch_size': batch_size,
+                        'rows': batch_size * batches,
+                        'rows_per_second': batch_size * batches / elapsed})
+    return results
+
+
+def bench_reads(store, repeats):
+    results = []
+    for hours in WINDOW_HOURS:
+        samples, rows = timed(lambda: store.get_historical_data(hours), repeats)
+        results.append(dict(latency_stats(samples), name='get_historical_data',
+                            hours=hours, rows=len(rows)))
+    samples, _ = timed(store.get_latest_data, repeats * 10)
+    results.append(dict(latency_stats(samples), name='get_latest_data'))
+    return results
+
+
+def bench_api(store, repeats):
+    from app import create_app
+    app = create_app(store, ingest_mode='off')
+    app.config['TESTING'] = True
+    client = app.test_client()
+    results = []
+    # Without the response cache, so every request does the full work
+    with mock.patch.object(app.extensions['seizuresafe'], 'responses', None):
+        for hours in WINDOW_HOURS:
+            def request():
+                response = client.get(f'/api/history/{hours}')
+                assert response.status_code == 200, response.status_code
+                return len(response.get_data())
+            samples, size = timed(request, repeats)
+            results.append(dict(latency_stats(samples), name='/api/history',
+                                hours=hours, response_bytes=size))
+        samples, _ = timed(lambda: client.get('/api/latest'), repeats * 10)
+        results.append(dict(latency_stats(samples), name='/api/latest'))
+    return results
+
+
+def load_memory_store(store, chunk_size=100000):
+    """A MemoryStore holding a copy of every reading in store."""
+    memory = MemoryStore()
+    rows = []
+    for row in store.iter_rows(0, chunk_size=chunk_size):
+        rows.append((row[2], row[1], row[3], row[4], row[5], row[6], row[7]))
+        if len(rows) == chunk_size:
+            memory.save_batch(rows)
+            rows = []
+    memory.save_batch(rows)
+    return memory
+
+
+def run(sizes, data_dir, repeats=20, regenerate=False, api=True, writes=True,
+        devices=100, days=30, single_writes=2000, batched_writes=50000,
+        backends=('sqlite',)):
+    results = []
+    for size in sizes:
+        path = database(data_dir, size, regenerate, devices=devices, days=days)
+        with DataStore(path) as store:
+            stores = []
+            # Copied before anything is written to the database
+            if 'memory' in backends:
+                stores.append(({'backend': 'memory'}, load_memory_store(store)))
+            if 'sqlite' in backends:
+                stores.insert(0, ({}, store))
+            for labels, target in stores:
+                # Reads first, so the write benchmark's extra rows do not count
+                for result in bench_reads(target, repeats):
+                    results.append(dict(result, size=size, **labels))
+                if api:
+                    for result in bench_api(target, repeats):
+                        results.append(dict(result, size=size, **labels))
+                if writes:
+                    for result in bench_writes(target, single_writes, batched_writes):
+                        results.append(dict(result, size=size, **labels))
+        logger.info(f"Finished benchmarks at {format_size(size)} readings")
+    return {'meta': environment(), 'results': results}
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+    }
+
+
+def _key(result):
+    return tuple((k, result[k]) for k in ('backend', 'name', 'size', 'hours', 'batch_size')
+                 if k in result)
+
+
+def compare(baseline, current, threshold=0.2):
+    """Results that got more than threshold worse than in baseline: higher
+    p50 latency or lower throughput."""
+    previous = {_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        before = previous.get(_key(result))
+        if before is None:
+            continue
+        if 'p50_ms' in result and result['p50_ms'] > before['p50_ms'] * (1 + threshold):
+            regressions.append((dict(_key(result)), 'p50_ms',
+                                before['p50_ms'], result['p50_ms']))
+        if 'rows_per_second' in result and \
+                result['rows_per_second'] < before['rows_per_second'] * (1 - threshold):
+            regressions.append((dict(_key(result)), 'rows_per_second',
+                                before['rows_per_second'], result['rows_per_second']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DataStore and API benchmarks.')
+    parser.add_argument('--sizes', default='1M,10M,50M',
+                        help='comma-separated reading counts, e.g. 1M,10M,50M')
+    parser.add_argument('--data-dir', default=os.path.join('benchmarks', 'data'))
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--days', type=int, default=30)
+    parser.add_argument('--regenerate', action='store_true')
+    parser.add_argument('--no-api', action='store_true')
+    parser.add_argument('--no-writes', action='store_true')
+    parser.add_argument('--backends', default='sqlite',
+                        help='comma-separated storage backends: sqlite, memory')
+    parser.add_argument('--output', help='write the JSON results here')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    report = run([parse_size(s) for s in args.sizes.split(',')], args.data_dir,
+                 args.repeats, args.regenerate, not args.no_api, not args.no_writes,
+                 args.devices, args.days, backends=args.backends.split(','))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        for key, metric, before, after in regressions:
+            print(f"REGRESSION {key} {metric}: {before:.3f} -> {after:.3f}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
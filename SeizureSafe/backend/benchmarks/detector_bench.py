@@ -0,0 +1,68 @@
+"""Throughput benchmark for the streaming seizure detector.
+
+Feeds interleaved synthetic readings from many devices through one
+SeizureDetector on one core and reports samples per second (with one reading per device per second,
+that is also the number of devices one core can keep up with).
+
+    python -m benchmarks.detector_bench --devices 5000 --samples 100
+"""
+import argparse
+import json
+import random
+import time
+
+from detector import SeizureDetector
+
+
+def synthetic_readings(devices, samples, seed=0):
+    """Interleaved (device_id, ts, heart_rate, previous, fall) readings, one
+    round per second, with occasional seizure-like episodes."""
+    rng = random.Random(seed)
+    start = 1_700_000_000_000
+    rates = [65.0 + rng.uniform(-5, 5) for _ in range(devices)]
+    names = [f'bracelet-{i}' for i in range(devices)]
+    readings = []
+    for n in range(samples):
+        ts = start + n * 1000
+        for i in range(devices):
+            previous = rates[i]
+            if rng.random() < 0.01:
+                rates[i] = rng.uniform(90, 140)
+            else:
+                rates[i] = min(max(rates[i] + rng.uniform(-2, 2), 55.0), 75.0)
+            readings.append((names[i], ts, rates[i], previous, rng.random() < 0.001))
+    return readings
+
+
+def run(devices=5000, samples=100, seed=0):
+    readings = synthetic_readings(devices, samples, seed)
+    detector = SeizureDetector()
+    process = detector.process
+    detections = 0
+    started = time.perf_counter()
+    for device_id, ts, heart_rate, previous, fall in readings:
+        detections += len(process(device_id, ts, heart_rate, previous, fall))
+    elapsed = time.perf_counter() - started
+    return {
+        'benchmark': 'detector',
+        'devices': devices,
+        'samples': len(readings),
+        'detections': detections,
+        'seconds': elapsed,
+        'samples_per_second': len(readings) / elapsed,
+        'microseconds_per_sample': elapsed / len(readings) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=5000)
+    parser.add_argument('--samples', type=int, default=100,
+                        help='readings per device')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    print(json.dumps(run(args.devices, args.samples, args.seed), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""Record raw MQTT traffic and replay it into the ingest pipeline.
+
+A capture file is append-only: a magic line followed by one record per
+message,
+
+    arrival time u64 (epoch microseconds) | topic length u16 |
+    payload length u32 | topic (utf-8) | payload (raw bytes)
+
+so it can be written from the MQTT callback with a single buffered write
+and survives a crash with at most a torn last record, which readers skip.
+
+Replay feeds a capture to an IngestService's on_message, bypassing the
+network, so replayed readings take the same alert, dedupe and waveform
+paths as live ones, preserving the original inter-arrival gaps divided by speed
+(None replays as fast as possible):
+
+    python capture.py info traffic.ssc
+    python capture.py replay traffic.ssc --speed 10 --db replay.db
+"""
+import argparse
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from types import SimpleNamespace
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SSCAPTURE1\n'
+RECORD = struct.Struct('<QHI')
+
+
+class CaptureWriter:
+    """Appends raw messages to a capture file. Safe to call from any thread.
+
+    Records are buffered and flushed every flush_interval seconds (checked
+    on write) and on close(), so capturing costs one small memcpy per
+    message on the MQTT thread.
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not new:
+            # Drop a record torn by a crash so new records stay aligned
+            valid = _valid_length(path)
+            if valid < os.path.getsize(path):
+                logger.warning(f"Truncating torn last record of {path}")
+                os.truncate(path, valid)
+        self._file = open(path, 'ab')
+        if new:
+            self._file.write(MAGIC)
+        self._last_flush = time.monotonic()
+        self.count = 0
+
+    def write(self, topic, payload, arrival_us=None):
+        if arrival_us is None:
+            arrival_us = time.time_ns() // 1000
+        topic = topic.encode() if isinstance(topic, str) else topic
+        record = RECORD.pack(arrival_us, len(topic), len(payload)) + topic + bytes(payload)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(record)
+            self.count += 1
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self._file.flush()
+                self._last_flush = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def _valid_length(path):
+    """Length of the prefix of path made of whole records."""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        end = len(MAGIC)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return end
+            _, topic_length, payload_length = RECORD.unpack(header)
+            record_end = end + RECORD.size + topic_length + payload_length
+            if record_end > size:
+                return end
+            f.seek(record_end)
+            end = record_end
+
+
+def read_capture(path):
+    """Yield (arrival_us, topic, payload) records in file order."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            arrival_us, topic_length, payload_length = RECORD.unpack(header)
+            topic = f.read(topic_length)
+            payload = f.read(payload_length)
+            if len(payload) < payload_length:
+                logger.warning(f"Ignoring truncated last record in {path}")
+                break
+            yield arrival_us, topic.decode(), payload
+
+
+def replay(path, handle, speed=1.0, sleep=time.sleep, clock=time.monotonic):
+    """Call handle(topic, payload) for every captured message.
+
+    With a speed, each message is sent at its original offset from the
+    first one divided by speed; with speed=None as fast as possible.
+    Returns a summary including how far behind schedule replay fell.
+    """
+    if speed is not None and speed <= 0:
+        raise ValueError("speed must be positive")
+    messages = failed = 0
+    max_lag = 0.0
+    first_us = None
+    started = clock()
+    for arrival_us, topic, payload in read_capture(path):
+        if first_us is None:
+            first_us = arrival_us
+        if speed is not None:
+            due = started + (arrival_us - first_us) / 1e6 / speed
+            delay = due - clock()
+            if delay > 0:
+                sleep(delay)
+            else:
+                max_lag = max(max_lag, -delay)
+        try:
+            handle(topic, payload)
+        except Exception as e:
+            failed += 1
+            logger.debug(f"Replayed message rejected: {e}")
+        messages += 1
+    elapsed = clock() - started
+    return {
+        'messages': messages,
+        'failed': failed,
+        'seconds': elapsed,
+        'rate': messages / elapsed if elapsed else 0.0,
+        'speed': speed,
+        'max_lag_seconds': max_lag,
+    }
+
+
+def replay_into_service(path, service, speed=1.0):
+    """Replay a capture through service.on_message(), as the MQTT client
+    would deliver it, then wait for the service to write everything."""
+    def handle(topic, payload):
+        service.on_message(None, None, SimpleNamespace(topic=topic, payload=payload))
+
+    report = replay(path, handle, speed)
+    service.pipeline.stop()
+    service.waveforms.stop()
+    pipeline = service.pipeline
+    report.update(written=pipeline.written, dropped=pipeline.dropped,
+                  write_failed=pipeline.failed,
+                  undecodable=service.messages_failed.value(),
+                  rejected=service.readings_rejected.value(),
+                  redelivered=service.readings_redelivered.value())
+    return report
+
+
+def capture_info(path):
+    count = size = 0
+    first = last = None
+    topics = set()
+    for arrival_us, topic, payload in read_capture(path):
+        count += 1
+        size += len(payload)
+        first = arrival_us if first is None else first
+        last = arrival_us
+        topics.add(topic)
+    return {
+        'messages': count,
+        'payload_bytes': size,
+        'seconds': (last - first) / 1e6 if count else 0.0,
+        'topics': sorted(topics),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or replay an MQTT capture.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info')
+    info.add_argument('path')
+    play = commands.add_parser('replay')
+    play.add_argument('path')
+    play.add_argument('--speed', default='1',
+                      help="speed-up factor, e.g. 1 or 10, or 'max'")
+    play.add_argument('--db', default='replay.db')
+    play.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.command == 'info':
+        print(json.dumps(capture_info(args.path), indent=2))
+        return
+
+    from data_store import DataStore
+    from ingestd import IngestService
+    speed = None if args.speed == 'max' else float(args.speed)
+    store = DataStore(args.db)
+    service = IngestService(store)
+    # Replayed traffic must not be appended to MQTT_CAPTURE_PATH again
+    service.capture = None
+    service.pipeline.batch_size = args.batch_size
+    service.pipeline.start()
+    service.waveforms.start()
+    try:
+        print(json.dumps(replay_into_service(args.path, service, speed), indent=2))
+    finally:
+        service.stop()
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
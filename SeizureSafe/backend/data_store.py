@@ -1,91 +1,1321 @@
 import sqlite3
+import collections
+import heapq
 import json
+import logging
+import os
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from datetime import datetime
+from archive import read_archive, write_archive
+from tracing import current as current_trace, record_query
 
-class DataStore:
-    def __init__(self, db_path='seizure_data.db'):
+logger = logging.getLogger(__name__)
+
+DAY_MS = 24 * 3600 * 1000
+
+def now_ms():
+    """Current UTC time as integer epoch milliseconds."""
+    return int(time.time() * 1000)
+
+def partition_table(day):
+    """Name of the partition table for a day number (UTC days since epoch)."""
+    return time.strftime('seizure_data_%Y%m%d', time.gmtime(day * 86400))
+
+# Device timestamps further in the future than this are not trusted; the
+# reading is stamped with its arrival time instead
+MAX_CLOCK_SKEW_MS = 5 * 60 * 1000
+
+# Sequence number stored for a reading with a millisecond device timestamp
+# but no sequence number of its own: (device_id, ts_ms) identifies it
+NO_SEQUENCE = -1
+
+def reading_device(data):
+    """The device id of a decoded message: device_id, else client_id."""
+    device_id = str(data.get('device_id', data.get('client_id', '')))
+    if len(device_id) > MAX_DEVICE_ID_LENGTH:
+        raise ValueError(f"device id longer than {MAX_DEVICE_ID_LENGTH} characters")
+    return device_id
+
+def device_time(data):
+    """(epoch ms, precise) of the time a bracelet took a reading, from
+    'device_ts' or 'ts' (epoch ms) or a local-time 'timestamp' string with
+    second precision; (None, False) if it did not say."""
+    ts = data.get('device_ts', data.get('ts'))
+    if ts is not None:
+        return int(ts), True
+    text = data.get('timestamp')
+    if isinstance(text, str):
+        try:
+            return int(datetime.strptime(text, '%Y-%m-%d %H:%M:%S').timestamp() * 1000), False
+        except ValueError:
+            pass
+    return None, False
+
+def reading_key(row):
+    """Identity of a prepare_row() row for deduplication, or None for a
+    reading stamped on arrival, which cannot be told apart from a copy."""
+    seq = row[7] if len(row) > 7 else None
+    return None if seq is None else (row[6], row[1], seq)
+
+# Column order of rows returned by DataStore.iter_rows()
+ROW_COLUMNS = ('id, ts_ms, timestamp, heart_rate, previous_heart_rate, '
+               'fall_detected, seizure_detected, device_id')
+
+def _create_seizure_data(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS seizure_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp DATETIME,
+            heart_rate REAL,
+            previous_heart_rate REAL,
+            fall_detected INTEGER,
+            seizure_detected INTEGER
+        )
+    ''')
+
+def _add_epoch_column(cursor):
+    # Adding a nullable column is a schema-only change; existing rows are
+    # filled in afterwards by DataStore.backfill_epoch() in small chunks.
+    cursor.execute('ALTER TABLE seizure_data ADD COLUMN ts_ms INTEGER')
+    cursor.execute('CREATE INDEX idx_seizure_data_ts ON seizure_data (ts_ms)')
+
+def _history_reading(row):
+    """History entry for an iter_rows() tuple."""
+    return {
+        'timestamp': row[2],
+        'device_id': row[7],
+        'heart_rate': row[3],
+        'fall_detected': bool(row[5]),
+        'seizure_detected': bool(row[6])
+    }
+
+def format_cursor(ts_ms, row_id):
+    """Opaque keyset pagination cursor for a history row."""
+    return f'{ts_ms}:{row_id}'
+
+def parse_cursor(cursor):
+    """Inverse of format_cursor(). A bare epoch-ms value means 'after ts'."""
+    try:
+        if ':' in cursor:
+            ts, row_id = cursor.split(':', 1)
+            return int(ts), int(row_id)
+        # Every row at exactly ts is skipped; ids never reach 2**63
+        return int(cursor), 2 ** 63 - 1
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+# Longest accepted device id (bracelets send e.g. SeizureSafeBracelet-1234)
+MAX_DEVICE_ID_LENGTH = 128
+
+# Rollup resolutions: name -> (table, bucket width in ms)
+ROLLUPS = {
+    '1m': ('seizure_rollup_1m', 60 * 1000),
+    '1h': ('seizure_rollup_1h', 3600 * 1000),
+}
+RESOLUTIONS = ('raw',) + tuple(ROLLUPS) + ('auto',)
+
+def _create_rollups(cursor):
+    for table, width in ROLLUPS.values():
+        cursor.execute(f'''
+            CREATE TABLE {table} (
+                bucket_ms INTEGER PRIMARY KEY,
+                count INTEGER NOT NULL,
+                heart_rate_sum REAL NOT NULL,
+                heart_rate_min REAL NOT NULL,
+                heart_rate_max REAL NOT NULL,
+                seizure_count INTEGER NOT NULL,
+                fall_count INTEGER NOT NULL
+            )
+        ''')
+        # Rows still waiting for the epoch backfill are rolled up by it
+        cursor.execute(f'''
+            INSERT INTO {table}
+            SELECT ts_ms - ts_ms % {width}, COUNT(*), SUM(heart_rate),
+                   MIN(heart_rate), MAX(heart_rate),
+                   SUM(seizure_detected), SUM(fall_detected)
+            FROM seizure_data
+            WHERE ts_ms IS NOT NULL
+            GROUP BY 1
+        ''')
+
+# Per-device rollups, same buckets keyed by (device_id, bucket_ms)
+DEVICE_ROLLUPS = {
+    '1m': ('seizure_rollup_1m_device', 60 * 1000),
+    '1h': ('seizure_rollup_1h_device', 3600 * 1000),
+}
+
+def _fold(readings, width, by_device):
+    """Aggregate (ts_ms, heart_rate, fall, seizure, device_id) into buckets."""
+    buckets = {}
+    for ts, heart_rate, fall, seizure, device_id in readings:
+        key = (device_id, ts - ts % width) if by_device else (ts - ts % width,)
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [1, heart_rate, heart_rate, heart_rate, seizure, fall]
+        else:
+            bucket[0] += 1
+            bucket[1] += heart_rate
+            bucket[2] = min(bucket[2], heart_rate)
+            bucket[3] = max(bucket[3], heart_rate)
+            bucket[4] += seizure
+            bucket[5] += fall
+    return [(*key, *values) for key, values in buckets.items()]
+
+def _rollup_upsert(table, key_columns):
+    placeholders = ', '.join('?' * (len(key_columns) + 6))
+    return f'''
+        INSERT INTO {table} VALUES ({placeholders})
+        ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET
+            count = count + excluded.count,
+            heart_rate_sum = heart_rate_sum + excluded.heart_rate_sum,
+            heart_rate_min = min(heart_rate_min, excluded.heart_rate_min),
+            heart_rate_max = max(heart_rate_max, excluded.heart_rate_max),
+            seizure_count = seizure_count + excluded.seizure_count,
+            fall_count = fall_count + excluded.fall_count
+    '''
+
+def _update_rollups(cursor, readings):
+    """Fold (ts_ms, heart_rate, fall, seizure, device_id) tuples into the
+    global and per-device rollup tables."""
+    for resolution, (table, width) in ROLLUPS.items():
+        cursor.executemany(_rollup_upsert(table, ['bucket_ms']),
+                           _fold(readings, width, by_device=False))
+        device_table = DEVICE_ROLLUPS[resolution][0]
+        cursor.executemany(_rollup_upsert(device_table, ['device_id', 'bucket_ms']),
+                           _fold(readings, width, by_device=True))
+
+def _add_device_column(cursor):
+    # Readings from before this migration belong to no device ('')
+    cursor.execute("ALTER TABLE seizure_data ADD COLUMN device_id TEXT NOT NULL DEFAULT ''")
+    cursor.execute('CREATE INDEX idx_seizure_data_device_ts ON seizure_data (device_id, ts_ms)')
+    cursor.execute('''
+        CREATE TABLE devices (
+            device_id TEXT PRIMARY KEY,
+            first_seen_ms INTEGER NOT NULL,
+            last_seen_ms INTEGER NOT NULL,
+            reading_count INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    for table, width in DEVICE_ROLLUPS.values():
+        cursor.execute(f'''
+            CREATE TABLE {table} (
+                device_id TEXT NOT NULL,
+                bucket_ms INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                heart_rate_sum REAL NOT NULL,
+                heart_rate_min REAL NOT NULL,
+                heart_rate_max REAL NOT NULL,
+                seizure_count INTEGER NOT NULL,
+                fall_count INTEGER NOT NULL,
+                PRIMARY KEY (device_id, bucket_ms)
+            ) WITHOUT ROWID
+        ''')
+        cursor.execute(f'''
+            INSERT INTO {table}
+            SELECT device_id, ts_ms - ts_ms % {width}, COUNT(*), SUM(heart_rate),
+                   MIN(heart_rate), MAX(heart_rate),
+                   SUM(seizure_detected), SUM(fall_detected)
+            FROM seizure_data
+            WHERE ts_ms IS NOT NULL
+            GROUP BY 1, 2
+        ''')
+
+def _create_partition_registry(cursor):
+    # New readings go to one seizure_data_YYYYMMDD table per UTC day, so
+    # expiring a day is a DROP TABLE. The original seizure_data table is
+    # emptied into partitions in the background and stays as a staging area.
+    cursor.execute('''
+        CREATE TABLE partitions (
+            day INTEGER PRIMARY KEY,
+            table_name TEXT,
+            archive_path TEXT
+        )
+    ''')
+    for table, _ in DEVICE_ROLLUPS.values():
+        cursor.execute(f'CREATE INDEX idx_{table}_bucket ON {table} (bucket_ms)')
+
+def _create_dedupe_index(cursor, table):
+    # Partial: readings stamped on arrival have no identity to enforce
+    cursor.execute(f'''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_reading
+        ON {table} (device_id, ts_ms, seq) WHERE seq IS NOT NULL
+    ''')
+
+def _add_sequence_column(cursor):
+    # Readings keep the device's clock and sequence number, and a unique
+    # index turns QoS 1 redeliveries into no-ops
+    cursor.execute('SELECT table_name FROM partitions WHERE table_name IS NOT NULL')
+    for (table,) in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN seq INTEGER')
+        _create_dedupe_index(cursor, table)
+
+# Longest waveform chunk, which bounds how far back a window query looks
+# for chunks that start before it
+MAX_WAVEFORM_CHUNK_MS = 60 * 1000
+
+def _create_waveform_chunks(cursor):
+    # High-rate sensor samples (see waveforms.py), one compressed array per
+    # contiguous run of up to MAX_WAVEFORM_CHUNK_MS, instead of a row each
+    cursor.execute('''
+        CREATE TABLE waveform_chunks (
+            device_id TEXT NOT NULL,
+            channel TEXT NOT NULL,
+            start_ms INTEGER NOT NULL,
+            end_ms INTEGER NOT NULL,
+            sample_rate REAL NOT NULL,
+            sample_count INTEGER NOT NULL,
+            dtype TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (device_id, channel, start_ms)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX idx_waveform_chunks_start ON waveform_chunks (start_ms)')
+
+def _max_row_id(cursor, days):
+    cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'seizure_data'")
+    row = cursor.fetchone()
+    max_id = row[0] if row else 0
+    for day in days:
+        cursor.execute(f'SELECT MAX(id) FROM {partition_table(day)}')
+        max_id = max(max_id, cursor.fetchone()[0] or 0)
+    return max_id
+
+def _create_meta(cursor):
+    # The newest row id ever assigned is kept here, committed with the rows,
+    # so the data set version never moves backwards when the rows holding
+    # the highest ids are cleared or expired
+    cursor.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+    cursor.execute('SELECT day FROM partitions WHERE table_name IS NOT NULL')
+    days = [day for (day,) in cursor.fetchall()]
+    cursor.execute("INSERT INTO meta VALUES ('last_row_id', ?)", (_max_row_id(cursor, days),))
+
+def _last_row_id(cursor):
+    cursor.execute("SELECT value FROM meta WHERE key = 'last_row_id'")
+    return cursor.fetchone()[0]
+
+# Schema migrations, applied in order. The number of migrations applied so
+# far is kept in PRAGMA user_version, so only append to this list.
+MIGRATIONS = [
+    _create_seizure_data,
+    _add_epoch_column,
+    _create_rollups,
+    _add_device_column,
+    _create_partition_registry,
+    _add_sequence_column,
+    _create_waveform_chunks,
+    _create_meta,
+]
+
+WAVEFORM_COLUMNS = ('start_ms, end_ms, sample_rate, sample_count, dtype, width, codec, data')
+
+# Slow statements kept for /api/admin/slow-queries
+SLOW_QUERY_LOG_SIZE = 100
+
+def _loggable(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return f'<{len(value)} bytes>'
+    if isinstance(value, str) and len(value) > 200:
+        return value[:200] + '...'
+    return value
+
+class _TimedCursor(sqlite3.Cursor):
+    """Cursor that times each statement across its execute and fetch
+    calls. The time is added to the current request's trace as it is
+    spent; a statement that took slow_query_ms or more in total is handed
+    to the connection's on_slow_query once it is done, i.e. when it is
+    fetched to the end, the next one is executed or the cursor closes.
+    Rows read by iterating the cursor are neither timed nor counted."""
+
+    _sql = None
+
+    def _begin(self, sql, params, many):
+        self._finish()
+        self._sql, self._params, self._many = sql, params, many
+        self._elapsed, self._rows = 0.0, 0
+
+    def _spent(self, started, statements=0):
+        elapsed = time.perf_counter() - started
+        self._elapsed += elapsed
+        record_query(elapsed, statements)
+
+    def _finish(self):
+        if self._sql is None:
+            return
+        sql, self._sql = self._sql, None
+        connection = self.connection
+        if connection.slow_query_ms is None or \
+                self._elapsed * 1000 < connection.slow_query_ms:
+            return
+        rows = self._rows if self._rows or self.rowcount < 0 else self.rowcount
+        plan = None
+        if not self._many:
+            try:
+                explain = sqlite3.Cursor(connection)
+                explain.execute('EXPLAIN QUERY PLAN ' + sql, self._params)
+                plan = [detail for _, _, _, detail in explain.fetchall()] or None
+                explain.close()
+            except sqlite3.Error:
+                pass
+        params = None
+        if isinstance(self._params, dict):
+            params = {name: _loggable(value) for name, value in self._params.items()}
+        elif not self._many:
+            params = [_loggable(value) for value in self._params]
+        connection.on_slow_query(' '.join(sql.split()), params, rows,
+                                 self._elapsed * 1000, plan)
+
+    def execute(self, sql, params=()):
+        self._begin(sql, params, False)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._spent(started, 1)
+
+    def executemany(self, sql, params):
+        self._begin(sql, None, True)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, params)
+        finally:
+            self._spent(started, 1)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._spent(started)
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._spent(started)
+        self._rows += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._spent(started)
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+class _TimedConnection(sqlite3.Connection):
+    """Connection whose cursors are _TimedCursors."""
+
+    slow_query_ms = None
+
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def on_slow_query(self, sql, params, rows, ms, plan):
+        pass
+
+class StorageBackend(ABC):
+    """Store of readings, as the API, ingestion and analytics use it.
+
+    A backend implements the abstract primitives below: writing a batch, a
+    range query, the latest reading, purging, and the few aggregates the
+    API serves. The rest is built on them here. DataStore is the SQLite
+    backend; MemoryStore (memory_store.py) keeps everything in memory, for
+    tests and benchmarks. create_store() in storage.py picks one by
+    STORAGE_BACKEND.
+    """
+
+    read_only = False
+    # Statements logged as slow, if the backend has any
+    slow_queries = ()
+
+    def __init__(self, retention_days=None, max_readers=8):
+        # Raw readings older than retention_days are expired a whole day at a
+        # time by enforce_retention()
+        self.retention_days = retention_days
+        # Threads expected to query at once, e.g. for sizing a worker pool
+        self.max_readers = max_readers
+        self._maintenance_thread = None
+        self._stop_maintenance = threading.Event()
+
+    # Primitives
+
+    @abstractmethod
+    def save_batch(self, rows):
+        """Insert prepare_row() rows, skipping any whose (device_id, ts_ms,
+        seq) is already stored. Returns the rows inserted, in order."""
+
+    @abstractmethod
+    def iter_rows(self, start_ms, after=None, limit=None, device_id=None,
+                  chunk_size=1000, ids=None):
+        """Yield ROW_COLUMNS tuples with ts_ms >= start_ms in (ts_ms, id)
+        order; see DataStore.iter_rows() for the other arguments."""
+
+    @abstractmethod
+    def get_latest_data(self, device_id=None):
+        """The newest reading, of one device or of any; {} if none."""
+
+    @abstractmethod
+    def enforce_retention(self, now=None):
+        """Purge the days of raw readings older than retention_days.
+        Returns the expired day numbers."""
+
+    @abstractmethod
+    def clear_data(self):
+        """Purge everything."""
+
+    @abstractmethod
+    def get_rollup_data(self, hours, resolution, device_id=None):
+        """Aggregated history, one entry per ROLLUPS bucket."""
+
+    @abstractmethod
+    def window_counts(self, start_ms, device_id=None):
+        """(minute buckets, readings) from start_ms, a whole minute, on."""
+
+    @abstractmethod
+    def list_devices(self):
+        """Every device that has sent a reading, with first/last seen times."""
+
+    @abstractmethod
+    def last_row_id(self):
+        """Id of the newest committed reading, the data set version."""
+
+    @abstractmethod
+    def save_waveform_chunks(self, chunks):
+        """Insert waveform chunks, tuples of device_id, channel and then
+        WAVEFORM_COLUMNS, skipping any whose device, channel and start time
+        are already stored. Returns the number inserted."""
+
+    @abstractmethod
+    def iter_waveform_chunks(self, device_id, channel, start_ms, end_ms):
+        """Yield the chunks of one channel of a device that overlap
+        start_ms <= t < end_ms as WAVEFORM_COLUMNS tuples, oldest first."""
+
+    @abstractmethod
+    def list_waveform_channels(self, device_id):
+        """Names of the channels a device has sent waveform samples on."""
+
+    def close(self):
+        self._stop_maintenance.set()
+
+    # Built on the primitives
+
+    @staticmethod
+    def prepare_row(data):
+        """Validate a reading and convert it to a seizure_data row.
+
+        Bracelets identify themselves with client_id; device_id is accepted
+        too. Readings without either are stored under the empty device id.
+
+        The reading is stamped with the device's own time (see
+        device_time()) when it sent one, so readings buffered during a
+        disconnect keep their times, and with its arrival time otherwise.
+        A 'seq' sequence number, or failing that a millisecond device
+        timestamp, makes the row identifiable for deduplication. A missing
+        or None previous_heart_rate is stored as NULL.
+        """
+        device_id = reading_device(data)
+        previous = data.get('previous_heart_rate')
+        received = now_ms()
+        ts, precise = device_time(data)
+        seq = data.get('seq')
+        if ts is None or ts > received + MAX_CLOCK_SKEW_MS:
+            ts, seq = received, None
+        elif seq is not None:
+            seq = int(seq)
+        elif precise:
+            seq = NO_SEQUENCE
+        return (
+            datetime.fromtimestamp(ts / 1000),
+            ts,
+            float(data['heart_rate']),
+            None if previous is None else float(previous),
+            int(data['fall_detected']),
+            int(data['seizure_detected']),
+            device_id,
+            seq
+        )
+
+    def save_data(self, data):
+        self.save_batch([self.prepare_row(data)])
+
+    def retention_cutoff(self, now=None):
+        """Epoch ms before which raw readings are expired, or None."""
+        if self.retention_days is None:
+            return None
+        return (now_ms() if now is None else now) - self.retention_days * DAY_MS
+
+    def get_historical_data(self, hours=24, device_id=None):
+        return list(self.iter_historical_data(now_ms() - hours * 3600 * 1000,
+                                              device_id=device_id))
+
+    def iter_historical_data(self, start_ms, after=None, limit=None, device_id=None,
+                             ids=None):
+        """Generator version of get_historical_data() starting at start_ms."""
+        for row in self.iter_rows(start_ms, after, limit, device_id, ids=ids):
+            yield _history_reading(row)
+
+    def get_history_page(self, start_ms, after=None, limit=1000, device_id=None):
+        """One keyset page of raw history: (readings, next_cursor).
+
+        next_cursor is None once the last page has been returned.
+        """
+        rows = list(self.iter_rows(start_ms, after, limit + 1, device_id))
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = format_cursor(rows[-1][1], rows[-1][0])
+        return [_history_reading(row) for row in rows], next_cursor
+
+    def get_rows(self, start_ms):
+        """Raw rows since start_ms, in the prepare_row() layout."""
+        return [(str(row[2]), row[1], row[3], row[4], row[5], row[6], row[7])
+                for row in self.iter_rows(start_ms)]
+
+    def resolve_resolution(self, hours, resolution='auto', max_points=1000,
+                           device_id=None):
+        """Turn 'auto' into the finest resolution that fits in max_points."""
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution: {resolution}")
+        if resolution != 'auto':
+            return resolution
+        start = now_ms() - hours * 3600 * 1000
+        minutes, rows = self.window_counts(start - start % ROLLUPS['1m'][1], device_id)
+        if rows <= max_points:
+            return 'raw'
+        if minutes <= max_points:
+            return '1m'
+        return '1h'
+
+    def get_history(self, hours=24, resolution='raw', device_id=None):
+        """History at a resolution from RESOLUTIONS other than 'auto'."""
+        if resolution == 'raw':
+            return self.get_historical_data(hours, device_id)
+        if resolution not in ROLLUPS:
+            raise ValueError(f"Unknown resolution: {resolution}")
+        return self.get_rollup_data(hours, resolution, device_id)
+
+    def start_maintenance(self, interval_seconds=3600):
+        """Run enforce_retention() now and then every interval_seconds."""
+        def run():
+            while not self._stop_maintenance.is_set():
+                try:
+                    self.enforce_retention()
+                except RuntimeError:
+                    return  # closed
+                except Exception as e:
+                    logger.error(f"Retention run failed: {e}")
+                self._stop_maintenance.wait(interval_seconds)
+
+        if self._maintenance_thread is None:
+            self._maintenance_thread = threading.Thread(
+                target=run, name='retention', daemon=True)
+            self._maintenance_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class DataStore(StorageBackend):
+    # Applied to every connection. WAL lets readers run alongside the single
+    # writer, and synchronous=NORMAL only fsyncs at checkpoints instead of on
+    # every commit (still crash-safe for the database file in WAL mode).
+    PRAGMAS = (
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA busy_timeout=5000',
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA cache_size=-16000',
+        'PRAGMA mmap_size=268435456',
+    )
+
+    def __init__(self, db_path='seizure_data.db', max_readers=8,
+                 backfill_chunk_size=5000, retention_days=None, archive_dir=None,
+                 rollup_retention_days=None, read_only=False, slow_query_ms=None):
+        super().__init__(retention_days, max_readers)
         self.db_path = db_path
+        # A read-only store has no writer connection and never migrates; it
+        # serves queries next to a separate process that owns the writes
+        self.read_only = read_only
+        self.backfill_chunk_size = backfill_chunk_size
+        # Expired days are archived to archive_dir first if one is set
+        self.archive_dir = archive_dir
+        self.rollup_retention_days = rollup_retention_days
+        # Statements taking slow_query_ms or more are logged with their
+        # query plan and kept in slow_queries
+        self.slow_query_ms = slow_query_ms
+        self.slow_queries = collections.deque(maxlen=SLOW_QUERY_LOG_SIZE)
+        self._closed = False
+        self._write_lock = threading.Lock()
+        self._idle_readers = queue.LifoQueue()
+        self._writer = None
+        if not read_only:
+            self._writer = self._connect()
+            self._writer.execute('PRAGMA journal_mode=WAL')
+        self._backfill_thread = None
+        # Writer-side state: days with a live partition table, next row id
+        # and the highest committed row id
+        self._partition_days = set()
+        self._next_id = 1
+        self._last_id = 0
         self.init_db()
 
-    def init_db(self):
-        conn = sqlite3.connect(self.db_path)
+    def _connect(self, read_only=False):
+        # isolation_level=None puts the connection in autocommit mode so that
+        # transactions are only ever opened explicitly by _write().
+        conn = sqlite3.connect(self.db_path, isolation_level=None,
+                               check_same_thread=False, factory=_TimedConnection)
+        conn.slow_query_ms = self.slow_query_ms
+        conn.on_slow_query = self._slow_query
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        if read_only:
+            conn.execute('PRAGMA query_only=ON')
+        return conn
+
+    @contextmanager
+    def _write(self):
+        """Run a single transaction on the shared writer connection."""
+        with self._write_lock:
+            if self._closed:
+                raise RuntimeError('DataStore is closed')
+            if self._writer is None:
+                raise RuntimeError('DataStore is read-only')
+            cursor = self._writer.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+            except BaseException:
+                cursor.execute('ROLLBACK')
+                raise
+            else:
+                cursor.execute('COMMIT')
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def _read(self):
+        """Borrow a reader connection from the pool for the calling thread.
+
+        Readers never take the write lock, so with WAL journaling a slow
+        query cannot hold up ingestion.
+        """
+        if self._closed:
+            raise RuntimeError('DataStore is closed')
+        try:
+            conn = self._idle_readers.get_nowait()
+        except queue.Empty:
+            conn = self._connect(read_only=True)
         cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS seizure_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            if self._closed or self._idle_readers.qsize() >= self.max_readers:
+                conn.close()
+            else:
+                self._idle_readers.put(conn)
+
+    @contextmanager
+    def _snapshot(self):
+        """Reader cursor inside a read transaction, so that the partition
+        registry and the partition tables it names are seen consistently."""
+        with self._read() as cursor:
+            cursor.execute('BEGIN')
+            try:
+                yield cursor
+            finally:
+                cursor.connection.rollback()
+
+    def _slow_query(self, sql, params, rows, ms, plan):
+        trace = current_trace()
+        entry = {
+            'at': now_ms(),
+            'ms': round(ms, 3),
+            'sql': sql,
+            'params': params,
+            'rows': rows,
+            'plan': plan,
+            'request': f'{trace.method} {trace.route}' if trace is not None else None,
+        }
+        self.slow_queries.append(entry)
+        logger.warning(f"Slow query ({ms:.1f} ms, {rows} rows"
+                       + (f", {entry['request']}" if trace is not None else "")
+                       + f"): {sql}" + (f" params={params}" if params else "")
+                       + (f" plan={plan}" if plan else ""))
+
+    def close(self):
+        """Close the writer and every idle reader connection."""
+        super().close()
+        with self._write_lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._writer is not None:
+                self._writer.execute('PRAGMA optimize')
+                self._writer.close()
+        while True:
+            try:
+                self._idle_readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def init_db(self):
+        """Bring the schema up to date, then backfill epoch times if needed."""
+        version = self.schema_version()
+        if self.read_only:
+            if version < len(MIGRATIONS):
+                raise RuntimeError(f"{self.db_path} is at schema version {version}, "
+                                   f"expected {len(MIGRATIONS)}; start the ingestion "
+                                   "daemon first to migrate it")
+            return
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            with self._write() as cursor:
+                migration(cursor)
+                cursor.execute(f'PRAGMA user_version = {number}')
+            logger.info(f"Applied schema migration {number}: {migration.__name__}")
+
+        with self._write_lock:
+            cursor = self._writer.cursor()
+            cursor.execute('SELECT day FROM partitions WHERE table_name IS NOT NULL')
+            self._partition_days = {day for (day,) in cursor.fetchall()}
+            self._last_id = _last_row_id(cursor)
+            self._next_id = self._last_id + 1
+            cursor.execute('SELECT 1 FROM seizure_data LIMIT 1')
+            pending = cursor.fetchone() is not None
+            cursor.close()
+
+        # Rows from before partitioning need their epoch time filled in and
+        # then moving into partitions; neither has to finish before ingest
+        if pending:
+            self._backfill_thread = threading.Thread(
+                target=self._run_backfill, name='legacy-backfill', daemon=True)
+            self._backfill_thread.start()
+
+    def last_row_id(self):
+        """Id of the newest committed reading. Ids only grow, so this works
+        as a version number of the data set, across clear_data(), expiry
+        and restarts too.
+
+        Free on a writable store; a read-only store has to ask the database.
+        """
+        if self._writer is not None:
+            return self._last_id
+        with self._snapshot() as cursor:
+            return _last_row_id(cursor)
+
+    def schema_version(self):
+        if self._writer is None:
+            with self._read() as cursor:
+                return cursor.execute('PRAGMA user_version').fetchone()[0]
+        with self._write_lock:
+            return self._writer.execute('PRAGMA user_version').fetchone()[0]
+
+    def backfill_epoch(self):
+        """Fill ts_ms for rows written before the column existed.
+
+        Legacy timestamps are local-time datetime.now() strings. Each chunk
+        is its own short transaction so ingestion can interleave with it.
+        """
+        last_id = 0
+        while not self._closed:
+            with self._read() as cursor:
+                cursor.execute('''
+                    SELECT id, timestamp, heart_rate, fall_detected, seizure_detected,
+                           device_id
+                    FROM seizure_data
+                    WHERE ts_ms IS NULL AND id > ?
+                    ORDER BY id
+                    LIMIT ?
+                ''', (last_id, self.backfill_chunk_size))
+                rows = cursor.fetchall()
+            if not rows:
+                break
+            updates = []
+            readings = []
+            for row_id, timestamp, heart_rate, fall, seizure, device_id in rows:
+                try:
+                    ts = int(datetime.fromisoformat(str(timestamp)).timestamp() * 1000)
+                except ValueError:
+                    logger.warning(f"Unparseable timestamp {timestamp!r} in row {row_id}")
+                    ts = 0
+                updates.append((ts, row_id))
+                readings.append((ts, heart_rate, fall, seizure, device_id))
+            with self._write() as cursor:
+                cursor.executemany('UPDATE seizure_data SET ts_ms = ? WHERE id = ?', updates)
+                _update_rollups(cursor, readings)
+            last_id = rows[-1][0]
+        logger.info("Epoch backfill complete")
+
+    def move_legacy_rows(self):
+        """Move rows from the original seizure_data table into day partitions.
+
+        Each chunk is inserted and deleted in one transaction, so every row
+        is visible in exactly one place throughout.
+        """
+        while not self._closed:
+            with self._read() as cursor:
+                cursor.execute(f'''
+                    SELECT {ROW_COLUMNS} FROM seizure_data
+                    WHERE ts_ms IS NOT NULL
+                    ORDER BY id
+                    LIMIT ?
+                ''', (self.backfill_chunk_size,))
+                rows = cursor.fetchall()
+            if not rows:
+                break
+            cutoff = self.retention_cutoff()
+            created = []
+            with self._write() as cursor:
+                for day, day_rows in self._split_by_day(rows, key=1).items():
+                    if cutoff is not None and (day + 1) * DAY_MS <= cutoff:
+                        continue  # already past retention, just delete it
+                    table = self._ensure_partition(cursor, day, created)
+                    cursor.executemany(f'''
+                        INSERT INTO {table} ({ROW_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', day_rows)
+                cursor.executemany('DELETE FROM seizure_data WHERE id = ?',
+                                   [(row[0],) for row in rows])
+            self._partition_days.update(created)
+        logger.info("Legacy rows moved into partitions")
+
+    def _run_backfill(self):
+        try:
+            self.backfill_epoch()
+            self.move_legacy_rows()
+        except RuntimeError:
+            pass  # the store was closed before the backfill finished
+
+    def wait_for_backfill(self, timeout=None):
+        if self._backfill_thread is not None:
+            self._backfill_thread.join(timeout)
+
+    def save_batch(self, rows):
+        """Insert rows built by prepare_row() in a single transaction.
+
+        Rows may be for any time, late ones included: each goes into its
+        day's partition through the indexes, nothing is rescanned. A row
+        whose (device_id, ts_ms, seq) is already stored is skipped by the
+        partition's unique index, and leaves rollups and device counts
+        alone. Returns the rows actually inserted, in their original order.
+        """
+        cutoff = self.retention_cutoff()
+        if cutoff is not None:
+            expired = [row for row in rows if row[1] < cutoff]
+            if expired:
+                logger.warning(f"Dropping {len(expired)} readings older than the retention period")
+                rows = [row for row in rows if row[1] >= cutoff]
+        created = []
+        skipped = set()
+        # Newest id actually inserted: a batch of duplicates leaves the
+        # data set version alone
+        last_id = self._last_id
+        with self._write() as cursor:
+            days = {}
+            for position, row in enumerate(rows):
+                days.setdefault(row[1] // DAY_MS, []).append((position, row))
+            for day, day_rows in days.items():
+                table = self._ensure_partition(cursor, day, created)
+                first_id = self._next_id
+                self._next_id += len(day_rows)
+                cursor.executemany(f'''
+                    INSERT OR IGNORE INTO {table}
+                    (id, timestamp, ts_ms, heart_rate, previous_heart_rate, fall_detected,
+                     seizure_detected, device_id, seq)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [(first_id + i, *row[:7], row[7] if len(row) > 7 else None)
+                      for i, (_, row) in enumerate(day_rows)])
+                if cursor.rowcount != len(day_rows):
+                    # Ids are explicit, so the ids missing from the range
+                    # are the duplicates
+                    cursor.execute(f'SELECT id FROM {table} WHERE id BETWEEN ? AND ?',
+                                   (first_id, first_id + len(day_rows) - 1))
+                    stored = {row_id for (row_id,) in cursor.fetchall()}
+                    skipped.update(position for i, (position, _) in enumerate(day_rows)
+                                   if first_id + i not in stored)
+                    last_id = max([last_id, *stored])
+                else:
+                    last_id = max(last_id, first_id + len(day_rows) - 1)
+            if last_id > self._last_id:
+                cursor.execute("UPDATE meta SET value = ? WHERE key = 'last_row_id'", (last_id,))
+            if skipped:
+                logger.debug(f"Skipped {len(skipped)} duplicate readings")
+                rows = [row for i, row in enumerate(rows) if i not in skipped]
+            devices = {}
+            for row in rows:
+                if not row[6]:
+                    continue
+                seen = devices.get(row[6])
+                if seen is None:
+                    devices[row[6]] = [row[1], row[1], 1]
+                else:
+                    seen[0] = min(seen[0], row[1])
+                    seen[1] = max(seen[1], row[1])
+                    seen[2] += 1
+            _update_rollups(cursor, [(row[1], row[2], row[4], row[5], row[6]) for row in rows])
+            cursor.executemany('''
+                INSERT INTO devices VALUES (?, ?, ?, ?)
+                ON CONFLICT (device_id) DO UPDATE SET
+                    first_seen_ms = min(first_seen_ms, excluded.first_seen_ms),
+                    last_seen_ms = max(last_seen_ms, excluded.last_seen_ms),
+                    reading_count = reading_count + excluded.reading_count
+            ''', [(device_id, *seen) for device_id, seen in devices.items()])
+        self._partition_days.update(created)
+        self._last_id = max(self._last_id, last_id)
+        return rows
+
+    def save_waveform_chunks(self, chunks):
+        """Insert waveform chunks, tuples of device_id, channel and then
+        WAVEFORM_COLUMNS, in a single transaction. A chunk whose device,
+        channel and start time are already stored is skipped, so samples
+        delivered twice are stored once. Returns the number inserted."""
+        cutoff = self.retention_cutoff()
+        if cutoff is not None:
+            chunks = [chunk for chunk in chunks if chunk[2] >= cutoff]
+        with self._write() as cursor:
+            cursor.executemany(f'''
+                INSERT OR IGNORE INTO waveform_chunks
+                (device_id, channel, {WAVEFORM_COLUMNS})
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', chunks)
+            return cursor.rowcount
+
+    def iter_waveform_chunks(self, device_id, channel, start_ms, end_ms):
+        """Yield the chunks of one channel of a device that overlap
+        start_ms <= t < end_ms as WAVEFORM_COLUMNS tuples, oldest first."""
+        with self._read() as cursor:
+            # The primary key range scan is bounded on both sides
+            cursor.execute(f'''
+                SELECT {WAVEFORM_COLUMNS} FROM waveform_chunks
+                WHERE device_id = ? AND channel = ?
+                  AND start_ms > ? AND start_ms < ? AND end_ms > ?
+                ORDER BY start_ms
+            ''', (device_id, channel, start_ms - MAX_WAVEFORM_CHUNK_MS, end_ms, start_ms))
+            yield from cursor
+
+    def list_waveform_channels(self, device_id):
+        """Names of the channels a device has sent waveform samples on."""
+        with self._read() as cursor:
+            cursor.execute('SELECT DISTINCT channel FROM waveform_chunks WHERE device_id = ? '
+                           'ORDER BY channel', (device_id,))
+            return [channel for (channel,) in cursor.fetchall()]
+
+    @staticmethod
+    def _split_by_day(rows, key):
+        days = {}
+        for row in rows:
+            days.setdefault(row[key] // DAY_MS, []).append(row)
+        return days
+
+    def _ensure_partition(self, cursor, day, created):
+        """Create the partition table for day inside the current write
+        transaction. created collects new days, to be recorded on commit."""
+        table = partition_table(day)
+        if day in self._partition_days or day in created:
+            return table
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY,
                 timestamp DATETIME,
                 heart_rate REAL,
                 previous_heart_rate REAL,
                 fall_detected INTEGER,
-                seizure_detected INTEGER
+                seizure_detected INTEGER,
+                ts_ms INTEGER NOT NULL,
+                device_id TEXT NOT NULL DEFAULT '',
+                seq INTEGER
             )
         ''')
-        conn.commit()
-        conn.close()
-
-    def save_data(self, data):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_ts ON {table} (ts_ms)')
+        _create_dedupe_index(cursor, table)
+        cursor.execute(f'''
+            CREATE INDEX IF NOT EXISTS idx_{table}_device_ts ON {table} (device_id, ts_ms)
+        ''')
         cursor.execute('''
-            INSERT INTO seizure_data 
-            (timestamp, heart_rate, previous_heart_rate, fall_detected, seizure_detected)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (
-            datetime.now(),
-            data['heart_rate'],
-            data['previous_heart_rate'],
-            int(data['fall_detected']),
-            int(data['seizure_detected'])
-        ))
-        conn.commit()
-        conn.close()
+            INSERT INTO partitions (day, table_name) VALUES (?, ?)
+            ON CONFLICT (day) DO UPDATE SET table_name = excluded.table_name
+        ''', (day, table))
+        created.append(day)
+        return table
+
+    def iter_rows(self, start_ms, after=None, limit=None, device_id=None,
+                  chunk_size=1000, ids=None):
+        """Yield rows in ROW_COLUMNS order and (ts_ms, id) order, optionally
+        for a single device.
+
+        Only the partitions (and archives) that overlap the window are
+        visited, one at a time, and rows are pulled chunk_size at a time, so
+        memory use does not grow with the window. after is a (ts_ms, id)
+        keyset cursor from format_cursor(); only rows after it are returned.
+        ids=(low, high) keeps only rows with low < id <= high, i.e. rows
+        committed between two last_row_id() values.
+        """
+        params = [start_ms]
+        where = 'ts_ms >= ?'
+        if device_id is not None:
+            # Served by the (device_id, ts_ms) index
+            where = 'device_id = ? AND ' + where
+            params.insert(0, device_id)
+        if ids is not None:
+            # Rows newer than a recent id are few: walk the primary key
+            # rather than the window's stretch of the ts_ms indexes
+            where = where.replace('device_id =', '+device_id =').replace('ts_ms >=', '+ts_ms >=')
+            where = 'id > ? AND id <= ? AND ' + where
+            params[:0] = ids
+        if after is not None:
+            after_ts, after_id = after
+            where += ' AND ts_ms >= ? AND (ts_ms > ? OR id > ?)'
+            params += [after_ts, after_ts, after_id]
+        sql = f'''
+            SELECT {ROW_COLUMNS}
+            FROM {{table}}
+            WHERE {where}
+            ORDER BY ts_ms ASC, id ASC
+        '''
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        def scan(conn, table):
+            cursor = conn.cursor()
+            try:
+                cursor.execute(sql.format(table=table), params)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                cursor.close()
+
+        def scan_partitions(conn, partitions):
+            # Partitions cover disjoint days, so visiting them in order yields
+            # rows in order and keeps at most one of them open
+            for table, archive_path in partitions:
+                if archive_path is not None:
+                    archived = read_archive(archive_path, start_ms, device_id, after)
+                    if ids is not None:
+                        archived = (row for row in archived if ids[0] < row[0] <= ids[1])
+                    yield from archived
+                if table is not None:
+                    yield from scan(conn, table)
+
+        first_day = max(start_ms, after[0] if after else start_ms) // DAY_MS
+        with self._snapshot() as cursor:
+            cursor.execute('''
+                SELECT table_name, archive_path FROM partitions
+                WHERE day >= ?
+                ORDER BY day
+            ''', (first_day,))
+            partitions = cursor.fetchall()
+            # Rows still waiting in the original table can belong to any day
+            legacy = scan(cursor.connection, 'seizure_data')
+            partitioned = scan_partitions(cursor.connection, partitions)
+            rows = heapq.merge(legacy, partitioned, key=lambda row: (row[1], row[0]))
+            try:
+                for n, row in enumerate(rows):
+                    if limit is not None and n >= limit:
+                        break
+                    yield row
+            finally:
+                legacy.close()
+                partitioned.close()
+
+    def get_rollup_data(self, hours, resolution, device_id=None):
+        """Aggregated history, one entry per '1m' or '1h' bucket."""
+        start = now_ms() - hours * 3600 * 1000
+        if device_id is None:
+            table, width = ROLLUPS[resolution]
+            where, params = 'bucket_ms >= ?', ()
+        else:
+            table, width = DEVICE_ROLLUPS[resolution]
+            where, params = 'device_id = ? AND bucket_ms >= ?', (device_id,)
+        with self._read() as cursor:
+            cursor.execute(f'''
+                SELECT bucket_ms, count, heart_rate_sum, heart_rate_min,
+                       heart_rate_max, seizure_count, fall_count
+                FROM {table}
+                WHERE {where}
+                ORDER BY bucket_ms ASC
+            ''', params + (start - start % width,))
+            data = cursor.fetchall()
 
-    def get_historical_data(self, hours=24):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT timestamp, heart_rate, fall_detected, seizure_detected
-            FROM seizure_data
-            WHERE timestamp >= datetime('now', ?)
-            ORDER BY timestamp ASC
-        ''', (f'-{hours} hours',))
-        
-        data = cursor.fetchall()
-        conn.close()
-        
         return [{
-            'timestamp': row[0],
-            'heart_rate': row[1],
-            'fall_detected': bool(row[2]),
-            'seizure_detected': bool(row[3])
+            'timestamp': str(datetime.fromtimestamp(row[0] / 1000)),
+            'heart_rate': row[2] / row[1],
+            'heart_rate_min': row[3],
+            'heart_rate_max': row[4],
+            'count': row[1],
+            'seizure_count': row[5],
+            'fall_count': row[6],
+            'fall_detected': row[6] > 0,
+            'seizure_detected': row[5] > 0
         } for row in data]
 
+    def window_counts(self, start_ms, device_id=None):
+        # The minute rollup knows how many raw rows the window holds without
+        # touching seizure_data at all
+        with self._read() as cursor:
+            if device_id is None:
+                cursor.execute('''
+                    SELECT COUNT(*), COALESCE(SUM(count), 0)
+                    FROM seizure_rollup_1m
+                    WHERE bucket_ms >= ?
+                ''', (start_ms,))
+            else:
+                cursor.execute('''
+                    SELECT COUNT(*), COALESCE(SUM(count), 0)
+                    FROM seizure_rollup_1m_device
+                    WHERE device_id = ? AND bucket_ms >= ?
+                ''', (device_id, start_ms))
+            return cursor.fetchone()
+
     def clear_data(self):
-        """Clear all data from the database."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM seizure_data')
-        conn.commit()
-        conn.close()
+        """Clear all data from the database, including archived partitions."""
+        with self._write() as cursor:
+            cursor.execute('SELECT table_name, archive_path FROM partitions')
+            for table, archive_path in cursor.fetchall():
+                if table is not None:
+                    cursor.execute(f'DROP TABLE {table}')
+                if archive_path is not None and os.path.exists(archive_path):
+                    os.remove(archive_path)
+            cursor.execute('DELETE FROM partitions')
+            self._partition_days = set()
+            cursor.execute('DELETE FROM seizure_data')
+            cursor.execute('DELETE FROM devices')
+            cursor.execute('DELETE FROM waveform_chunks')
+            for table, _ in list(ROLLUPS.values()) + list(DEVICE_ROLLUPS.values()):
+                cursor.execute(f'DELETE FROM {table}')
 
-    def get_latest_data(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT timestamp, heart_rate, previous_heart_rate, fall_detected, seizure_detected
-            FROM seizure_data
-            ORDER BY timestamp DESC
-            LIMIT 1
-        ''')
-        row = cursor.fetchone()
-        conn.close()
+    def list_devices(self):
+        """Every device that has sent a reading, with first/last seen times."""
+        with self._read() as cursor:
+            cursor.execute('''
+                SELECT device_id, first_seen_ms, last_seen_ms, reading_count
+                FROM devices
+                ORDER BY device_id
+            ''')
+            return [{
+                'device_id': row[0],
+                'first_seen': str(datetime.fromtimestamp(row[1] / 1000)),
+                'last_seen': str(datetime.fromtimestamp(row[2] / 1000)),
+                'reading_count': row[3]
+            } for row in cursor.fetchall()]
+
+    def get_latest_data(self, device_id=None):
+        where, params = '', ()
+        if device_id is not None:
+            where, params = 'WHERE device_id = ?', (device_id,)
+        with self._snapshot() as cursor:
+            cursor.execute('''
+                SELECT table_name FROM partitions
+                WHERE table_name IS NOT NULL
+                ORDER BY day DESC
+            ''')
+            # Newest partition first; usually the first lookup finds it
+            tables = [table for (table,) in cursor.fetchall()] + ['seizure_data']
+            row = None
+            for table in tables:
+                cursor.execute(f'''
+                    SELECT timestamp, heart_rate, previous_heart_rate, fall_detected,
+                           seizure_detected, device_id
+                    FROM {table}
+                    {where}
+                    ORDER BY ts_ms DESC
+                    LIMIT 1
+                ''', params)
+                row = cursor.fetchone()
+                if row:
+                    break
         if row:
             return {
                 'timestamp': row[0],
+                'device_id': row[5],
                 'heart_rate': row[1],
                 'previous_heart_rate': row[2],
                 'fall_detected': bool(row[3]),
                 'seizure_detected': bool(row[4])
             }
         else:
-            return {} 
\ No newline at end of file
+            return {}
+
+    def enforce_retention(self, now=None):
+        """Expire raw readings older than retention_days.
+
+        Whole expired days are archived (if archive_dir is set) and their
+        partition table dropped; nothing is deleted row by row except
+        leftovers in the original seizure_data table. Rollups are kept for
+        rollup_retention_days, or forever. Returns the expired day numbers.
+        """
+        now = now_ms() if now is None else now
+        expired = []
+        cutoff = self.retention_cutoff(now)
+        if cutoff is not None:
+            with self._read() as cursor:
+                cursor.execute('''
+                    SELECT day, table_name FROM partitions
+                    WHERE table_name IS NOT NULL AND day < ?
+                    ORDER BY day
+                ''', (cutoff // DAY_MS,))
+                partitions = cursor.fetchall()
+            for day, table in partitions:
+                archive_path = None
+                if self.archive_dir is not None:
+                    os.makedirs(self.archive_dir, exist_ok=True)
+                    archive_path = os.path.join(self.archive_dir, f'{table}.ssar.gz')
+                    with self._read() as cursor:
+                        cursor.execute(f'SELECT {ROW_COLUMNS} FROM {table} ORDER BY ts_ms, id')
+                        write_archive(archive_path, cursor)
+                with self._write() as cursor:
+                    cursor.execute(f'DROP TABLE {table}')
+                    if archive_path is not None:
+                        cursor.execute('''
+                            UPDATE partitions SET table_name = NULL, archive_path = ?
+                            WHERE day = ?
+                        ''', (archive_path, day))
+                    else:
+                        cursor.execute('DELETE FROM partitions WHERE day = ?', (day,))
+                    self._partition_days.discard(day)
+                expired.append(day)
+                logger.info(f"Expired partition {table}" +
+                            (f", archived to {archive_path}" if archive_path else ""))
+
+            # Waveforms are not archived; they expire with the raw readings
+            with self._write() as cursor:
+                cursor.execute('DELETE FROM waveform_chunks WHERE start_ms < ?', (cutoff,))
+                if cursor.rowcount:
+                    logger.info(f"Expired {cursor.rowcount} waveform chunks")
+
+            while True:
+                with self._write() as cursor:
+                    cursor.execute('''
+                        DELETE FROM seizure_data WHERE id IN (
+                            SELECT id FROM seizure_data WHERE ts_ms < ? LIMIT ?
+                        )
+                    ''', (cutoff, self.backfill_chunk_size))
+                    if cursor.rowcount < self.backfill_chunk_size:
+                        break
+
+        if self.rollup_retention_days is not None:
+            rollup_cutoff = now - self.rollup_retention_days * DAY_MS
+            with self._write() as cursor:
+                for table, _ in list(ROLLUPS.values()) + list(DEVICE_ROLLUPS.values()):
+                    cursor.execute(f'DELETE FROM {table} WHERE bucket_ms < ?',
+                                   (rollup_cutoff,))
+        return expired
+
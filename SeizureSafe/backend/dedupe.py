@@ -0,0 +1,37 @@
+import threading
+from collections import OrderedDict
+
+
+class RecentKeys:
+    """Bounded LRU set of recently seen reading identities.
+
+    The ingest path checks every identifiable reading against it, so QoS 1
+    redeliveries and bracelets resending their buffer after a reconnect are
+    dropped before they are queued, alerted on or written. A copy that
+    arrives after its original has left the window is still caught by the
+    partitions' unique index (see DataStore.save_batch()).
+    """
+
+    def __init__(self, capacity=65536):
+        self.capacity = capacity
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        """Whether key was seen within the window, without recording it."""
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return True
+            return False
+
+    def add(self, key):
+        """Record key, once its reading has been accepted."""
+        with self._lock:
+            self._keys[key] = None
+            self._keys.move_to_end(key)
+            if len(self._keys) > self.capacity:
+                self._keys.popitem(last=False)
+
+    def __len__(self):
+        return len(self._keys)
@@ -0,0 +1,177 @@
+"""Streaming seizure detection over the heart rate of every device.
+
+Each device keeps a fixed-size sliding window of recent baseline heart
+rates with a running sum and sum of squares, so every sample is evaluated
+in constant time however long the device has been streaming. Samples that
+are themselves elevated are kept out of the baseline, so a long episode
+does not raise the level it is measured against.
+
+Derived events:
+  heart_rate_jump              |heart_rate - previous_heart_rate| >= jump_bpm
+  sustained_elevation          sustained_samples elevated samples in a row
+  fall_with_heart_rate_change  a fall within correlation_ms of a jump or
+                               elevation
+  seizure_suspected            sustained elevation within correlation_ms of
+                               a jump or fall
+"""
+import math
+from collections import OrderedDict
+from datetime import datetime
+
+
+class DeviceState:
+    """Sliding-window baseline and episode state of one device."""
+
+    __slots__ = ('window', 'next', 'size', 'total', 'total_sq', 'elevated_run',
+                 'last_jump_ms', 'last_fall_ms', 'last_elevated_ms', 'last_ms')
+
+    def __init__(self, window_size):
+        self.window = [0.0] * window_size
+        self.next = 0  # slot the next baseline sample goes into
+        self.size = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.elevated_run = 0
+        self.last_jump_ms = None
+        self.last_fall_ms = None
+        self.last_elevated_ms = None
+        self.last_ms = None  # newest reading
+
+    def add(self, heart_rate):
+        if self.size == len(self.window):
+            old = self.window[self.next]
+            self.total -= old
+            self.total_sq -= old * old
+        else:
+            self.size += 1
+        self.window[self.next] = heart_rate
+        self.total += heart_rate
+        self.total_sq += heart_rate * heart_rate
+        self.next = (self.next + 1) % len(self.window)
+
+    def mean(self):
+        return self.total / self.size if self.size else None
+
+    def std(self):
+        if not self.size:
+            return None
+        mean = self.total / self.size
+        # Running sums can drift a hair below zero variance
+        return math.sqrt(max(self.total_sq / self.size - mean * mean, 0.0))
+
+
+class SeizureDetector:
+    """Evaluates readings one at a time and returns the events they trigger.
+
+    A sample is elevated when it is at least elevated_bpm, or, once the
+    device has min_samples of baseline, more than z_threshold standard
+    deviations (at least min_std) above the baseline mean.
+
+    A device that has sent nothing for idle_ms (by reading time) is
+    forgotten, as is the least recently seen one beyond max_devices, so
+    churning device ids do not grow the state without bound; a device
+    that comes back starts a new baseline.
+    """
+
+    def __init__(self, window_size=60, min_samples=10, z_threshold=3.0, min_std=3.0,
+                 elevated_bpm=130.0, jump_bpm=20.0, sustained_samples=3,
+                 correlation_ms=30000, max_devices=10000, idle_ms=3600 * 1000):
+        self.window_size = window_size
+        self.min_samples = min_samples
+        self.z_threshold = z_threshold
+        self.min_std = min_std
+        self.elevated_bpm = elevated_bpm
+        self.jump_bpm = jump_bpm
+        self.sustained_samples = sustained_samples
+        self.correlation_ms = correlation_ms
+        self.max_devices = max_devices
+        self.idle_ms = idle_ms
+        # Least recently seen first
+        self._devices = OrderedDict()
+        self.processed = 0
+
+    def device_count(self):
+        return len(self._devices)
+
+    def baseline(self, device_id):
+        """(mean, std) of a device's baseline window, or None if unknown."""
+        state = self._devices.get(device_id)
+        if state is None or not state.size:
+            return None
+        return state.mean(), state.std()
+
+    def _recent(self, ts, then):
+        return then is not None and ts - then <= self.correlation_ms
+
+    def process(self, device_id, ts, heart_rate, previous_heart_rate=None, fall=False):
+        """Evaluate one reading; returns a (possibly empty) list of events."""
+        self.processed += 1
+        state = self._devices.get(device_id)
+        if state is None:
+            state = self._devices[device_id] = DeviceState(self.window_size)
+        else:
+            self._devices.move_to_end(device_id)
+        state.last_ms = ts if state.last_ms is None else max(state.last_ms, ts)
+        self._evict_devices(ts)
+        events = []
+
+        mean = std = None
+        elevated = heart_rate >= self.elevated_bpm
+        if state.size >= self.min_samples:
+            mean = state.total / state.size
+            std = max(state.std(), self.min_std)
+            elevated = elevated or heart_rate > mean + self.z_threshold * std
+
+        def event(event_type):
+            events.append({
+                'type': event_type,
+                'device_id': device_id,
+                'timestamp': str(datetime.fromtimestamp(ts / 1000)),
+                'ts_ms': ts,
+                'heart_rate': heart_rate,
+                'previous_heart_rate': previous_heart_rate,
+                'baseline_mean': mean,
+                'baseline_std': std,
+            })
+
+        if previous_heart_rate is not None and \
+                abs(heart_rate - previous_heart_rate) >= self.jump_bpm:
+            state.last_jump_ms = ts
+            event('heart_rate_jump')
+
+        if elevated:
+            state.elevated_run += 1
+            state.last_elevated_ms = ts
+            if state.elevated_run == self.sustained_samples:
+                event('sustained_elevation')
+                if self._recent(ts, state.last_jump_ms) or self._recent(ts, state.last_fall_ms):
+                    event('seizure_suspected')
+        else:
+            state.elevated_run = 0
+            state.add(heart_rate)
+
+        if fall:
+            if self._recent(ts, state.last_jump_ms) or self._recent(ts, state.last_elevated_ms):
+                event('fall_with_heart_rate_change')
+            state.last_fall_ms = ts
+        return events
+
+    def process_rows(self, rows):
+        """Evaluate rows in the DataStore.prepare_row() layout, in order."""
+        events = []
+        for row in rows:
+            _, ts, heart_rate, previous, fall, _, device_id = row[:7]
+            events.extend(self.process(device_id, ts, heart_rate, previous, fall))
+        return events
+
+    def _evict_devices(self, now_ms):
+        """Drop idle devices and the least recently seen beyond max_devices."""
+        idle_before = now_ms - self.idle_ms
+        while len(self._devices) > 1:
+            device_id, state = next(iter(self._devices.items()))
+            if len(self._devices) <= self.max_devices and state.last_ms >= idle_before:
+                break
+            del self._devices[device_id]
+
+    def forget(self, device_id):
+        self._devices.pop(device_id, None)
@@ -0,0 +1,124 @@
+import itertools
+import json
+import threading
+from collections import deque
+
+
+class Subscription:
+    """One subscriber's bounded event buffer.
+
+    If the subscriber falls more than max_events behind it is marked as
+    dropped instead of letting its buffer grow; the stream then ends and the
+    client is expected to reconnect.
+    """
+
+    def __init__(self, devices, max_events):
+        self.devices = frozenset(devices)
+        self.max_events = max_events
+        self.dropped = False
+        self._events = deque()
+        self._ready = threading.Condition()
+
+    def put(self, event):
+        with self._ready:
+            if self.dropped:
+                return
+            if len(self._events) >= self.max_events:
+                self.dropped = True
+                self._events.clear()
+            else:
+                self._events.append(event)
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """Next event, or None if nothing arrived within timeout."""
+        with self._ready:
+            if not self._events and not self.dropped:
+                self._ready.wait(timeout)
+            return self._events.popleft() if self._events else None
+
+
+class EventBroker:
+    """Fans ingested readings and alerts out to live subscribers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._all = set()         # subscribers without a device filter
+        self._by_device = {}      # device id -> filtered subscribers
+        self._ids = itertools.count(1)
+
+    def subscribe(self, devices=(), max_events=100):
+        subscription = Subscription(devices, max_events)
+        with self._lock:
+            if subscription.devices:
+                for device in subscription.devices:
+                    self._by_device.setdefault(device, set()).add(subscription)
+            else:
+                self._all.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._all.discard(subscription)
+            for device in subscription.devices:
+                subscribers = self._by_device.get(device)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._by_device[device]
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._all) + len(set().union(*self._by_device.values()))
+
+    def publish(self, event_type, data, device=None):
+        event = (next(self._ids), event_type, data)
+        with self._lock:
+            subscribers = list(self._all)
+            if device is not None:
+                subscribers.extend(self._by_device.get(device, ()))
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def publish_rows(self, rows, alerts=True):
+        """Publish committed rows in the DataStore.prepare_row() layout.
+
+        With alerts=False seizure/fall rows only produce a 'reading' event,
+        for when their alerts went out through publish_alert() already.
+        """
+        for row in rows:
+            timestamp, _, heart_rate, previous, fall, seizure, device_id = row[:7]
+            reading = {
+                'timestamp': str(timestamp),
+                'device_id': device_id,
+                'heart_rate': heart_rate,
+                'previous_heart_rate': previous,
+                'fall_detected': bool(fall),
+                'seizure_detected': bool(seizure)
+            }
+            self.publish('reading', reading, device_id)
+            if not alerts:
+                continue
+            if seizure:
+                self.publish('seizure', reading, device_id)
+            if fall:
+                self.publish('fall', reading, device_id)
+
+    def publish_alert(self, alert):
+        """Publish an alert from the ingest priority lane as 'seizure'
+        and/or 'fall' events, ahead of its reading being committed."""
+        if alert['seizure_detected']:
+            self.publish('seizure', alert, alert['device_id'])
+        if alert['fall_detected']:
+            self.publish('fall', alert, alert['device_id'])
+
+    def publish_detections(self, detections):
+        """Publish SeizureDetector events, each under its own event type."""
+        for detection in detections:
+            self.publish(detection['type'], detection, detection['device_id'])
+
+
+def format_sse(event):
+    """Encode an (id, type, data) event in the text/event-stream format."""
+    event_id, event_type, data = event
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
@@ -0,0 +1,154 @@
+import json
+from datetime import datetime, timezone
+from flask import Response, stream_with_context
+from werkzeug.http import is_resource_modified
+from data_store import now_ms, parse_cursor
+from tracing import serialized
+
+# Readings serialized per chunk handed to the WSGI server
+CHUNK_ROWS = 500
+
+# Largest page a client can ask for with ?limit=
+MAX_PAGE_SIZE = 10000
+
+# The window of a response moves with now; its validators and cache key
+# move with it in steps of this many ms
+WINDOW_STEP_MS = 60 * 1000
+
+FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+def json_array_chunks(readings):
+    """Serialize readings as one JSON array, a few hundred rows at a time."""
+    yield '['
+    parts = []
+    first = True
+    for reading in readings:
+        parts.append(json.dumps(reading))
+        if len(parts) >= CHUNK_ROWS:
+            yield ('' if first else ',') + ','.join(parts)
+            parts = []
+            first = False
+    if parts:
+        yield ('' if first else ',') + ','.join(parts)
+    yield ']'
+
+def ndjson_chunks(readings):
+    """Serialize readings as newline-delimited JSON."""
+    parts = []
+    for reading in readings:
+        parts.append(json.dumps(reading))
+        if len(parts) >= CHUNK_ROWS:
+            yield '\n'.join(parts) + '\n'
+            parts = []
+    if parts:
+        yield '\n'.join(parts) + '\n'
+
+def _http_date(ms):
+    return datetime.fromtimestamp(ms // 1000, timezone.utc)
+
+def _etag(version, resolution, window):
+    return f'{version}-{resolution}-{window}'
+
+def _finish(response, resolution, version, modified_ms, window):
+    response.headers['X-Resolution'] = resolution
+    response.headers['X-Cursor'] = str(version)
+    response.set_etag(_etag(version, resolution, window))
+    if modified_ms is not None:
+        response.last_modified = _http_date(modified_ms)
+    return response
+
+def history_response(store, hours, args, cache=None, max_points=1000, device_id=None,
+                     responses=None, request=None):
+    """Build the /api/history/<hours> response from the request query args.
+
+    Raw history is streamed straight off the database cursor, so memory use
+    does not grow with the window. Passing after= and/or limit= switches to
+    keyset pagination; the cursor for the next page is returned in the
+    X-Next-Cursor header. device_id restricts the response to one device.
+
+    Every response carries the data set version (the newest committed row
+    id) as X-Cursor and in its ETag. since=<X-Cursor of an earlier
+    response> returns only the raw readings committed after it, and
+    If-None-Match / If-Modified-Since get a 304 while nothing was
+    committed and the window has not moved on to the next WINDOW_STEP_MS,
+    which the ETag includes as well. responses, a ResponseCache kept current by the ingest path,
+    supplies the version and holds rendered responses that are small
+    enough to keep: rollups and raw windows served by the hot cache.
+    Without it the version is read from the store.
+    Raises ValueError for invalid parameters.
+    """
+    resolution = store.resolve_resolution(
+        hours,
+        args.get('resolution', 'raw'),
+        args.get('points', max_points, type=int),
+        device_id
+    )
+    fmt = args.get('format', 'json')
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format: {fmt}")
+    start = now_ms() - hours * 3600 * 1000
+    window = start // WINDOW_STEP_MS
+    after = args.get('after')
+    limit = args.get('limit', type=int)
+    since = args.get('since', type=int)
+    if 'since' in args and since is None:
+        raise ValueError(f"Invalid since cursor: {args['since']}")
+    if since is not None and (resolution != 'raw' or after is not None or limit is not None):
+        raise ValueError("since= only applies to raw history without after= or limit=")
+
+    if responses is not None:
+        version, modified_ms = responses.version, responses.modified_ms
+    else:
+        version, modified_ms = store.last_row_id(), None
+    key = (device_id, hours, resolution, fmt, window)
+    cacheable = responses is not None and since is None and after is None and limit is None
+    entry = responses.get(key) if cacheable else None
+    if entry is not None:
+        version, modified_ms = entry.version, entry.modified_ms
+    if modified_ms is not None:
+        # The body also changes whenever the window moves on a step
+        modified_ms = max(modified_ms, window * WINDOW_STEP_MS + hours * 3600 * 1000)
+    if request is not None and not is_resource_modified(
+            request.environ, _etag(version, resolution, window),
+            last_modified=_http_date(modified_ms) if modified_ms is not None else None):
+        return _finish(Response(status=304), resolution, version, modified_ms, window)
+    if entry is not None:
+        return _finish(Response(entry.body, mimetype=entry.mimetype),
+                       resolution, version, modified_ms, window)
+
+    next_cursor = None
+    if resolution != 'raw':
+        # Rollups are bounded by the number of buckets in the window
+        readings = store.get_history(hours, resolution, device_id)
+    elif since is not None:
+        # Rows committed after since and up to the version handed out now,
+        # so that following the X-Cursor chain never skips a row
+        readings = [] if since >= version else \
+            store.iter_historical_data(start, device_id=device_id, ids=(since, version))
+        cacheable = False
+    elif after is not None or limit is not None:
+        limit = MAX_PAGE_SIZE if limit is None else limit
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        readings, next_cursor = store.get_history_page(
+            start, parse_cursor(after) if after else None, limit, device_id)
+    else:
+        readings = cache.history(start, device_id) if cache is not None else None
+        if readings is None:
+            readings = store.iter_historical_data(start, device_id=device_id)
+            cacheable = False  # too large to keep; stream it
+
+    chunks = ndjson_chunks(readings) if fmt == 'ndjson' else json_array_chunks(readings)
+    chunks = serialized(chunks)
+    if cacheable:
+        body = ''.join(chunks).encode()
+        responses.put(key, body, FORMATS[fmt], version, modified_ms)
+        response = Response(body, mimetype=FORMATS[fmt])
+    else:
+        response = Response(stream_with_context(chunks), mimetype=FORMATS[fmt])
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return _finish(response, resolution, version, modified_ms, window)
@@ -0,0 +1,381 @@
+import logging
+import math
+import queue
+import struct
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from metrics import Counter, Gauge, Histogram
+from spool import SpoolFull
+
+logger = logging.getLogger(__name__)
+
+# Wakes the writer thread up when the pipeline is stopped
+_STOP = object()
+# Wakes the writer thread up for a priority reading
+_WAKE = object()
+
+# Attempts at committing priority readings left over at stop(); while
+# running the writer retries them until they are written
+PRIORITY_WRITE_ATTEMPTS = 3
+
+# Longest wait between attempts at writing spooled or priority readings
+RETRY_MAX_DELAY = 5.0
+
+# A spooled row: ts_ms, heart rate, previous heart rate (NaN if unknown),
+# seq, receipt time (epoch seconds), flags and the device id length in
+# bytes, then the device id. MAX_DEVICE_ID_LENGTH counts characters, so a
+# UTF-8 id can take more than 255 bytes.
+SPOOLED_ROW = struct.Struct('<qddqdBH')
+_FALL, _SEIZURE, _PRIORITY, _HAS_SEQ = 1, 2, 4, 8
+
+
+def _spool_record(row, received, priority):
+    seq = row[7] if len(row) > 7 else None
+    flags = (_FALL if row[4] else 0) | (_SEIZURE if row[5] else 0) | \
+        (_PRIORITY if priority else 0) | (_HAS_SEQ if seq is not None else 0)
+    device = row[6].encode()
+    # Monotonic time means nothing to another process, so store wall time
+    received = time.time() - (time.monotonic() - received)
+    previous = math.nan if row[3] is None else row[3]
+    return SPOOLED_ROW.pack(row[1], row[2], previous, seq or 0, received, flags,
+                            len(device)) + device
+
+
+def _spooled_item(record):
+    ts, heart_rate, previous, seq, received, flags, length = \
+        SPOOLED_ROW.unpack_from(record)
+    device = record[SPOOLED_ROW.size:SPOOLED_ROW.size + length].decode()
+    row = (datetime.fromtimestamp(ts / 1000), ts, heart_rate,
+           None if previous != previous else previous,  # NaN -> None
+           int(bool(flags & _FALL)), int(bool(flags & _SEIZURE)), device,
+           seq if flags & _HAS_SEQ else None)
+    received = time.monotonic() - max(0.0, time.time() - received)
+    return row, received, bool(flags & _PRIORITY)
+
+
+class IngestPipeline:
+    """Bounded queue between the MQTT callback and a single writer thread.
+
+    Readings are validated on submit() and written in group commits: the
+    writer flushes once it has batch_size rows or once max_delay seconds have
+    passed since the first row of the batch arrived, whichever comes first.
+
+    backpressure decides what happens when the queue is full:
+      'block'       wait up to put_timeout seconds for space, then drop
+      'drop'        drop the new reading straight away
+      'drop_oldest' discard the oldest queued reading to make room
+
+    Priority readings (seizure and fall alerts) bypass the bounded queue and
+    are never dropped: the writer commits them right away, together with
+    everything queued ahead of them, in batches of batch_size, and if a
+    commit fails keeps them at the front of the line and retries with
+    backoff until it succeeds.
+
+    With a spool (spool.Spool, set before start()) the queue is on disk
+    instead: submit() returns once the row is appended to it, and the
+    writer reads batches back, moving the spool's checkpoint past them
+    after each commit. A failed write loses nothing; the writer backs off
+    and retries, and whatever is left at a crash or stop is written after
+    the next start. The spool's max_bytes replaces max_queue, and as the
+    oldest spooled readings may not be written yet, 'drop_oldest' drops
+    new readings like 'drop' once it is full.
+    """
+
+    BACKPRESSURE_POLICIES = ('block', 'drop', 'drop_oldest')
+
+    def __init__(self, store, batch_size=500, max_delay=0.05, max_queue=10000,
+                 backpressure='block', put_timeout=1.0, spool=None):
+        if backpressure not in self.BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {backpressure}")
+        self.store = store
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.backpressure = backpressure
+        self.put_timeout = put_timeout
+        self.spool = spool
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._priority = deque()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._listeners = []
+
+        # Simple counters, only ever incremented
+        self.submitted = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.retries = 0
+        # Receipt to commit, per reading, and save_batch() time, per batch
+        self.commit_latency = Histogram(
+            'seizuresafe_broker_to_commit_seconds',
+            'Time from receiving a reading from the broker to its commit')
+        self.commit_seconds = Histogram(
+            'seizuresafe_sqlite_commit_seconds',
+            'Time to write and commit one batch')
+        self.priority_commit_latency = Histogram(
+            'seizuresafe_alert_commit_seconds',
+            'Time from receiving an alert reading to its commit')
+
+    def start(self):
+        if self._thread is None:
+            run = self._run if self.spool is None else self._run_spooled
+            self._thread = threading.Thread(target=run, name='ingest-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def add_listener(self, listener):
+        """Call listener(rows) on the writer thread after each batch commits,
+        with the rows that were inserted (duplicates left out)."""
+        self._listeners.append(listener)
+
+    def qsize(self):
+        if self.spool is not None:
+            return self.spool.pending()
+        return self._queue.qsize() + len(self._priority)
+
+    def metrics(self):
+        """The pipeline's metrics, for a metrics.Registry."""
+        return [
+            Gauge('seizuresafe_ingest_queue_depth', 'Readings waiting for the writer',
+                  function=self.qsize),
+            Counter('seizuresafe_readings_submitted_total', 'Readings queued for writing',
+                    function=lambda: self.submitted),
+            Counter('seizuresafe_readings_dropped_total', 'Readings dropped by backpressure',
+                    function=lambda: self.dropped),
+            Counter('seizuresafe_readings_written_total', 'Readings committed',
+                    function=lambda: self.written),
+            Counter('seizuresafe_readings_write_failed_total', 'Readings lost to failed writes',
+                    function=lambda: self.failed),
+            Counter('seizuresafe_readings_duplicate_total',
+                    'Readings already stored, skipped by the unique index',
+                    function=lambda: self.duplicates),
+            Counter('seizuresafe_spool_write_retries_total',
+                    'Failed writes of spooled readings, retried later',
+                    function=lambda: self.retries),
+            Gauge('seizuresafe_spool_bytes', 'Disk space taken by the ingest spool',
+                  function=lambda: self.spool.disk_bytes() if self.spool else 0),
+            self.commit_latency,
+            self.commit_seconds,
+            self.priority_commit_latency,
+        ]
+
+    def submit(self, data, received=None):
+        """Queue a reading for writing. Returns False if it was dropped.
+
+        received is the time.monotonic() the reading arrived at, for the
+        commit latency histogram; it defaults to now.
+        Raises if the reading is invalid, so the caller can log it.
+        """
+        return self.submit_row(self.store.prepare_row(data), received)
+
+    def submit_row(self, row, received=None, priority=False):
+        """Queue a row built by prepare_row(). A priority row is always
+        accepted and written ahead of the max_delay wait."""
+        if self._stopping.is_set():
+            raise RuntimeError('Ingest pipeline is stopped')
+        row = (row, time.monotonic() if received is None else received, priority)
+        self.submitted += 1
+        if self.spool is not None:
+            return self._spool_row(*row)
+        if priority:
+            self._priority.append(row)
+            try:
+                self._queue.put_nowait(_WAKE)
+            except queue.Full:
+                pass  # the writer has a full batch to flush and checks after it
+            return True
+        try:
+            if self.backpressure == 'block':
+                self._queue.put(row, timeout=self.put_timeout)
+            elif self.backpressure == 'drop':
+                self._queue.put_nowait(row)
+            else:
+                while True:
+                    try:
+                        self._queue.put_nowait(row)
+                        break
+                    except queue.Full:
+                        try:
+                            if self._queue.get_nowait() not in (_STOP, _WAKE):
+                                self.dropped += 1
+                        except queue.Empty:
+                            pass
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("Ingest queue full, dropping reading")
+            return False
+        return True
+
+    def _spool_row(self, row, received, priority):
+        record = _spool_record(row, received, priority)
+        deadline = time.monotonic() + self.put_timeout
+        while True:
+            try:
+                # Alerts are never turned away, the bound is for the rest
+                self.spool.append(record, urgent=priority, force=priority)
+                return True
+            except SpoolFull:
+                if self.backpressure != 'block' or time.monotonic() >= deadline:
+                    break
+                time.sleep(0.01)
+        self.dropped += 1
+        logger.warning("Ingest spool full, dropping reading")
+        return False
+
+    def stop(self, timeout=None):
+        """Stop accepting readings and wait for the queue to be drained."""
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        if self._thread is None:
+            # Never started: write whatever was queued from this thread
+            self._drain()
+            return
+        if self.spool is not None:
+            self.spool.interrupt()
+        try:
+            self._queue.put_nowait(_STOP)
+        except queue.Full:
+            pass  # the writer checks _stopping between batches anyway
+        self._thread.join(timeout)
+
+    def _run(self):
+        failures = 0
+        while not self._stopping.is_set():
+            if self._priority:
+                if self._flush_priority():
+                    failures = 0
+                else:
+                    failures += 1
+                    self._stopping.wait(min(RETRY_MAX_DELAY, 0.1 * 2 ** failures))
+                continue
+            try:
+                row = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if row is _STOP:
+                break
+            batch = [] if row is _WAKE else [row]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.batch_size and not self._priority:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    row = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if row is _STOP:
+                    break
+                if row is not _WAKE:
+                    batch.append(row)
+            if batch:
+                self._flush(batch)
+        self._drain()
+
+    def _run_spooled(self):
+        failures = 0
+        while not self._stopping.is_set():
+            if not self.spool.wait(1, timeout=0.5):
+                continue
+            # Group commit, unless an alert is waiting
+            self.spool.wait(self.batch_size, timeout=self.max_delay)
+            self.spool.flush()
+            if self._flush_spooled():
+                failures = 0
+                continue
+            failures += 1
+            self._stopping.wait(min(RETRY_MAX_DELAY, 0.1 * 2 ** failures))
+        self._drain()
+
+    def _flush_spooled(self):
+        """Write the next batch from the spool. Returns True on success."""
+        records, position = self.spool.read(self.batch_size)
+        if not records:
+            return True
+        if self._flush([_spooled_item(record) for record in records], count_failure=False):
+            self.spool.commit(position, len(records))
+            return True
+        self.retries += 1
+        self.spool.rewind()
+        return False
+
+    def _take_queued(self):
+        items = []
+        while True:
+            try:
+                row = self._queue.get_nowait()
+            except queue.Empty:
+                return items
+            if row is not _STOP and row is not _WAKE:
+                items.append(row)
+
+    def _flush_priority(self):
+        """Commit the priority rows with everything queued ahead of them, a
+        batch at a time. Returns True on success; on failure the unwritten
+        items are put back at the front of the priority line."""
+        items = self._take_queued()
+        while self._priority:
+            items.append(self._priority.popleft())
+        # Readings queued after an alert but taken with it are newer
+        items.sort(key=lambda item: item[0][1])
+        for i in range(0, len(items), self.batch_size):
+            if not self._flush(items[i:i + self.batch_size], count_failure=False):
+                self.retries += 1
+                self._priority.extendleft(reversed(items[i:]))
+                return False
+        return True
+
+    def _drain(self):
+        if self.spool is not None:
+            while self.spool.wait(1, timeout=0):
+                if not self._flush_spooled():
+                    logger.warning(f"Leaving {self.spool.pending()} readings in the spool "
+                                   f"for the next start")
+                    return
+            return
+        for attempt in range(1, PRIORITY_WRITE_ATTEMPTS + 1):
+            if not self._priority or self._flush_priority():
+                break
+            time.sleep(0.1 * attempt)
+        if self._priority:
+            lost = list(self._priority)
+            self._priority.clear()
+            self.failed += len(lost)
+            logger.critical(f"Gave up writing {sum(item[2] for item in lost)} alert readings "
+                            f"and {sum(not item[2] for item in lost)} others at stop")
+        items = self._take_queued()
+        for i in range(0, len(items), self.batch_size):
+            self._flush(items[i:i + self.batch_size])
+
+    def _flush(self, items, count_failure=True):
+        """Write (row, received, priority) items. Returns True on success."""
+        batch = [row for row, _, _ in items]
+        started = time.monotonic()
+        try:
+            inserted = self.store.save_batch(batch)
+        except Exception as e:
+            if count_failure:
+                self.failed += len(batch)
+            logger.error(f"Failed to write batch of {len(batch)} readings: {e}")
+            return False
+        committed = time.monotonic()
+        self.written += len(inserted)
+        self.duplicates += len(batch) - len(inserted)
+        self.commit_seconds.observe(committed - started)
+        for _, received, priority in items:
+            self.commit_latency.observe(committed - received)
+            if priority:
+                self.priority_commit_latency.observe(committed - received)
+        if not inserted:
+            return True
+        for listener in self._listeners:
+            try:
+                listener(inserted)
+            except Exception as e:
+                logger.error(f"Ingest listener {listener!r} failed: {e}")
+        return True
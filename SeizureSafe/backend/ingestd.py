@@ -0,0 +1,366 @@
+"""Ingestion daemon: the one process that subscribes to MQTT and writes.
+
+Owns the MQTT client, the IngestPipeline writer, the seizure detector,
+traffic capture and retention. Committed readings and detections are
+pushed to API workers over a Unix socket (INGEST_SOCKET, see ipc.py), so
+the Flask API can run read-only in as many worker processes as needed:
+
+    python ingestd.py
+    gunicorn -w 4 api:app
+
+For a single-process setup, `python app.py` runs the same IngestService
+inside the API process instead.
+
+Readings are spooled to disk (INGEST_SPOOL_DIR, see spool.py) before the
+broker's QoS 1 delivery is acknowledged, and the MQTT session is
+persistent (a fixed MQTT_CLIENT_ID and clean_session=False), so neither a
+stalled database nor a restart of the daemon loses readings.
+"""
+import logging
+import os
+import signal
+import ssl
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from dotenv import load_dotenv
+
+from capture import CaptureWriter
+from data_store import device_time, reading_device, reading_key
+from dedupe import RecentKeys
+from detector import SeizureDetector
+from ingest import IngestPipeline
+from ipc import INGEST_SOCKET
+from metrics import LATENCY_BUCKETS, Counter, Histogram, Registry, serve as serve_metrics
+from payload import decode_payload
+from spool import Spool
+from storage import create_store
+from waveforms import WaveformWriter
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# MQTT settings from environment variables
+BROKER = os.getenv('MQTT_BROKER')
+PORT = int(os.getenv('MQTT_PORT', 8084))
+TOPIC = os.getenv('MQTT_TOPIC')
+USERNAME = os.getenv('MQTT_USERNAME')
+PASSWORD = os.getenv('MQTT_PASSWORD')
+# The broker keeps the subscription and queues QoS 1 messages for this
+# client id while it is disconnected
+CLIENT_ID = os.getenv('MQTT_CLIENT_ID', 'seizuresafe-ingest')
+
+RETENTION_INTERVAL_SECONDS = float(os.getenv('RETENTION_INTERVAL_SECONDS', 3600))
+
+# Prometheus /metrics port of the daemon (0 disables it)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9108))
+# Distinct devices given their own message counter; the rest share one
+METRICS_MAX_DEVICES = int(os.getenv('METRICS_MAX_DEVICES', 1000))
+# Every LOG_SAMPLE_EVERY-th message is logged, at debug level
+LOG_SAMPLE_EVERY = max(1, int(os.getenv('LOG_SAMPLE_EVERY', 1000)))
+
+# Target for device timestamp -> subscriber notification of an alert
+ALERT_SLO_MS = float(os.getenv('ALERT_SLO_MS', 1000))
+
+# Recent reading identities remembered to drop redeliveries early
+DEDUPE_WINDOW = int(os.getenv('DEDUPE_WINDOW', 65536))
+
+# On-disk queue between MQTT and the database writer; empty disables it
+SPOOL_DIR = os.getenv('INGEST_SPOOL_DIR', 'ingest_spool')
+SPOOL_MAX_MB = int(os.getenv('INGEST_SPOOL_MAX_MB', 1024))
+SPOOL_SEGMENT_MB = int(os.getenv('INGEST_SPOOL_SEGMENT_MB', 16))
+
+
+class IngestService:
+    """MQTT subscription, writer pipeline and detector around one store.
+
+    add_listener() callbacks get committed rows; add_detection_listener()
+    callbacks get the detector's events for them. Both run on the writer
+    thread.
+
+    Seizure and fall readings take a priority lane: add_alert_listener()
+    callbacks get them on the MQTT thread as soon as they are parsed,
+    before they are written, and the pipeline then commits them ahead of
+    its batching delay and never drops them. The device timestamp to
+    notification latency of every alert is recorded against ALERT_SLO_MS.
+
+    Raw sample arrays in a message's 'waveforms' go to a WaveformWriter
+    (see waveforms.py); a message may carry them without a reading.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # Readings are group-committed by a dedicated writer thread
+        self.pipeline = IngestPipeline(
+            store,
+            batch_size=int(os.getenv('INGEST_BATCH_SIZE', 500)),
+            max_delay=float(os.getenv('INGEST_MAX_DELAY_MS', 50)) / 1000,
+            max_queue=int(os.getenv('INGEST_MAX_QUEUE', 10000)),
+            backpressure=os.getenv('INGEST_BACKPRESSURE', 'block')
+        )
+        # Server-side detection over every device's heart rate stream
+        self.detector = SeizureDetector(
+            elevated_bpm=float(os.getenv('DETECTOR_ELEVATED_BPM', 130)),
+            jump_bpm=float(os.getenv('DETECTOR_JUMP_BPM', 20)),
+            sustained_samples=int(os.getenv('DETECTOR_SUSTAINED_SAMPLES', 3)),
+            max_devices=int(os.getenv('DETECTOR_MAX_DEVICES', 10000)),
+            idle_ms=float(os.getenv('DETECTOR_IDLE_MINUTES', 60)) * 60000
+        )
+        # Raw PPG/accelerometer arrays, chunked and written on their own thread
+        self.waveforms = WaveformWriter(
+            store, chunk_ms=int(float(os.getenv('WAVEFORM_CHUNK_SECONDS', 10)) * 1000))
+        self._detection_listeners = []
+        self._alert_listeners = []
+        self.recent = RecentKeys(DEDUPE_WINDOW)
+        # Raw MQTT traffic is appended to MQTT_CAPTURE_PATH when set, for
+        # offline replay with capture.py
+        capture_path = os.getenv('MQTT_CAPTURE_PATH')
+        self.capture = CaptureWriter(capture_path) if capture_path else None
+        self.client = None
+
+        self.messages_received = Counter('seizuresafe_messages_received_total',
+                                         'MQTT messages received')
+        self.messages_failed = Counter('seizuresafe_messages_failed_total',
+                                       'MQTT messages that could not be decoded')
+        self.readings_parsed = Counter('seizuresafe_readings_parsed_total',
+                                       'Readings decoded from MQTT messages')
+        self.readings_rejected = Counter('seizuresafe_readings_rejected_total',
+                                         'Readings that failed validation')
+        self.readings_redelivered = Counter('seizuresafe_readings_redelivered_total',
+                                            'Copies of recent readings dropped on arrival')
+        self.device_messages = Counter('seizuresafe_device_readings_total',
+                                       'Readings received per device', ('device',),
+                                       max_series=METRICS_MAX_DEVICES)
+        self.alerts = Counter('seizuresafe_alerts_total', 'Seizure and fall alerts', ('type',))
+        self.alert_latency = Histogram(
+            'seizuresafe_alert_notify_seconds',
+            'Time from the device timestamp (or receipt) of an alert to its notification',
+            buckets=sorted(set(LATENCY_BUCKETS) | {ALERT_SLO_MS / 1000}))
+        self.alert_slo_breaches = Counter('seizuresafe_alert_slo_breaches_total',
+                                          'Alerts notified later than ALERT_SLO_MS')
+
+    def metrics(self):
+        """Metrics of the service and its pipeline, for a metrics.Registry."""
+        return [self.messages_received, self.messages_failed, self.readings_parsed,
+                self.readings_rejected, self.readings_redelivered, self.device_messages,
+                self.alerts,
+                self.alert_latency, self.alert_slo_breaches] + self.pipeline.metrics() + \
+            self.waveforms.metrics()
+
+    def add_listener(self, listener):
+        self.pipeline.add_listener(listener)
+
+    def add_detection_listener(self, listener):
+        if not self._detection_listeners:
+            self.pipeline.add_listener(self._detect)
+        self._detection_listeners.append(listener)
+
+    def add_alert_listener(self, listener):
+        self._alert_listeners.append(listener)
+
+    def _alert(self, row, data, received):
+        """Notify alert listeners of a validated, not yet durable reading."""
+        # prepare_row() stamps readings on arrival when the device clock is
+        # missing or cannot be trusted
+        device_ts = row[1] if device_time(data)[0] == row[1] else None
+        alert = {
+            'timestamp': str(row[0]),
+            'device_id': row[6],
+            'heart_rate': row[2],
+            'previous_heart_rate': row[3],
+            'fall_detected': bool(row[4]),
+            'seizure_detected': bool(row[5]),
+            'device_ts': device_ts,
+            'durable': False
+        }
+        for listener in self._alert_listeners:
+            try:
+                listener(alert)
+            except Exception as e:
+                logger.error(f"Alert listener {listener!r} failed: {e}")
+        if device_ts is not None:
+            latency_ms = max(0.0, time.time() * 1000 - device_ts)
+        else:
+            latency_ms = (time.monotonic() - received) * 1000
+        self.alert_latency.observe(latency_ms / 1000)
+        for kind in ('seizure', 'fall'):
+            if alert[f'{kind}_detected']:
+                self.alerts.inc(labels=(kind,))
+        if latency_ms > ALERT_SLO_MS:
+            self.alert_slo_breaches.inc()
+            logger.error(f"Alert for device {row[6]!r} notified after {latency_ms:.0f} ms, "
+                         f"over the {ALERT_SLO_MS:.0f} ms target")
+        else:
+            logger.info(f"Alert for device {row[6]!r} notified after {latency_ms:.0f} ms")
+
+    def _detect(self, rows):
+        detections = self.detector.process_rows(rows)
+        for detection in detections:
+            if detection['type'] == 'seizure_suspected':
+                logger.warning(f"Seizure suspected on device {detection['device_id']!r}: "
+                               f"heart rate {detection['heart_rate']}")
+        for listener in self._detection_listeners:
+            listener(detections)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            if flags.get('session present'):
+                logger.info("Connected to MQTT broker, resuming the persistent session")
+            else:
+                logger.info("Connected successfully to MQTT broker")
+            client.subscribe(TOPIC, qos=1)
+        else:
+            logger.error(f"Connection failed with code {rc}")
+
+    def on_message(self, client, userdata, msg):
+        received = time.monotonic()
+        if self.capture is not None:
+            self.capture.write(msg.topic, msg.payload)
+        self.messages_received.inc()
+        try:
+            # JSON or binary; a binary payload can carry many readings
+            readings = decode_payload(msg.payload)
+        except Exception as e:
+            self.messages_failed.inc()
+            logger.error(f"Error processing message: {e}")
+            return
+        self.readings_parsed.inc(len(readings))
+        # Logging every message costs more than ingesting it; sample instead
+        if logger.isEnabledFor(logging.DEBUG) and \
+                self.messages_received.value() % LOG_SAMPLE_EVERY == 0:
+            logger.debug(f"Received {len(readings)} readings, e.g. {readings[0]}")
+        for data in readings:
+            try:
+                self.device_messages.inc(labels=(reading_device(data),))
+                waveforms = data.pop('waveforms', None)
+                if waveforms is not None:
+                    device_id = reading_device(data)
+                    try:
+                        self.waveforms.add(device_id, waveforms)
+                    except ValueError as e:
+                        # The reading that came with them is still stored
+                        logger.error(f"Invalid waveforms from device {device_id!r}: {e}")
+                    if 'heart_rate' not in data:
+                        continue
+                row = self.store.prepare_row(data)
+                key = reading_key(row)
+                if key is not None and key in self.recent:
+                    self.readings_redelivered.inc()
+                    continue
+                if row[4] or row[5]:
+                    self._alert(row, data, received)
+                    accepted = self.pipeline.submit_row(row, received, priority=True)
+                else:
+                    accepted = self.pipeline.submit_row(row, received)
+                # Only once accepted: the resend of a dropped reading must get through
+                if accepted and key is not None:
+                    self.recent.add(key)
+            except Exception as e:
+                self.readings_rejected.inc()
+                logger.error(f"Error processing message: {e}")
+
+    def start(self):
+        """Start the writer and retention, then connect to the broker.
+        Returns the MQTT client, or None if the connection failed."""
+        if SPOOL_DIR and self.pipeline.spool is None:
+            # Readings left over from a crash are written first
+            self.pipeline.spool = Spool(SPOOL_DIR, segment_bytes=SPOOL_SEGMENT_MB << 20,
+                                        max_bytes=SPOOL_MAX_MB << 20)
+        self.pipeline.start()
+        self.waveforms.start()
+        self.store.start_maintenance(RETENTION_INTERVAL_SECONDS)
+        client = mqtt.Client(client_id=CLIENT_ID, clean_session=False,
+                             transport="websockets")
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+
+        # Set credentials
+        client.username_pw_set(USERNAME, PASSWORD)
+
+        # Set up secure TLS configuration
+        try:
+            logger.info("Configuring TLS security...")
+            client.tls_set(
+                cert_reqs=ssl.CERT_REQUIRED,  # Require certificate verification
+                tls_version=ssl.PROTOCOL_TLS,  # Use latest TLS protocol
+                ciphers='ECDHE-ECDSA-AES256-GCM-SHA384:ECDHE-RSA-AES256-GCM-SHA384'  # Specify secure cipher suite
+            )
+            client.tls_insecure_set(False)  # Enforce secure connections
+
+            logger.info("TLS security configured successfully")
+            logger.info(f"Attempting to connect to broker {BROKER}:{PORT}")
+
+            client.enable_logger(logger)
+
+            # Connect with 30 second keepalive
+            client.connect(BROKER, PORT, keepalive=30)
+            client.loop_start()
+
+            # Wait connection
+            time.sleep(2)
+            if not client.is_connected():
+                logger.error("Failed to establish connection within timeout")
+                return None
+
+            logger.info("Successfully connected and started MQTT loop")
+            self.client = client
+            return client
+
+        except ssl.SSLError as ssl_err:
+            logger.error(f"SSL/TLS configuration error: {ssl_err}")
+            return None
+        except Exception as e:
+            logger.error(f"Failed to connect to MQTT broker: {e}")
+            return None
+
+    def stop(self):
+        """Stop receiving messages, then drain the ingest queue to the database."""
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+            self.client = None
+        self.pipeline.stop()
+        self.waveforms.stop()
+        if self.pipeline.spool is not None:
+            self.pipeline.spool.close()
+        if self.capture is not None:
+            self.capture.close()
+
+
+def main():
+    from ipc import EventPublisher
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    store = create_store()
+    service = IngestService(store)
+    publisher = EventPublisher(INGEST_SOCKET)
+    service.add_listener(lambda rows: publisher.publish_rows(rows, store.last_row_id()))
+    service.add_detection_listener(publisher.publish_detections)
+    service.add_alert_listener(publisher.publish_alert)
+    logger.info(f"Publishing live events on {INGEST_SOCKET}")
+    metrics_server = None
+    if METRICS_PORT:
+        registry = Registry()
+        for metric in service.metrics():
+            registry.register(metric)
+        metrics_server = serve_metrics(registry, METRICS_PORT)
+
+    stopping = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stopping.set())
+    if service.start() is None:
+        logger.error("Failed to start ingestion due to MQTT connection failure")
+    else:
+        stopping.wait()
+    logger.info("Shutting down ingestion...")
+    service.stop()
+    publisher.close()
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""Live event channel from the ingestion daemon to API worker processes.
+
+The daemon runs an EventPublisher on a Unix domain socket; every API
+worker connects an EventSubscriber to it. Messages are newline-delimited
+JSON:
+
+    {"type": "rows", "rows": [[timestamp, ts_ms, heart_rate, previous,
+                               fall, seizure, device_id], ...],
+     "last_id": newest committed row id}
+    {"type": "detections", "detections": [{...}, ...]}
+    {"type": "alert", "alert": {...}}
+
+Rows use the DataStore.prepare_row() layout and are only sent after they
+are committed. Alerts (see IngestService) are sent before their reading
+is committed, so they reach dashboards ahead of any write backlog. A
+subscriber that cannot keep up is disconnected rather than allowed to
+stall the writer; it reconnects, and its on_connect hook is expected to
+resynchronize from the database.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Unix socket the ingestion daemon publishes live events on
+INGEST_SOCKET = os.getenv('INGEST_SOCKET', '/tmp/seizuresafe-ingest.sock')
+
+# Kernel send buffer per subscriber: how far a worker may fall behind
+SEND_BUFFER_BYTES = 1 << 20
+
+
+class EventPublisher:
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)  # left over from a previous run
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen()
+        self._clients = []
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()  # keeps messages from interleaving
+        self._closed = False
+        self._thread = threading.Thread(target=self._accept, name='ipc-accept', daemon=True)
+        self._thread.start()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                break  # closed
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_BYTES)
+            conn.setblocking(False)
+            with self._lock:
+                self._clients.append(conn)
+            logger.info("API worker subscribed to live events")
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._clients)
+
+    def publish(self, message):
+        data = json.dumps(message).encode() + b'\n'
+        with self._lock:
+            clients = list(self._clients)
+        with self._send_lock:
+            self._send(clients, data)
+
+    def _send(self, clients, data):
+        for conn in clients:
+            try:
+                conn.sendall(data)
+            except OSError as e:
+                # Full buffer (possibly after a partial write) or a closed
+                # peer: either way this stream is unusable now
+                logger.warning(f"Dropping live event subscriber: {e}")
+                with self._lock:
+                    if conn in self._clients:
+                        self._clients.remove(conn)
+                conn.close()
+
+    def publish_rows(self, rows, last_id=None):
+        self.publish({'type': 'rows',
+                      'rows': [[str(row[0]), *row[1:7]] for row in rows],
+                      'last_id': last_id})
+
+    def publish_alert(self, alert):
+        self.publish({'type': 'alert', 'alert': alert})
+
+    def publish_detections(self, detections):
+        if detections:
+            self.publish({'type': 'detections', 'detections': detections})
+
+    def close(self):
+        self._closed = True
+        self._server.close()
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for conn in clients:
+            conn.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class EventSubscriber:
+    """Background connection to an EventPublisher.
+
+    handler(message) is called for every message on the subscriber thread.
+    on_connect() is called after each (re)connection, before any message
+    of that connection is handled.
+    """
+
+    def __init__(self, path, handler, on_connect=None, retry_seconds=1.0):
+        self.path = path
+        self.handler = handler
+        self.on_connect = on_connect
+        self.retry_seconds = retry_seconds
+        self.connected = threading.Event()
+        self._stopping = threading.Event()
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ipc-subscriber',
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        logged = False
+        while not self._stopping.is_set():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except OSError as e:
+                sock.close()
+                if not logged:
+                    logger.warning(f"Live events unavailable at {self.path}: {e}")
+                    logged = True
+                self._stopping.wait(self.retry_seconds)
+                continue
+            self._sock = sock
+            logged = False
+            logger.info(f"Subscribed to live events at {self.path}")
+            try:
+                if self.on_connect is not None:
+                    try:
+                        self.on_connect()
+                    except Exception as e:
+                        logger.error(f"Live event resync failed: {e}")
+                self.connected.set()
+                for line in sock.makefile('rb'):
+                    try:
+                        self.handler(json.loads(line))
+                    except Exception as e:
+                        logger.error(f"Live event handler failed: {e}")
+            except OSError:
+                pass
+            finally:
+                self.connected.clear()
+                self._sock = None
+                sock.close()
+            if not self._stopping.is_set():
+                logger.warning("Lost live event connection, reconnecting")
+                self._stopping.wait(self.retry_seconds)
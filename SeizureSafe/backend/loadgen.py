@@ -0,0 +1,424 @@
+"""Fleet-scale load generator: thousands of simulated bracelets in one process.
+
+Every bracelet is an asyncio task that publishes readings at a fixed rate,
+using the heart rate model of mqtt_test.py and the payload of
+mock_bracelet.py. Bracelets are started gradually over the ramp-up period.
+Seizures and falls are injected according to a profile.
+
+Readings go either to a real MQTT broker (one or more shared connections)
+or to LocalBroker, an in-process stand-in that can feed an IngestPipeline
+directly, so the whole ingest path can be loaded without any network.
+
+    python loadgen.py --devices 2000 --rate 1 --duration 60 --ramp-up 10 --ingest
+    python loadgen.py --broker mqtt --devices 500 --rate 0.2
+
+--format binary --batch N publishes N readings per message in the
+compact binary format (payload.py) instead of one JSON object each.
+
+Prints a JSON report with publish throughput and latency percentiles:
+delivery latency is publish -> subscriber callback, commit latency is
+receipt -> durable in the database (local --ingest only).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import queue
+import random
+import ssl
+import threading
+import time
+from types import SimpleNamespace
+
+from payload import FORMATS as PAYLOAD_FORMATS, decode_payload, encode as encode_payload
+
+logger = logging.getLogger(__name__)
+
+# Seizure/fall injection profiles: seizure every seizure_interval seconds
+# (per bracelet, randomly phased) and/or with seizure_probability per
+# reading; falls with fall_probability per reading, or
+# seizure_fall_probability during a seizure.
+PROFILES = {
+    'quiet': dict(seizure_interval=None, seizure_probability=0.0,
+                  fall_probability=0.0, seizure_fall_probability=0.0),
+    'default': dict(seizure_interval=None, seizure_probability=0.001,
+                    fall_probability=0.0005, seizure_fall_probability=0.3),
+    # mqtt_test.py: a seizure every 20 seconds, 30% of them with a fall
+    'demo': dict(seizure_interval=20, seizure_probability=0.0,
+                 fall_probability=0.0, seizure_fall_probability=0.3),
+    'storm': dict(seizure_interval=None, seizure_probability=0.05,
+                  fall_probability=0.01, seizure_fall_probability=0.5),
+}
+
+
+class Bracelet:
+    """Heart rate model of one bracelet.
+
+    Between seizures the heart rate wanders by up to 2 BPM per reading
+    between 60 and 70; a seizure sets it to 85-95.
+    """
+
+    def __init__(self, client_id, rng=None, seizure_interval=None, seizure_probability=0.0,
+                 fall_probability=0.0, seizure_fall_probability=0.3):
+        self.client_id = client_id
+        self.rng = rng or random.Random()
+        self.seizure_interval = seizure_interval
+        self.seizure_probability = seizure_probability
+        self.fall_probability = fall_probability
+        self.seizure_fall_probability = seizure_fall_probability
+        self.heart_rate = 65
+        self.seq = 0
+        # Randomly phased so a fleet does not seize in lockstep
+        self.last_seizure_time = time.time() - self.rng.uniform(0, seizure_interval or 0)
+
+    def reading(self, now=None):
+        now = time.time() if now is None else now
+        rng = self.rng
+        previous = self.heart_rate
+        seizure = (self.seizure_interval is not None and
+                   now - self.last_seizure_time >= self.seizure_interval) or \
+            (self.seizure_probability and rng.random() < self.seizure_probability)
+        if seizure:
+            self.heart_rate = rng.randint(85, 95)
+            fall = rng.random() < self.seizure_fall_probability
+            self.last_seizure_time = now
+        else:
+            self.heart_rate = max(60, min(70, self.heart_rate + rng.randint(-2, 2)))
+            fall = bool(self.fall_probability) and rng.random() < self.fall_probability
+        self.seq += 1
+        return {
+            "heart_rate": self.heart_rate,
+            "previous_heart_rate": previous,
+            "seizure_detected": bool(seizure),
+            "fall_detected": fall,
+            "client_id": self.client_id,
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)),
+            # Sample time in epoch ms, used for latency measurement
+            "ts": int(now * 1000),
+            "seq": self.seq
+        }
+
+
+class LatencyRecorder:
+    """Collects latency samples in milliseconds and summarizes them."""
+
+    def __init__(self):
+        self._samples = []
+        self._lock = threading.Lock()
+
+    def add(self, latency_ms):
+        with self._lock:
+            self._samples.append(latency_ms)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def summary(self):
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+
+        def percentile(p):
+            return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+        return {
+            'count': len(samples),
+            'p50': percentile(50),
+            'p95': percentile(95),
+            'p99': percentile(99),
+            'max': samples[-1],
+        }
+
+
+class LocalBroker:
+    """In-process stand-in for the MQTT broker.
+
+    publish() never blocks: messages are queued and delivered in order on
+    a single delivery thread, like paho's network loop, to callbacks with
+    the paho on_message(client, userdata, msg) signature.
+    """
+
+    def __init__(self):
+        self._queue = queue.SimpleQueue()
+        self._subscribers = []
+        self._thread = threading.Thread(target=self._deliver, name='local-broker',
+                                        daemon=True)
+        self._thread.start()
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def publish(self, topic, payload, qos=1):
+        self._queue.put(SimpleNamespace(topic=topic, payload=payload, qos=qos))
+        return True
+
+    def close(self, timeout=None):
+        """Deliver everything already published, then stop."""
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _deliver(self):
+        while True:
+            msg = self._queue.get()
+            if msg is None:
+                break
+            for callback in self._subscribers:
+                try:
+                    callback(None, None, msg)
+                except Exception as e:
+                    logger.error(f"Subscriber failed: {e}")
+
+
+class MqttBroker:
+    """A real MQTT broker, shared by the fleet over a few connections.
+
+    Bracelets publish round-robin over the connections; the first one is
+    also subscribed to topic so delivery latency can be measured.
+    """
+
+    def __init__(self, host, port, topic, username=None, password=None, tls=True,
+                 transport='tcp', connections=1, client_prefix='loadgen'):
+        import paho.mqtt.client as mqtt
+        self._mqtt = mqtt
+        self.topic = topic
+        self._subscribers = []
+        self._clients = []
+        for i in range(connections):
+            client = mqtt.Client(client_id=f'{client_prefix}-{os.getpid()}-{i}',
+                                 transport=transport)
+            if username:
+                client.username_pw_set(username, password)
+            if tls:
+                client.tls_set(cert_reqs=ssl.CERT_NONE)
+                client.tls_insecure_set(True)
+            client.max_queued_messages_set(0)
+            client.connect(host, port, 60)
+            client.loop_start()
+            self._clients.append(client)
+        self._clients[0].on_message = self._deliver
+        self._next = 0
+
+    def subscribe(self, callback):
+        if not self._subscribers:
+            self._clients[0].subscribe(self.topic, qos=1)
+        self._subscribers.append(callback)
+
+    def _deliver(self, client, userdata, msg):
+        for callback in self._subscribers:
+            try:
+                callback(client, userdata, msg)
+            except Exception as e:
+                logger.error(f"Subscriber failed: {e}")
+
+    def publish(self, topic, payload, qos=1):
+        client = self._clients[self._next]
+        self._next = (self._next + 1) % len(self._clients)
+        return client.publish(topic, payload, qos=qos).rc == self._mqtt.MQTT_ERR_SUCCESS
+
+    def close(self, timeout=None):
+        for client in self._clients:
+            client.loop_stop()
+            client.disconnect()
+
+
+class IngestSink:
+    """Feeds delivered messages into a real DataStore through an
+    IngestPipeline and measures receipt -> commit latency."""
+
+    def __init__(self, db_path, batch_size=500, max_delay=0.05, max_queue=10000,
+                 backpressure='block'):
+        from data_store import DataStore, now_ms
+        from ingest import IngestPipeline
+        self._now_ms = now_ms
+        self.store = DataStore(db_path)
+        self.pipeline = IngestPipeline(self.store, batch_size=batch_size,
+                                       max_delay=max_delay, max_queue=max_queue,
+                                       backpressure=backpressure)
+        self.commit_latency = LatencyRecorder()
+        self.pipeline.add_listener(self._committed)
+        self.pipeline.start()
+
+    def _committed(self, rows):
+        now = self._now_ms()
+        for row in rows:
+            self.commit_latency.add(now - row[1])
+
+    def on_message(self, client, userdata, msg):
+        for data in decode_payload(msg.payload):
+            self.pipeline.submit(data)
+
+    def close(self):
+        self.pipeline.stop()
+        self.store.close()
+
+
+class LoadGenerator:
+    """rate is in readings per second per device; with batch > 1 each
+    bracelet publishes its readings batch at a time, in payload_format."""
+
+    def __init__(self, broker, topic, devices=1000, rate=1.0, duration=60.0, ramp_up=0.0,
+                 profile='default', seed=None, client_prefix='LoadgenBracelet',
+                 payload_format='json', batch=1):
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown profile: {profile}")
+        if payload_format not in PAYLOAD_FORMATS:
+            raise ValueError(f"Unknown payload format: {payload_format}")
+        self.payload_format = payload_format
+        self.batch = batch
+        self.broker = broker
+        self.topic = topic
+        self.devices = devices
+        self.rate = rate
+        self.duration = duration
+        self.ramp_up = ramp_up
+        rng = random.Random(seed)
+        self.bracelets = [
+            Bracelet(f'{client_prefix}-{i}', random.Random(rng.random()), **PROFILES[profile])
+            for i in range(devices)
+        ]
+        self.published = 0
+        self.messages = 0
+        self.payload_bytes = 0
+        self.publish_errors = 0
+        self.seizures = 0
+        self.falls = 0
+        self.delivery_latency = LatencyRecorder()
+
+    def on_delivered(self, client, userdata, msg):
+        """Subscriber callback measuring publish -> delivery latency."""
+        now = time.time() * 1000
+        for reading in decode_payload(msg.payload):
+            sent_at = reading.get('ts', reading.get('device_ts'))
+            if sent_at is not None:
+                self.delivery_latency.add(now - sent_at)
+
+    async def _run_bracelet(self, bracelet, start_delay, stop_at):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(start_delay)
+        interval = 1 / self.rate
+        # Spread the first publish over one interval
+        next_time = loop.time() + bracelet.rng.uniform(0, interval)
+        pending = []
+        while True:
+            await asyncio.sleep(max(0.0, next_time - loop.time()))
+            if loop.time() >= stop_at:
+                break
+            reading = bracelet.reading()
+            self.seizures += reading['seizure_detected']
+            self.falls += reading['fall_detected']
+            pending.append(reading)
+            if len(pending) >= self.batch:
+                self._publish(bracelet, pending)
+                pending = []
+            next_time += interval
+        if pending:
+            self._publish(bracelet, pending)
+
+    def _publish(self, bracelet, readings):
+        try:
+            payload = encode_payload(readings, self.payload_format, bracelet.client_id)
+            ok = self.broker.publish(self.topic, payload)
+        except Exception as e:
+            logger.error(f"Publish failed: {e}")
+            ok = False
+        if ok:
+            self.published += len(readings)
+            self.messages += 1
+            self.payload_bytes += len(payload)
+        else:
+            self.publish_errors += len(readings)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        stop_at = started + self.duration
+        step = self.ramp_up / self.devices if self.devices else 0
+        await asyncio.gather(*(self._run_bracelet(bracelet, i * step, stop_at)
+                               for i, bracelet in enumerate(self.bracelets)))
+        return loop.time() - started
+
+    def report(self, elapsed):
+        return {
+            'devices': self.devices,
+            'rate_per_device': self.rate,
+            'seconds': elapsed,
+            'published': self.published,
+            'publish_errors': self.publish_errors,
+            'publish_rate': self.published / elapsed if elapsed else 0.0,
+            'payload_format': self.payload_format,
+            'messages': self.messages,
+            'bytes_per_reading': self.payload_bytes / self.published if self.published else 0.0,
+            'seizures_injected': self.seizures,
+            'falls_injected': self.falls,
+            'delivery_latency_ms': self.delivery_latency.summary(),
+        }
+
+
+def run_load(broker, topic, sink=None, **options):
+    """Run a load against broker and return the report. If sink is given it
+    is subscribed to the broker, drained and closed before reporting."""
+    generator = LoadGenerator(broker, topic, **options)
+    broker.subscribe(generator.on_delivered)
+    if sink is not None:
+        broker.subscribe(sink.on_message)
+    elapsed = asyncio.run(generator.run())
+    broker.close()
+    report = generator.report(elapsed)
+    if sink is not None:
+        sink.close()
+        report['committed'] = sink.pipeline.written
+        report['dropped'] = sink.pipeline.dropped
+        report['commit_latency_ms'] = sink.commit_latency.summary()
+    return report
+
+
+def main():
+    from dotenv import load_dotenv
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Simulate a fleet of SeizureSafe bracelets.')
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help='readings per second per device')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    parser.add_argument('--ramp-up', type=float, default=0.0,
+                        help='seconds over which devices are started')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='default')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--format', choices=PAYLOAD_FORMATS, default='json',
+                        help='payload format')
+    parser.add_argument('--batch', type=int, default=1,
+                        help='readings per published message')
+    parser.add_argument('--broker', choices=('local', 'mqtt'), default='local')
+    parser.add_argument('--connections', type=int, default=1,
+                        help='MQTT connections shared by the fleet')
+    parser.add_argument('--topic', default=os.getenv('MQTT_TOPIC') or 'seizuresafe/load')
+    parser.add_argument('--ingest', action='store_true',
+                        help='local broker only: write readings through an IngestPipeline')
+    parser.add_argument('--db', default='loadgen.db', help='database used with --ingest')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    sink = None
+    if args.broker == 'local':
+        broker = LocalBroker()
+        if args.ingest:
+            sink = IngestSink(args.db)
+    else:
+        if args.ingest:
+            parser.error('--ingest needs --broker local; run app.py against the broker instead')
+        broker = MqttBroker(os.getenv('MQTT_BROKER', 'localhost'),
+                            int(os.getenv('MQTT_PORT', 1883)), args.topic,
+                            os.getenv('MQTT_USERNAME'), os.getenv('MQTT_PASSWORD'),
+                            tls=os.getenv('MQTT_TLS', '1') != '0',
+                            connections=args.connections)
+    report = run_load(broker, args.topic, sink, devices=args.devices, rate=args.rate,
+                      duration=args.duration, ramp_up=args.ramp_up,
+                      profile=args.profile, seed=args.seed,
+                      payload_format=args.format, batch=args.batch)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
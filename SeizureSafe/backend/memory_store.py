@@ -0,0 +1,357 @@
+"""In-memory storage backend, for tests and benchmarks.
+
+MemoryStore implements the StorageBackend interface of data_store.py
+over NumPy columns instead of SQLite, so tests run without touching the
+disk and benchmarks can measure the API without the database under it:
+
+    STORAGE_BACKEND=memory python app.py
+
+Readings are kept as one array per column, sorted by (ts_ms, id), with
+device ids dictionary encoded as int32 codes. A range query is two
+binary searches and a mask, and rollups are computed from the columns on
+request. The arrays are never changed below the published row count:
+a batch newer than every stored reading is appended in place behind it,
+anything else builds new arrays. Readers therefore take (columns, size)
+once and read it without a lock while the writer carries on.
+
+Nothing survives the process, and rollups are kept as long as the raw
+readings they are computed from, not for rollup_retention_days.
+"""
+import bisect
+import logging
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from data_store import (
+    DAY_MS, MAX_WAVEFORM_CHUNK_MS, ROLLUPS, StorageBackend, now_ms, reading_key
+)
+
+logger = logging.getLogger(__name__)
+
+# Columns of a stored reading, in ROW_COLUMNS order less the timestamp
+# text, which is formatted from ts_ms on the way out
+COLUMNS = (
+    ('id', np.int64),
+    ('ts', np.int64),
+    ('heart_rate', np.float64),
+    ('previous', np.float64),
+    ('fall', np.int8),
+    ('seizure', np.int8),
+    ('device', np.int32),
+)
+
+MIN_CAPACITY = 1024
+
+
+def _empty(capacity):
+    return {name: np.empty(capacity, dtype) for name, dtype in COLUMNS}
+
+
+class MemoryStore(StorageBackend):
+    """StorageBackend keeping readings in NumPy columns; see the module
+    docstring."""
+
+    def __init__(self, retention_days=None, max_readers=8):
+        super().__init__(retention_days, max_readers)
+        self._lock = threading.Lock()
+        # Not reset by clear_data(), so last_row_id() never moves backwards
+        self._next_id = 1
+        self._reset()
+
+    def _reset(self):
+        # Published as one tuple so readers see arrays and size together
+        self._state = (_empty(0), 0)
+        self._codes = {}
+        self._names = []
+        self._keys = set()
+        # device code -> [first_seen_ms, last_seen_ms, reading_count]
+        self._devices = {}
+        # device code -> (ts_ms, id, prepare_row() row) of its newest reading
+        self._latest = {}
+        # (device_id, channel) -> ([start_ms, ...], [WAVEFORM_COLUMNS tuple, ...])
+        self._waveforms = {}
+
+    def _code(self, device_id):
+        code = self._codes.get(device_id)
+        if code is None:
+            code = self._codes[device_id] = len(self._names)
+            self._names.append(device_id)
+        return code
+
+    def save_batch(self, rows):
+        """Insert prepare_row() rows, skipping any whose (device_id, ts_ms,
+        seq) is already stored. Returns the rows inserted, in order."""
+        cutoff = self.retention_cutoff()
+        if cutoff is not None:
+            expired = [row for row in rows if row[1] < cutoff]
+            if expired:
+                logger.warning(f"Dropping {len(expired)} readings older than the retention period")
+                rows = [row for row in rows if row[1] >= cutoff]
+        with self._lock:
+            inserted = []
+            for row in rows:
+                key = reading_key(row)
+                if key is not None:
+                    if key in self._keys:
+                        continue
+                    self._keys.add(key)
+                inserted.append(row)
+            if len(inserted) < len(rows):
+                logger.debug(f"Skipped {len(rows) - len(inserted)} duplicate readings")
+            if not inserted:
+                return inserted
+
+            first_id = self._next_id
+            self._next_id += len(inserted)
+            batch = {
+                'id': np.arange(first_id, self._next_id, dtype=np.int64),
+                'ts': np.array([row[1] for row in inserted], dtype=np.int64),
+                'heart_rate': np.array([row[2] for row in inserted], dtype=np.float64),
+                'previous': np.array([row[3] for row in inserted], dtype=np.float64),
+                'fall': np.array([row[4] for row in inserted], dtype=np.int8),
+                'seizure': np.array([row[5] for row in inserted], dtype=np.int8),
+                'device': np.array([self._code(row[6]) for row in inserted], dtype=np.int32),
+            }
+            # Ids grow with position, so a stable sort keeps (ts_ms, id) order
+            order = np.argsort(batch['ts'], kind='stable')
+            batch = {name: column[order] for name, column in batch.items()}
+            self._insert(batch)
+
+            for row_id, row in enumerate(inserted, first_id):
+                code = self._codes[row[6]]
+                latest = self._latest.get(code)
+                if latest is None or row[1] >= latest[0]:
+                    self._latest[code] = (row[1], row_id, row)
+                if not row[6]:
+                    continue
+                seen = self._devices.get(code)
+                if seen is None:
+                    self._devices[code] = [row[1], row[1], 1]
+                else:
+                    seen[0] = min(seen[0], row[1])
+                    seen[1] = max(seen[1], row[1])
+                    seen[2] += 1
+        return inserted
+
+    def _insert(self, batch):
+        """Publish the stored rows merged with batch, sorted by ts_ms."""
+        columns, size = self._state
+        count = len(batch['id'])
+        capacity = len(columns['id'])
+        if size + count <= capacity and (not size or batch['ts'][0] >= columns['ts'][size - 1]):
+            # Newer than everything stored: readers never look past size
+            for name, column in columns.items():
+                column[size:size + count] = batch[name]
+            self._state = (columns, size + count)
+            return
+        # Late readings, or out of room: build new arrays for the merge
+        merged = _empty(max(MIN_CAPACITY, 2 * (size + count)))
+        positions = np.searchsorted(columns['ts'][:size], batch['ts'], side='right')
+        positions += np.arange(count)
+        old = np.ones(size + count, dtype=bool)
+        old[positions] = False
+        for name, column in merged.items():
+            column[positions] = batch[name]
+            column[:size + count][old] = columns[name][:size]
+        self._state = (merged, size + count)
+
+    def _window(self, start_ms, device_id=None, after=None, ids=None):
+        """(columns, indices) of the stored rows in (ts_ms, id) order
+        matching the iter_rows() arguments."""
+        columns, size = self._state
+        ts = columns['ts'][:size]
+        low = int(np.searchsorted(ts, start_ms, side='left'))
+        if after is not None:
+            low = max(low, int(np.searchsorted(ts, after[0], side='left')))
+        mask = None
+
+        def narrow(condition):
+            nonlocal mask
+            mask = condition if mask is None else mask & condition
+
+        if device_id is not None:
+            code = self._codes.get(device_id)
+            if code is None:
+                return columns, np.empty(0, dtype=np.int64)
+            narrow(columns['device'][low:size] == code)
+        if ids is not None:
+            row_ids = columns['id'][low:size]
+            narrow((row_ids > ids[0]) & (row_ids <= ids[1]))
+        if after is not None:
+            narrow((ts[low:] > after[0]) | (columns['id'][low:size] > after[1]))
+        if mask is None:
+            return columns, np.arange(low, size)
+        return columns, low + np.flatnonzero(mask)
+
+    def iter_rows(self, start_ms, after=None, limit=None, device_id=None,
+                  chunk_size=1000, ids=None):
+        """Yield ROW_COLUMNS tuples with ts_ms >= start_ms in (ts_ms, id)
+        order; see DataStore.iter_rows() for the other arguments."""
+        columns, indices = self._window(start_ms, device_id, after, ids)
+        if limit is not None:
+            indices = indices[:limit]
+        names = self._names
+        for first in range(0, len(indices), chunk_size):
+            chunk = indices[first:first + chunk_size]
+            for row_id, ts, heart_rate, previous, fall, seizure, device in zip(
+                    *(columns[name][chunk].tolist() for name, _ in COLUMNS)):
+                yield (row_id, ts, str(datetime.fromtimestamp(ts / 1000)), heart_rate,
+                       None if previous != previous else previous,  # NaN -> None
+                       fall, seizure, names[device])
+
+    def get_latest_data(self, device_id=None):
+        if device_id is None:
+            latest = max(list(self._latest.values()), default=None,
+                         key=lambda entry: (entry[0], entry[1]))
+        else:
+            code = self._codes.get(device_id)
+            latest = None if code is None else self._latest.get(code)
+        if latest is None:
+            return {}
+        row = latest[2]
+        return {
+            'timestamp': str(datetime.fromtimestamp(row[1] / 1000)),
+            'device_id': row[6],
+            'heart_rate': row[2],
+            'previous_heart_rate': row[3],
+            'fall_detected': bool(row[4]),
+            'seizure_detected': bool(row[5])
+        }
+
+    def _buckets(self, start_ms, width, device_id):
+        """(bucket start ms, rows per bucket, first row of each) of the rows
+        from start_ms on, and the columns, for reduceat()."""
+        columns, indices = self._window(start_ms, device_id)
+        buckets = columns['ts'][indices] // width * width
+        if not len(buckets):
+            return columns, indices, buckets, buckets, buckets
+        starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+        counts = np.diff(np.append(starts, len(buckets)))
+        return columns, indices, buckets[starts], counts, starts
+
+    def get_rollup_data(self, hours, resolution, device_id=None):
+        """Aggregated history, one entry per '1m' or '1h' bucket."""
+        width = ROLLUPS[resolution][1]
+        start = now_ms() - hours * 3600 * 1000
+        columns, indices, buckets, counts, starts = \
+            self._buckets(start - start % width, width, device_id)
+        if not len(buckets):
+            return []
+        heart_rate = columns['heart_rate'][indices]
+        sums = np.add.reduceat(heart_rate, starts)
+        minima = np.minimum.reduceat(heart_rate, starts)
+        maxima = np.maximum.reduceat(heart_rate, starts)
+        seizures = np.add.reduceat(columns['seizure'][indices].astype(np.int64), starts)
+        falls = np.add.reduceat(columns['fall'][indices].astype(np.int64), starts)
+        return [{
+            'timestamp': str(datetime.fromtimestamp(bucket / 1000)),
+            'heart_rate': total / count,
+            'heart_rate_min': low,
+            'heart_rate_max': high,
+            'count': count,
+            'seizure_count': seizure_count,
+            'fall_count': fall_count,
+            'fall_detected': fall_count > 0,
+            'seizure_detected': seizure_count > 0
+        } for bucket, count, total, low, high, seizure_count, fall_count in zip(
+            buckets.tolist(), counts.tolist(), sums.tolist(), minima.tolist(),
+            maxima.tolist(), seizures.tolist(), falls.tolist())]
+
+    def window_counts(self, start_ms, device_id=None):
+        _, indices, buckets, _, _ = self._buckets(start_ms, ROLLUPS['1m'][1], device_id)
+        return len(buckets), len(indices)
+
+    def list_devices(self):
+        """Every device that has sent a reading, with first/last seen times."""
+        devices = sorted((self._names[code], seen)
+                         for code, seen in list(self._devices.items()))
+        return [{
+            'device_id': device_id,
+            'first_seen': str(datetime.fromtimestamp(first / 1000)),
+            'last_seen': str(datetime.fromtimestamp(last / 1000)),
+            'reading_count': count
+        } for device_id, (first, last, count) in devices]
+
+    def last_row_id(self):
+        """Id of the newest reading, the data set version."""
+        return self._next_id - 1
+
+    def enforce_retention(self, now=None):
+        """Expire raw readings and waveform chunks older than retention_days,
+        raw readings a whole day at a time as DataStore does. Returns the
+        expired day numbers."""
+        cutoff = self.retention_cutoff(now)
+        if cutoff is None:
+            return []
+        with self._lock:
+            columns, size = self._state
+            ts = columns['ts'][:size]
+            expired = []
+            drop = int(np.searchsorted(ts, cutoff // DAY_MS * DAY_MS, side='left'))
+            if drop:
+                expired = np.unique(ts[:drop] // DAY_MS).tolist()
+                kept = _empty(max(MIN_CAPACITY, 2 * (size - drop)))
+                for name, column in kept.items():
+                    column[:size - drop] = columns[name][drop:size]
+                self._state = (kept, size - drop)
+                first_kept = cutoff // DAY_MS * DAY_MS
+                self._keys = {key for key in self._keys if key[1] >= first_kept}
+                self._latest = {code: latest for code, latest in self._latest.items()
+                                if latest[0] >= first_kept}
+                logger.info(f"Expired {drop} readings of {len(expired)} days")
+
+            for key, (starts, chunks) in list(self._waveforms.items()):
+                first = bisect.bisect_left(starts, cutoff)
+                if first:
+                    self._waveforms[key] = (starts[first:], chunks[first:])
+        return expired
+
+    def clear_data(self):
+        """Drop every reading and waveform chunk."""
+        with self._lock:
+            self._reset()
+
+    def save_waveform_chunks(self, chunks):
+        """Insert waveform chunks, tuples of device_id, channel and then
+        WAVEFORM_COLUMNS, skipping any whose device, channel and start time
+        are already stored. Returns the number inserted."""
+        cutoff = self.retention_cutoff()
+        inserted = 0
+        with self._lock:
+            # Copied once per channel and published whole, so a reader
+            # holding the old lists is unaffected
+            updated = {}
+            for device_id, channel, *chunk in chunks:
+                if cutoff is not None and chunk[0] < cutoff:
+                    continue
+                key = (device_id, channel)
+                if key not in updated:
+                    starts, stored = self._waveforms.get(key, ([], []))
+                    updated[key] = (list(starts), list(stored))
+                starts, stored = updated[key]
+                position = bisect.bisect_left(starts, chunk[0])
+                if position < len(starts) and starts[position] == chunk[0]:
+                    continue
+                starts.insert(position, chunk[0])
+                stored.insert(position, tuple(chunk))
+                inserted += 1
+            self._waveforms.update(updated)
+        return inserted
+
+    def iter_waveform_chunks(self, device_id, channel, start_ms, end_ms):
+        """Yield the chunks of one channel of a device that overlap
+        start_ms <= t < end_ms as WAVEFORM_COLUMNS tuples, oldest first."""
+        starts, chunks = self._waveforms.get((device_id, channel), ([], []))
+        first = bisect.bisect_right(starts, start_ms - MAX_WAVEFORM_CHUNK_MS)
+        last = bisect.bisect_left(starts, end_ms)
+        for chunk in chunks[first:last]:
+            if chunk[1] > start_ms:
+                yield chunk
+
+    def list_waveform_channels(self, device_id):
+        """Names of the channels a device has sent waveform samples on."""
+        return sorted(channel
+                      for (device, channel), (starts, _) in list(self._waveforms.items())
+                      if device == device_id and starts)
@@ -0,0 +1,200 @@
+"""In-process metrics in the Prometheus text exposition format.
+
+Metrics are plain objects updated from the hot path: a counter increment
+or a histogram observation is a lock and an addition, so instrumenting
+every message costs well under a microsecond. A Registry renders them for
+a scraper, either from the Flask app's /metrics route or, for the
+ingestion daemon, from serve() on METRICS_PORT.
+
+Values that already exist elsewhere (queue depth, pipeline counters) are
+exposed with a function instead of being copied on every change.
+"""
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from a fast batch commit to a badly backed-up queue
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Monotonic count, optionally split by labels.
+
+    With max_series set, label values beyond that many distinct ones are
+    counted under overflow instead, so a flood of device ids cannot grow
+    the registry without bound.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=(), function=None, max_series=None,
+                 overflow='_other'):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.max_series = max_series
+        self.overflow = overflow
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            if labels not in self._values and self.max_series is not None and \
+                    len(self._values) >= self.max_series:
+                labels = (self.overflow,) * len(self.labelnames)
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        if self.function is not None:
+            return self.function()
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, '', self.function())]
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, _labels(self.labelnames, labels), value)
+                for labels, value in values]
+
+
+class Gauge(Counter):
+    """Current value, usually read from a function at scrape time."""
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram:
+    """Distribution of observations over fixed upper bounds."""
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)  # last one is +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    @property
+    def count(self):
+        return sum(self._counts)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile, or None."""
+        with self._lock:
+            counts = list(self._counts)
+        total = sum(counts)
+        if not total:
+            return None
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            running += count
+            if running >= q * total:
+                return bound
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        samples = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            running += count
+            samples.append((self.name + '_bucket', f'{{le="{_number(bound)}"}}', running))
+        samples.append((self.name + '_sum', '', total))
+        samples.append((self.name + '_count', '', running))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add metric, replacing any earlier one of the same name (e.g. of
+        a restarted pipeline). Returns metric."""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logger.error(f"Failed to collect metric {metric.name}: {e}")
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{labels} {_number(value)}' for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes every few seconds would drown the log
+
+
+def serve(registry, port, host='0.0.0.0'):
+    """Serve registry at http://host:port/metrics from a daemon thread.
+    Returns the server; call shutdown() on it to stop."""
+    handler = type('MetricsHandler', (_Handler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f"Serving metrics on {host}:{server.server_address[1]}/metrics")
+    return server
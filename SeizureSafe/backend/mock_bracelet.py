@@ -1,13 +1,14 @@
 import paho.mqtt.client as mqtt
+import itertools
 import time
 import random
-import json
-import pyttsx3 #this for for the text to speech for the alert
 import logging
 import ssl
 from dotenv import load_dotenv
 import os
 
+from payload import encode as encode_payload
+
 # Load environment variables
 load_dotenv()
 
@@ -22,6 +23,8 @@ MQTT_PORT = int(os.getenv('MQTT_PORT', 8883))
 MQTT_TOPIC = os.getenv('MQTT_TOPIC')
 MQTT_USERNAME = os.getenv('MQTT_USERNAME')
 MQTT_PASSWORD = os.getenv('MQTT_PASSWORD')
+# 'json' (default) or 'binary', see payload.py
+PAYLOAD_FORMAT = os.getenv('PAYLOAD_FORMAT', 'json')
 
 def on_connect(client, userdata, flags, reason_code, properties=None):
     if reason_code == 0:
@@ -47,44 +50,43 @@ def on_disconnect(client, userdata, reason_code, properties=None):
     else:
         logger.info("Disconnected successfully")
 
-# Generate a unique client ID
-client_id = f"SeizureSafeBracelet-{random.randint(1000, 9999)}"
-logger.info(f"Generated client ID: {client_id}")
-
-# Set up MQTT client
-client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5)
-client.on_connect = on_connect
-client.on_publish = on_publish
-client.on_disconnect = on_disconnect
+def create_client(client_id):
+    """Set up an MQTT client for one bracelet and connect it."""
+    client = mqtt.Client(client_id=client_id, protocol=mqtt.MQTTv5)
+    client.on_connect = on_connect
+    client.on_publish = on_publish
+    client.on_disconnect = on_disconnect
 
-# Set username and password
-client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    # Set username and password
+    client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
 
-# Enable SSL/TLS
-client.tls_set(certfile=None,
-               keyfile=None,
-               cert_reqs=ssl.CERT_NONE,
-               tls_version=ssl.PROTOCOL_TLS,
-               ciphers=None)
+    # Enable SSL/TLS
+    client.tls_set(certfile=None,
+                   keyfile=None,
+                   cert_reqs=ssl.CERT_NONE,
+                   tls_version=ssl.PROTOCOL_TLS,
+                   ciphers=None)
 
-# Don't verify the server's hostname
-client.tls_insecure_set(True)
+    # Don't verify the server's hostname
+    client.tls_insecure_set(True)
 
-try:
     logger.info(f"Connecting to MQTT broker at {MQTT_BROKER}...")
     client.connect(MQTT_BROKER, MQTT_PORT, 60)
     client.loop_start()
-except Exception as e:
-    logger.error(f"Failed to connect to MQTT broker: {e}")
-    logger.exception("Detailed error:")
-    exit(1)
+    return client
 
-def generate_mock_data():
+# Per-run reading counter; with the sample time it identifies a reading,
+# so the backend can drop copies redelivered after a reconnect
+sequence = itertools.count()
+
+def generate_mock_data(client_id):
     data = {
         "heart_rate": random.randint(60, 120),
         "fall_detected": random.choice([True, False, False, False]),
         "client_id": client_id,
-        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "ts": int(time.time() * 1000),
+        "seq": next(sequence)
     }
     logger.info(f"Generated mock data: {data}")
     return data
@@ -92,6 +94,7 @@ def generate_mock_data():
 def alert_fall():
     """ Simulate a speaker alert if fall is detected """
     try:
+        import pyttsx3  # text to speech for the alert, only needed when one plays
         engine = pyttsx3.init()
         engine.say("Seizure alert, please make sure i have not hit my head")
         engine.runAndWait()
@@ -100,44 +103,60 @@ def alert_fall():
     except Exception as e:
         logger.error(f"Failed to play alert: {e}")
 
-try:
-    logger.info("Starting main loop...")
-    message_count = 0
-    while True:
-        data = generate_mock_data()
-        try:
-            message = json.dumps(data)
-            result = client.publish(MQTT_TOPIC, message, qos=1)
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                message_count += 1
-                logger.info(f"Successfully published message #{message_count}: {message}")
-            else:
-                logger.error(f"Failed to publish data: {result.rc}")
+def main(interval=5):
+    # Generate a unique client ID
+    client_id = f"SeizureSafeBracelet-{random.randint(1000, 9999)}"
+    logger.info(f"Generated client ID: {client_id}")
+
+    try:
+        client = create_client(client_id)
+    except Exception as e:
+        logger.error(f"Failed to connect to MQTT broker: {e}")
+        logger.exception("Detailed error:")
+        exit(1)
+
+    try:
+        logger.info("Starting main loop...")
+        message_count = 0
+        while True:
+            data = generate_mock_data(client_id)
+            try:
+                message = encode_payload([data], PAYLOAD_FORMAT, client_id)
+                result = client.publish(MQTT_TOPIC, message, qos=1)
+                if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                    message_count += 1
+                    logger.info(f"Successfully published message #{message_count}: {data}")
+                else:
+                    logger.error(f"Failed to publish data: {result.rc}")
+                    # Try to reconnect
+                    try:
+                        client.reconnect()
+                    except Exception as e:
+                        logger.error(f"Failed to reconnect: {e}")
+            except Exception as e:
+                logger.error(f"Error publishing data: {e}")
+                logger.exception("Detailed error:")
                 # Try to reconnect
                 try:
                     client.reconnect()
                 except Exception as e:
                     logger.error(f"Failed to reconnect: {e}")
-        except Exception as e:
-            logger.error(f"Error publishing data: {e}")
-            logger.exception("Detailed error:")
-            # Try to reconnect
-            try:
-                client.reconnect()
-            except Exception as e:
-                logger.error(f"Failed to reconnect: {e}")
-
-        if data["fall_detected"]:
-            alert_fall()
-
-        time.sleep(5)  # Send data every 5 seconds
-
-except KeyboardInterrupt:
-    logger.info("\nProgram stopped by user. Exiting gracefully...")
-    client.loop_stop()
-    client.disconnect()
-except Exception as e:
-    logger.error(f"Unexpected error: {e}")
-    logger.exception("Detailed error:")
-    client.loop_stop()
-    client.disconnect()
+
+            if data["fall_detected"]:
+                alert_fall()
+
+            time.sleep(interval)  # Send data every 5 seconds
+
+    except KeyboardInterrupt:
+        logger.info("\nProgram stopped by user. Exiting gracefully...")
+        client.loop_stop()
+        client.disconnect()
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+        logger.exception("Detailed error:")
+        client.loop_stop()
+        client.disconnect()
+
+# For a whole fleet of bracelets use loadgen.py
+if __name__ == "__main__":
+    main()
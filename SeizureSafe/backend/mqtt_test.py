@@ -1,11 +1,11 @@
 import paho.mqtt.client as mqtt
 import ssl
 import time
-import json
-import random
 import logging
 from dotenv import load_dotenv
 import os
+from loadgen import Bracelet
+from payload import encode as encode_payload
 
 # Load environment variables
 load_dotenv()
@@ -21,6 +21,8 @@ PORT = int(os.getenv('MQTT_PORT', 8084))
 TOPIC = os.getenv('MQTT_TOPIC')
 USERNAME = os.getenv('MQTT_USERNAME')
 PASSWORD = os.getenv('MQTT_PASSWORD')
+# 'json' (default) or 'binary', see payload.py
+PAYLOAD_FORMAT = os.getenv('PAYLOAD_FORMAT', 'json')
 
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
@@ -41,38 +43,19 @@ def main():
         client.connect(BROKER, PORT, 60)
         client.loop_start()
 
-        # Initialize simulated data
-        heart_rate = 65
-        last_seizure_time = 0
+        # Same heart rate model the load generator uses for a whole fleet:
+        # a seizure every 20 seconds, 30% of them with a fall
+        bracelet = Bracelet("mqtt-test", seizure_interval=20, seizure_fall_probability=0.3)
+        bracelet.last_seizure_time = 0
 
         while True:
-            current_time = time.time()
-            
-            # Force a seizure every 20 seconds
-            if current_time - last_seizure_time >= 20:
-                heart_rate = random.randint(85, 95)
-                seizure_detected = True
-                fall_detected = random.random() < 0.3
-                last_seizure_time = current_time
-                logger.warning(f"SEIZURE DETECTED! Heart Rate: {heart_rate}")
-            else:
-                # Normal heart rate simulation around 65 BPM
-                heart_rate += random.randint(-2, 2)
-                heart_rate = max(60, min(70, heart_rate))
-                seizure_detected = False
-                fall_detected = False
-
-            # Create data packet
-            data = {
-                "heart_rate": heart_rate,
-                "previous_heart_rate": heart_rate - random.randint(-2, 2),
-                "seizure_detected": seizure_detected,
-                "fall_detected": fall_detected,
-                "timestamp": time.strftime("%H:%M:%S")
-            }
+            data = bracelet.reading()
+            if data["seizure_detected"]:
+                logger.warning(f"SEIZURE DETECTED! Heart Rate: {data['heart_rate']}")
 
             # Publish data
-            client.publish(TOPIC, json.dumps(data), qos=1)
+            client.publish(TOPIC, encode_payload([data], PAYLOAD_FORMAT, bracelet.client_id),
+                           qos=1)
             logger.info(f"Published: {data}")
             
             time.sleep(3)
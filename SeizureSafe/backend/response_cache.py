@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CachedResponse:
+    __slots__ = ('body', 'mimetype', 'version', 'modified_ms', 'expires')
+
+    def __init__(self, body, mimetype, version, modified_ms, expires):
+        self.body = body
+        self.mimetype = mimetype
+        self.version = version
+        self.modified_ms = modified_ms
+        self.expires = expires
+
+
+class ResponseCache:
+    """Rendered history responses plus the data set version they were
+    rendered at.
+
+    The version is the newest committed row id (DataStore.last_row_id()).
+    The ingest path calls invalidate() with every committed batch, before
+    the rows reach the hot cache, which bumps the version and drops the
+    entries of the devices in the batch (and every all-device entry).
+    Entries also expire after ttl_seconds, since a window relative to now
+    slowly loses its oldest readings even when nothing new arrives.
+    """
+
+    def __init__(self, max_entries=256, ttl_seconds=5.0, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.version = 0
+        self.modified_ms = int(time.time() * 1000)
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self, version):
+        """Forget every entry and start over at version, e.g. after the
+        live event stream was interrupted."""
+        with self._lock:
+            self._entries.clear()
+            self.version = version
+            self.modified_ms = int(time.time() * 1000)
+
+    def invalidate(self, rows, version=None):
+        """Account for committed rows in the DataStore.prepare_row() layout.
+        version is the store's last_row_id() after they were committed."""
+        devices = {row[6] for row in rows}
+        with self._lock:
+            if version is not None and version > self.version:
+                self.version = version
+            self.modified_ms = int(time.time() * 1000)
+            for key in [key for key in self._entries
+                        if key[0] is None or key[0] in devices]:
+                del self._entries[key]
+
+    def get(self, key):
+        """Entry for key, which starts with the device id (None for all)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= self._clock():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body, mimetype, version, modified_ms):
+        """Store a response rendered at version. Ignored if the data set
+        has moved on since, as the response may already be stale."""
+        with self._lock:
+            if version != self.version:
+                return
+            self._entries[key] = CachedResponse(body, mimetype, version, modified_ms,
+                                                self._clock() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,248 @@
+import math
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+from heapq import merge
+
+from data_store import now_ms
+
+FALL = 1
+SEIZURE = 2
+
+
+def _reading(device_id, ts, heart_rate, flags):
+    return {
+        'timestamp': str(datetime.fromtimestamp(ts / 1000)),
+        'device_id': device_id,
+        'heart_rate': heart_rate,
+        'fall_detected': bool(flags & FALL),
+        'seizure_detected': bool(flags & SEIZURE)
+    }
+
+
+# Readings a RingBuffer has room for before it first grows
+INITIAL_ALLOCATION = 16
+
+
+class RingBuffer:
+    """Bounded circular buffer of readings in typed arrays.
+
+    Readings are kept in time order: append() takes the newest one, insert()
+    places a late one. The arrays start small and double as needed up to
+    capacity readings; once the buffer is full each addition overwrites the
+    oldest reading, whose timestamp is returned so the caller knows how far
+    back the buffer is still complete.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._allocate(min(capacity, INITIAL_ALLOCATION))
+        self._start = 0  # physical index of the oldest reading
+        self._size = 0
+
+    def _allocate(self, length):
+        self._length = length
+        self._ts = array('q', bytes(8 * length))
+        self._heart_rate = array('d', bytes(8 * length))
+        self._previous = array('d', bytes(8 * length))
+        self._flags = array('B', bytes(length))
+
+    def _grow(self):
+        """Double the arrays, keeping the readings in logical order."""
+        entries = [self._entry(n) for n in range(self._size)]
+        self._allocate(min(self.capacity, 2 * self._length))
+        self._start = 0
+        for i, (ts, heart_rate, previous, flags) in enumerate(entries):
+            self._ts[i] = ts
+            self._heart_rate[i] = heart_rate
+            self._previous[i] = previous
+            self._flags[i] = flags
+
+    def __len__(self):
+        return self._size
+
+    def append(self, ts, heart_rate, previous_heart_rate, flags):
+        evicted = None
+        if self._size == self._length < self.capacity:
+            self._grow()
+        if self._size < self._length:
+            i = (self._start + self._size) % self._length
+            self._size += 1
+        else:
+            i = self._start
+            evicted = self._ts[i]
+            self._start = (self._start + 1) % self._length
+        self._ts[i] = ts
+        self._heart_rate[i] = heart_rate
+        self._previous[i] = previous_heart_rate
+        self._flags[i] = flags
+        return evicted
+
+    def _physical(self, n):
+        return (self._start + n) % self._length
+
+    def _entry(self, n):
+        i = self._physical(n)
+        return (self._ts[i], self._heart_rate[i], self._previous[i], self._flags[i])
+
+    def _bisect(self, ts, right=False):
+        """Logical index of the first reading with ts >= ts (> ts if right)."""
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self._ts[self._physical(mid)]
+            if value < ts or (right and value == ts):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def insert(self, ts, heart_rate, previous_heart_rate, flags):
+        """Add a reading that may be older than the newest one.
+
+        Returns (added, evicted) like append(): added is False for an exact
+        copy of a buffered reading, and for a reading older than everything
+        in a full buffer, which counts as evicted itself. Costs a shift of
+        the readings newer than it, which for late data are few.
+        """
+        position = self._bisect(ts, right=True)
+        entry = (ts, heart_rate, previous_heart_rate, flags)
+        n = position - 1
+        while n >= 0 and self._ts[self._physical(n)] == ts:
+            if self._entry(n) == entry:
+                return False, None
+            n -= 1
+        if position == self._size:
+            return True, self.append(*entry)
+        if position == 0 and self._size == self.capacity:
+            return False, ts
+        newer = [self._entry(n) for n in range(position, self._size)]
+        self._size = position
+        evicted = self.append(*entry)
+        for reading in newer:
+            dropped = self.append(*reading)
+            evicted = dropped if evicted is None else evicted
+        return True, evicted
+
+    def last_ts(self):
+        return self._ts[self._physical(self._size - 1)] if self._size else None
+
+    def latest(self):
+        if not self._size:
+            return None
+        i = self._physical(self._size - 1)
+        return (self._ts[i], self._heart_rate[i], self._previous[i], self._flags[i])
+
+    def since(self, start_ms):
+        """Yield (ts, heart_rate, previous, flags) tuples with ts >= start_ms."""
+        for n in range(self._bisect(start_ms), self._size):
+            i = self._physical(n)
+            yield (self._ts[i], self._heart_rate[i], self._previous[i], self._flags[i])
+
+
+class HotCache:
+    """In-memory tier holding the most recent readings of every device.
+
+    Fed with committed rows from the ingest pipeline, so anything it returns
+    is already durable. history() only answers when the buffers still hold
+    every reading of the requested window, otherwise it returns None and the
+    caller should fall back to the database.
+
+    A device that has sent nothing for window_minutes is dropped, and so is
+    the least recently seen one beyond max_devices; either way the cache
+    stops claiming to be complete before that device's last reading.
+    """
+
+    def __init__(self, window_minutes=60, capacity=2048, max_devices=10000):
+        self.window_ms = window_minutes * 60 * 1000
+        self.capacity = capacity
+        self.max_devices = max_devices
+        # Device id -> RingBuffer, least recently seen first
+        self._buffers = OrderedDict()
+        self._lock = threading.Lock()
+        # Earliest time from which the cache is known to hold every reading.
+        # Nothing is complete until load() has run.
+        self._complete_from = None
+
+    def load(self, store):
+        """Rebuild the buffers from the last window of stored readings."""
+        start = now_ms() - self.window_ms
+        rows = store.get_rows(start)
+        with self._lock:
+            self._buffers = OrderedDict()
+            self._complete_from = start
+            self._add(rows)
+
+    def add_rows(self, rows):
+        """Append rows in the DataStore.prepare_row() layout."""
+        with self._lock:
+            self._add(rows)
+
+    def _add(self, rows):
+        for row in rows:
+            _, ts, heart_rate, previous, fall, seizure, device_id = row[:7]
+            buffer = self._buffers.get(device_id)
+            if buffer is None:
+                buffer = self._buffers[device_id] = RingBuffer(self.capacity)
+            else:
+                self._buffers.move_to_end(device_id)
+            flags = (FALL if fall else 0) | (SEIZURE if seizure else 0)
+            if previous is None:
+                previous = math.nan
+            if len(buffer) and ts <= buffer.last_ts():
+                # Late data, or a live row that load() picked up already
+                _, evicted = buffer.insert(ts, heart_rate, previous, flags)
+            else:
+                evicted = buffer.append(ts, heart_rate, previous, flags)
+            if evicted is not None:
+                self._incomplete_before(evicted + 1)
+        self._evict_devices()
+
+    def _incomplete_before(self, ts):
+        if self._complete_from is not None:
+            self._complete_from = max(self._complete_from, ts)
+
+    def _evict_devices(self):
+        """Drop idle devices and the least recently seen beyond max_devices."""
+        idle_before = now_ms() - self.window_ms
+        while self._buffers:
+            device_id, buffer = next(iter(self._buffers.items()))
+            last_ts = buffer.last_ts()
+            if len(self._buffers) <= self.max_devices and \
+                    (last_ts is None or last_ts >= idle_before):
+                break
+            del self._buffers[device_id]
+            if last_ts is not None:
+                self._incomplete_before(last_ts + 1)
+
+    def covers(self, start_ms):
+        return self._complete_from is not None and start_ms >= self._complete_from
+
+    def _selected(self, device_id):
+        if device_id is None:
+            return self._buffers.items()
+        buffer = self._buffers.get(device_id)
+        return [(device_id, buffer)] if buffer is not None else []
+
+    def latest(self, device_id=None):
+        """Most recent reading, of one device or across all of them."""
+        with self._lock:
+            candidates = [(b.latest(), device) for device, b in self._selected(device_id)
+                          if len(b)]
+        if not candidates:
+            return None
+        (ts, heart_rate, previous, flags), device = max(candidates)
+        reading = _reading(device, ts, heart_rate, flags)
+        reading['previous_heart_rate'] = None if previous != previous else previous
+        return reading
+
+    def history(self, start_ms, device_id=None):
+        """Readings since start_ms in the get_historical_data() format."""
+        with self._lock:
+            if not self.covers(start_ms):
+                return None
+            streams = [[(row, device) for row in b.since(start_ms)]
+                       for device, b in self._selected(device_id)]
+        return [_reading(device, ts, heart_rate, flags)
+                for (ts, heart_rate, _, flags), device in merge(*streams)]
@@ -0,0 +1,257 @@
+"""Append-only, memory-mapped spool between the MQTT callback and the writer.
+
+Records go into fixed-size segment files, each mapped into memory:
+
+    segment  magic b'SSSPOOL1' | record | record | ... | zero fill
+    record   body length u32 | crc32 of body u32 | body
+
+A length of SKIP means the rest of the segment is unused and the next
+record is at the start of the next segment. Appending is a memcpy into
+the shared mapping, so a record survives a crash of the process as soon
+as append() returns; flush() forces the mappings to disk, which the writer
+does every loop to bound what a power failure can take.
+
+A checkpoint file holds the position up to which records are committed to
+the database. On start the spool scans forward from it, drops a record
+torn by a crash, and hands everything after the checkpoint to the writer
+again. Segments wholly before the checkpoint are deleted, and appends fail
+with SpoolFull once max_bytes of segments are in use.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SSSPOOL1'
+RECORD = struct.Struct('<II')
+SKIP = 0xFFFFFFFF
+# Committed (segment, offset) and a crc32 of the two
+CHECKPOINT = struct.Struct('<QQI')
+CHECKPOINT_FILE = 'checkpoint'
+SEGMENT_SUFFIX = '.seg'
+
+
+def _checkpoint_crc(segment, offset):
+    return zlib.crc32(struct.pack('<QQ', segment, offset))
+
+
+class SpoolFull(Exception):
+    """The spool holds max_bytes of records the writer has not committed."""
+
+
+class Spool:
+    """Durable FIFO of byte records with a single reader.
+
+    append() may be called from any thread. read(), rewind() and commit()
+    belong to the one writer: read() hands out the next records, and once
+    they are in the database commit() moves the checkpoint past them; after
+    a failed write rewind() makes read() return them again.
+    """
+
+    def __init__(self, directory, segment_bytes=16 << 20, max_bytes=1 << 30):
+        if segment_bytes < len(MAGIC) + RECORD.size + 1:
+            raise ValueError("segment_bytes too small")
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_segments = max(2, max_bytes // segment_bytes)
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._maps = {}
+        self._urgent = False
+        self._committed = self._load_checkpoint()
+        for segment in self._segments():
+            if segment < self._committed[0]:
+                os.remove(self._path(segment))
+        self._recover()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f'{segment:016d}{SEGMENT_SUFFIX}')
+
+    def _segments(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _map(self, segment, create=False):
+        mm = self._maps.get(segment)
+        if mm is not None:
+            return mm
+        path = self._path(segment)
+        if create and not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(MAGIC)
+                f.truncate(self.segment_bytes)
+        with open(path, 'r+b') as f:
+            if os.fstat(f.fileno()).st_size != self.segment_bytes:
+                f.truncate(self.segment_bytes)
+            mm = mmap.mmap(f.fileno(), self.segment_bytes)
+        self._maps[segment] = mm
+        return mm
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT_FILE), 'rb') as f:
+                segment, offset, crc = CHECKPOINT.unpack(f.read(CHECKPOINT.size))
+        except (OSError, struct.error):
+            segment = None
+        else:
+            if _checkpoint_crc(segment, offset) != crc:
+                logger.warning("Spool checkpoint is corrupt, replaying every segment")
+                segment = None
+        if segment is None:
+            segments = self._segments()
+            return (segments[0] if segments else 0), len(MAGIC)
+        return segment, offset
+
+    def _next(self, position):
+        """(position of the record after the one at position, its body),
+        or (position, None) at the end of the written records."""
+        segment, offset = position
+        mm = self._maps.get(segment)
+        if mm is None:
+            return position, None
+        if offset + RECORD.size <= self.segment_bytes:
+            length, crc = RECORD.unpack_from(mm, offset)
+        else:
+            length, crc = SKIP, 0
+        if length == SKIP:
+            if segment + 1 not in self._maps:
+                return position, None
+            following = (segment + 1, len(MAGIC))
+            return self._next(following)
+        end = offset + RECORD.size + length
+        if length == 0 or end > self.segment_bytes:
+            return position, None
+        body = mm[offset + RECORD.size:end]
+        if zlib.crc32(body) != crc:
+            return position, None
+        return (segment, end), body
+
+    def _recover(self):
+        segments = [s for s in self._segments() if s >= self._committed[0]]
+        for segment in segments or [self._committed[0]]:
+            self._map(segment, create=True)
+        position, pending = self._committed, 0
+        while True:
+            # Moves past a SKIP into the next segment even at the end
+            position, body = self._next(position)
+            if body is None:
+                break
+            pending += 1
+        segment, offset = position
+        last = max(self._maps)
+        if segment != last:
+            logger.warning(f"Spool segment {segment} ends in a torn record, "
+                           f"discarding segments after it")
+            for later in range(segment + 1, last + 1):
+                self._maps.pop(later).close()
+                os.remove(self._path(later))
+        mm = self._maps[segment]
+        if any(mm[offset:offset + RECORD.size]):
+            logger.warning("Discarding a torn record at the end of the spool")
+            mm[offset:] = bytes(self.segment_bytes - offset)
+        self._write = position
+        self._read = self._committed
+        self._pending = self._unread = pending
+        if pending:
+            logger.info(f"Spool has {pending} readings to replay")
+
+    def append(self, body, urgent=False, force=False):
+        """Add a record. urgent wakes the reader without waiting for a full
+        batch; force ignores max_bytes. Raises SpoolFull."""
+        size = RECORD.size + len(body)
+        if not body or size > self.segment_bytes - len(MAGIC):
+            raise ValueError(f"Spool records must be 1 to "
+                             f"{self.segment_bytes - len(MAGIC) - RECORD.size} bytes")
+        with self._lock:
+            segment, offset = self._write
+            mm = self._maps[segment]
+            if offset + size > self.segment_bytes:
+                if segment + 1 - self._committed[0] >= self.max_segments and not force:
+                    raise SpoolFull(f"Spool {self.directory} is full")
+                if offset + RECORD.size <= self.segment_bytes:
+                    RECORD.pack_into(mm, offset, SKIP, 0)
+                segment, offset = segment + 1, len(MAGIC)
+                mm = self._map(segment, create=True)
+            mm[offset + RECORD.size:offset + size] = body
+            RECORD.pack_into(mm, offset, len(body), zlib.crc32(body))
+            self._write = (segment, offset + size)
+            self._pending += 1
+            self._unread += 1
+            self._urgent = self._urgent or urgent
+            self._changed.notify_all()
+
+    def wait(self, count=1, timeout=None):
+        """Wait until count records are unread, an urgent one was appended
+        or interrupt() was called. Returns the number of unread records."""
+        with self._changed:
+            self._changed.wait_for(lambda: self._unread >= count or self._urgent, timeout)
+            return self._unread
+
+    def interrupt(self):
+        """Wake the reader out of wait()."""
+        with self._changed:
+            self._urgent = True
+            self._changed.notify_all()
+
+    def read(self, limit):
+        """Up to limit unread records: (bodies, position after them)."""
+        with self._lock:
+            self._urgent = False
+            bodies = []
+            position = self._read
+            while len(bodies) < limit and position != self._write:
+                position, body = self._next(position)
+                if body is None:
+                    break
+                bodies.append(body)
+            self._read = position
+            self._unread -= len(bodies)
+            return bodies, position
+
+    def rewind(self):
+        """Make read() start over at the checkpoint."""
+        with self._lock:
+            self._read = self._committed
+            self._unread = self._pending
+
+    def commit(self, position, count):
+        """Record that the count records before position are in the database."""
+        segment, offset = position
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(CHECKPOINT.pack(segment, offset, _checkpoint_crc(segment, offset)))
+        os.replace(path + '.tmp', path)
+        with self._lock:
+            self._committed = position
+            self._pending -= count
+            done = [s for s in self._maps if s < segment]
+            for old in done:
+                self._maps.pop(old).close()
+        for old in done:
+            os.remove(self._path(old))
+
+    def flush(self):
+        """Write the mapped segments to disk."""
+        with self._lock:
+            maps = list(self._maps.values())
+        for mm in maps:
+            mm.flush()
+
+    def pending(self):
+        """Records not yet committed."""
+        return self._pending
+
+    def disk_bytes(self):
+        return len(self._maps) * self.segment_bytes
+
+    def close(self):
+        with self._lock:
+            for mm in self._maps.values():
+                mm.flush()
+                mm.close()
+            self._maps.clear()
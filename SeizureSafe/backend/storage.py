@@ -0,0 +1,43 @@
+"""The store the API and the ingestion daemon run on, as configured.
+
+STORAGE_BACKEND picks the StorageBackend (see data_store.py) that
+create_store() opens: 'sqlite' for a DataStore on seizure_data.db, or
+'memory' for a MemoryStore that keeps nothing on disk. Both app.py and
+ingestd.py open their store here, so the API does not depend on the
+daemon.
+"""
+import os
+
+from dotenv import load_dotenv
+
+from data_store import DataStore
+from memory_store import MemoryStore
+
+load_dotenv()
+
+# Statements slower than this are logged with their query plan (0 disables it)
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 250)) or None
+
+# 'sqlite', or 'memory' for a MemoryStore that keeps nothing on disk
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
+
+
+def _optional_int(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+
+def create_store():
+    """The writable store of STORAGE_BACKEND. Raw readings are kept for
+    DATA_RETENTION_DAYS (forever if unset) and, by a DataStore, archived
+    to ARCHIVE_DIR before being dropped."""
+    if STORAGE_BACKEND == 'memory':
+        return MemoryStore(retention_days=_optional_int('DATA_RETENTION_DAYS'))
+    if STORAGE_BACKEND != 'sqlite':
+        raise ValueError(f"Unknown STORAGE_BACKEND: {STORAGE_BACKEND}")
+    return DataStore(
+        retention_days=_optional_int('DATA_RETENTION_DAYS'),
+        archive_dir=os.getenv('ARCHIVE_DIR') or None,
+        rollup_retention_days=_optional_int('ROLLUP_RETENTION_DAYS'),
+        slow_query_ms=SLOW_QUERY_MS
+    )
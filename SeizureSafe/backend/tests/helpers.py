@@ -0,0 +1,20 @@
+"""Readings and rows shared by the test suites."""
+from datetime import datetime
+from data_store import now_ms
+
+def make_reading(heart_rate=80.0, previous=78.0, fall=False, seizure=False, **fields):
+    """A decoded bracelet message; fields adds e.g. client_id, ts or seq."""
+    return dict({
+        "heart_rate": heart_rate,
+        "previous_heart_rate": previous,
+        "fall_detected": fall,
+        "seizure_detected": seizure
+    }, **fields)
+
+def make_row(heart_rate=70.0, ts=None, device_id='', seq=None, previous=None, fall=0,
+             seizure=0):
+    """A row in the StorageBackend.prepare_row() layout, stamped at ts
+    (now by default). previous defaults to heart_rate."""
+    ts = now_ms() if ts is None else ts
+    return (datetime.fromtimestamp(ts / 1000), ts, heart_rate,
+            heart_rate if previous is None else previous, fall, seizure, device_id, seq)
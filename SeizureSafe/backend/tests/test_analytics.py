@@ -0,0 +1,101 @@
+import unittest
+import json
+from analytics import ReadingArrays, parse_window, stats, window_stats
+from app import create_app
+from data_store import now_ms
+from memory_store import MemoryStore
+from helpers import make_row
+
+class TestAnalytics(unittest.TestCase):
+    """Test suite for the windowed heart rate statistics."""
+
+    def setUp(self):
+        self.store = MemoryStore()
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_parse_window(self):
+        """Test that window widths are parsed and invalid ones rejected."""
+        self.assertEqual(parse_window('30s'), 30 * 1000)
+        self.assertEqual(parse_window('5m'), 5 * 60 * 1000)
+        self.assertEqual(parse_window('1h'), 3600 * 1000)
+        for invalid in ('', '0m', '5', '1d', 'm'):
+            with self.assertRaises(ValueError):
+                parse_window(invalid)
+
+    def test_window_stats_match_python(self):
+        """Test that vectorized window aggregates match a plain Python loop."""
+        start = 1_700_000_000_000
+        minute = 60 * 1000
+        rows = [make_row(60.0 + (i * 13) % 40, start + i * 7000,
+                         previous=60.0 + (i * 7) % 40, fall=int(i % 11 == 0),
+                         seizure=int(i % 17 == 0))
+                for i in range(100)]
+        self.store.save_batch(rows)
+        arrays = ReadingArrays.load(self.store, start)
+        result = window_stats(arrays, start, start + 20 * minute, 2 * minute)
+
+        expected = {}
+        for row in rows:
+            expected.setdefault((row[1] - start) // (2 * minute), []).append(row)
+        self.assertEqual(len(result), len(expected))
+        for window, (_, group) in zip(result, sorted(expected.items())):
+            rates = [row[2] for row in group]
+            changes = [abs(row[2] - row[3]) for row in group]
+            self.assertEqual(window['count'], len(group))
+            self.assertAlmostEqual(window['heart_rate_mean'], sum(rates) / len(rates))
+            self.assertEqual(window['heart_rate_min'], min(rates))
+            self.assertEqual(window['heart_rate_max'], max(rates))
+            self.assertAlmostEqual(window['heart_rate_change_mean'],
+                                   sum(changes) / len(changes))
+            self.assertEqual(window['heart_rate_change_max'], max(changes))
+            self.assertEqual(window['seizure_count'], sum(row[5] for row in group))
+            self.assertEqual(window['fall_count'], sum(row[4] for row in group))
+
+    def test_empty_windows_skipped(self):
+        """Test that windows without readings are left out."""
+        start = 1_700_000_000_000
+        self.store.save_batch([make_row(70.0, start), make_row(80.0, start + 3600 * 1000)])
+        arrays = ReadingArrays.load(self.store, start)
+        result = window_stats(arrays, start, start + 2 * 3600 * 1000, 60 * 1000)
+        self.assertEqual([w['heart_rate_mean'] for w in result], [70.0, 80.0])
+        self.assertEqual(window_stats(arrays[:0], start, start + 1000, 1000), [])
+
+    def test_summary_and_device_filter(self):
+        """Test the summary, time since last event and the device filter."""
+        now = now_ms()
+        self.store.save_batch([
+            make_row(70.0, now - 50000, 'a', seizure=1),
+            make_row(90.0, now - 40000, 'b', fall=1),
+            make_row(80.0, now - 30000, 'a'),
+        ])
+        result = stats(self.store, 1, '1m', now=now)
+        self.assertEqual(result['summary']['count'], 3)
+        self.assertEqual(result['summary']['heart_rate_max'], 90.0)
+        self.assertEqual(result['summary']['seconds_since_last_seizure'], 50.0)
+        self.assertEqual(result['summary']['seconds_since_last_fall'], 40.0)
+        self.assertEqual(sum(w['count'] for w in result['windows']), 3)
+
+        result = stats(self.store, 1, '1m', device_id='a', now=now)
+        self.assertEqual(result['summary']['count'], 2)
+        self.assertIsNone(result['summary']['last_fall'])
+
+        with self.assertRaises(ValueError):
+            stats(self.store, 24 * 365, '1s')
+
+    def test_stats_endpoint(self):
+        """Test the /api/stats route and its parameter validation."""
+        self.store.save_batch([make_row(75.0)])
+        app = create_app(self.store, ingest_mode='off')
+        app.config['TESTING'] = True
+        client = app.test_client()
+        response = client.get('/api/stats?hours=1&window=5m')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['summary']['count'], 1)
+        self.assertEqual(data['windows'][0]['heart_rate_mean'], 75.0)
+        self.assertEqual(client.get('/api/stats?window=5x').status_code, 400)
+
+if __name__ == '__main__':
+    unittest.main()
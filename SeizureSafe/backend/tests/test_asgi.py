@@ -0,0 +1,255 @@
+import unittest
+import asyncio
+import http.client
+import json
+import queue
+import threading
+import time
+from unittest import mock
+from app import create_app
+from asgi import AsgiApp, serve
+from memory_store import MemoryStore
+from ring_buffer import HotCache
+
+def call(application, method, path, query=b'', body=b'', headers=()):
+    """(status, headers, body) of one request to an ASGI application."""
+    return asyncio.run(request(application, method, path, query, body, headers))
+
+async def request(application, method, path, query=b'', body=b'', headers=()):
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query,
+             'headers': list(headers), 'http_version': '1.1', 'scheme': 'http',
+             'server': ('testserver', 80), 'client': ('127.0.0.1', 1234)}
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+    await application(scope, receive, send)
+    return (messages[0]['status'], dict(messages[0]['headers']),
+            b''.join(m.get('body', b'') for m in messages[1:]))
+
+class SlowApp:
+    """WSGI app that takes delay seconds per request and counts calls."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        time.sleep(self.delay)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        body = [environ['PATH_INFO'].encode(), b'?', environ['QUERY_STRING'].encode()]
+        if 'HTTP_AUTHORIZATION' in environ:
+            body.append(b' as ' + environ['HTTP_AUTHORIZATION'].encode())
+        return body
+
+class TestAsgi(unittest.TestCase):
+    """Test suite for the asyncio serving mode."""
+
+    def setUp(self):
+        """Set up test environment before each test."""
+        self.store = MemoryStore()
+        self.cache = HotCache(window_minutes=60, capacity=100)
+        self.app = create_app(self.store, ingest_mode='off')
+        self.app.config['TESTING'] = True
+        services = self.app.extensions['seizuresafe']
+        services.cache = self.cache
+        services.responses = None
+        self.application = AsgiApp(self.app, inline=services.served_from_memory,
+                                   db_workers=2)
+
+    def tearDown(self):
+        """Clean up after each test."""
+        self.application.close()
+        self.store.close()
+
+    def test_same_responses_as_flask(self):
+        """Test that the routes answer exactly like the Flask app."""
+        self.cache.load(self.store)
+        self.store.save_data({'heart_rate': 91.0, 'previous_heart_rate': 70.0,
+                              'fall_detected': True, 'seizure_detected': False})
+        self.cache.load(self.store)
+        client = self.app.test_client()
+
+        status, headers, body = call(self.application, 'GET', '/api/latest')
+        self.assertEqual((status, body), (200, client.get('/api/latest').data))
+        status, headers, body = call(self.application, 'GET', '/api/history/1',
+                                     b'resolution=1m')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b'x-resolution'], b'1m')
+        self.assertEqual(json.loads(body),
+                         json.loads(client.get('/api/history/1?resolution=1m').data))
+        login = json.dumps({'username': 'testuser', 'password': 'testpass'}).encode()
+        status, _, body = call(self.application, 'POST', '/api/login', body=login,
+                               headers=[(b'content-type', b'application/json'),
+                                        (b'content-length', str(len(login)).encode())])
+        self.assertEqual(status, 200)
+        self.assertTrue(json.loads(body)['success'])
+        self.assertEqual(call(self.application, 'GET', '/api/stream')[0], 501)
+
+        self.assertEqual(self.application.inline_requests, 2,
+                         "/api/latest and /api/login never touch the database")
+        self.assertEqual(self.application.offloaded, 1)
+
+    def test_latest_offloaded_when_not_cached(self):
+        """Test that /api/latest only runs on the loop when the hot cache can answer it."""
+        status, _, _ = call(self.application, 'GET', '/api/latest')
+        self.assertEqual(status, 404)
+        self.assertEqual((self.application.inline_requests, self.application.offloaded), (0, 1))
+
+    def test_identical_requests_coalesced(self):
+        """Test that identical in-flight requests share one execution."""
+        slow = SlowApp(0.2)
+        application = AsgiApp(slow, db_workers=4)
+
+        async def burst():
+            return await asyncio.gather(
+                *[request(application, 'GET', '/api/history/24') for _ in range(5)],
+                request(application, 'GET', '/api/history/24', b'resolution=1h'))
+        responses = asyncio.run(burst())
+        application.close()
+        self.assertEqual(slow.calls, 2)
+        self.assertEqual(application.coalesced, 4)
+        self.assertEqual({body for _, _, body in responses[:5]}, {b'/api/history/24?'})
+        self.assertEqual(responses[5][2], b'/api/history/24?resolution=1h')
+
+    def test_credentials_not_shared(self):
+        """Test that concurrent requests with different credentials never share a response."""
+        slow = SlowApp(0.2)
+        application = AsgiApp(slow, db_workers=4)
+        tokens = [b'Bearer a', b'Bearer b', None, b'Bearer a']
+
+        async def burst():
+            return await asyncio.gather(*[
+                request(application, 'GET', '/api/devices',
+                        headers=[(b'authorization', token)] if token else [])
+                for token in tokens])
+        responses = asyncio.run(burst())
+        application.close()
+        self.assertEqual(slow.calls, 3)
+        self.assertEqual(application.coalesced, 1)
+        self.assertEqual([body for _, _, body in responses],
+                         [b'/api/devices? as Bearer a',
+                          b'/api/devices? as Bearer b',
+                          b'/api/devices?',
+                          b'/api/devices? as Bearer a'])
+        cookies = [[(b'cookie', b'session=a')], [(b'cookie', b'session=a'), (b'cookie', b'x=1')]]
+
+        async def cookie_burst():
+            return await asyncio.gather(*[request(application, 'GET', '/api/history/1',
+                                                  headers=headers) for headers in cookies])
+        application = AsgiApp(slow, db_workers=4)
+        asyncio.run(cookie_burst())
+        application.close()
+        self.assertEqual((slow.calls, application.coalesced), (5, 0))
+
+    def test_admin_routes_not_coalesced(self):
+        """Test that admin requests run on their own even with the same token."""
+        services = self.app.extensions['seizuresafe']
+        services.store.slow_queries = [{'sql': 'SELECT 1', 'ms': 300.0}]
+        headers = [(b'authorization', b'Bearer test-admin-token')]
+
+        async def burst():
+            return await asyncio.gather(*[
+                request(self.application, 'GET', '/api/admin/slow-queries', headers=headers)
+                for _ in range(3)],
+                request(self.application, 'GET', '/api/admin/slow-queries'))
+        with mock.patch('app.ADMIN_TOKEN', 'test-admin-token'):
+            responses = asyncio.run(burst())
+        self.assertEqual([status for status, _, _ in responses], [200, 200, 200, 403])
+        self.assertEqual(json.loads(responses[0][2]), [{'sql': 'SELECT 1', 'ms': 300.0}])
+        self.assertEqual((self.application.offloaded, self.application.coalesced), (4, 0))
+
+    def test_large_response_bounded(self):
+        """Test that a large body streamed to a slow client is buffered only
+        up to buffer_bytes, and that a request arriving after that runs on its own."""
+        chunk, count, limit = b'x' * 4096, 256, 64 << 10
+        received = [0]
+        lead = []
+        calls = []
+
+        def large(environ, start_response):
+            calls.append(environ)
+            first = len(calls) == 1
+            start_response('200 OK', [('Content-Type', 'application/octet-stream')])
+            for i in range(count):
+                if first:
+                    # Bytes produced but not yet sent to the slow client
+                    lead.append(i * len(chunk) - received[0])
+                yield chunk
+        application = AsgiApp(large, db_workers=2, buffer_bytes=limit)
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/history/24',
+                 'query_string': b'', 'headers': [], 'http_version': '1.1'}
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def slow_send(message):
+            received[0] += len(message.get('body', b''))
+            await asyncio.sleep(0.001)
+
+        async def burst():
+            reading = asyncio.ensure_future(application(scope, receive, slow_send))
+            while received[0] <= limit:
+                await asyncio.sleep(0.001)
+            late = await request(application, 'GET', '/api/history/24')
+            await reading
+            return late
+        late = asyncio.run(burst())
+        application.close()
+        self.assertEqual(received[0], count * len(chunk))
+        self.assertEqual(len(late[2]), count * len(chunk))
+        self.assertEqual((application.offloaded, application.coalesced), (2, 0))
+        self.assertLessEqual(max(lead), limit + 2 * len(chunk))
+
+    def test_backlog_rejected(self):
+        """Test that requests beyond max_pending get a 503 instead of queueing."""
+        application = AsgiApp(SlowApp(0.2), db_workers=1, max_pending=1)
+
+        async def burst():
+            return await asyncio.gather(request(application, 'GET', '/api/history/1'),
+                                        request(application, 'GET', '/api/history/2'))
+        first, second = asyncio.run(burst())
+        application.close()
+        self.assertEqual((first[0], second[0]), (200, 503))
+        self.assertEqual(second[1][b'retry-after'], b'1')
+        self.assertEqual(application.rejected, 1)
+
+    def test_http_server(self):
+        """Test the standard library HTTP/1.1 server, including keep-alive."""
+        self.cache.load(self.store)
+        self.store.save_data({'heart_rate': 80.0, 'previous_heart_rate': 75.0,
+                              'fall_detected': False, 'seizure_detected': False})
+        self.cache.load(self.store)
+        started = queue.Queue()
+
+        def started_on(port):
+            started.put((port, asyncio.get_running_loop(), asyncio.current_task()))
+
+        def run():
+            try:
+                asyncio.run(serve(self.application, '127.0.0.1', 0, started=started_on))
+            except asyncio.CancelledError:
+                pass
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        port, loop, task = started.get(timeout=5)
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            connection.request('GET', '/api/history/1')
+            response = connection.getresponse()
+            self.assertEqual(response.status, 200)
+            self.assertEqual(len(json.loads(response.read())), 1)
+            connection.request('GET', '/api/latest')
+            response = connection.getresponse()
+            self.assertEqual(json.loads(response.read())['heart_rate'], 80.0)
+            connection.close()
+        finally:
+            loop.call_soon_threadsafe(task.cancel)
+            thread.join(5)
+
+if __name__ == '__main__':
+    unittest.main()
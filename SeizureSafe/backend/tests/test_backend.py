@@ -1,35 +1,30 @@
 import unittest
 import json
-from app import app
-from data_store import DataStore
-import os
+from unittest import mock
+from app import create_app
+from data_store import now_ms
+from history import WINDOW_STEP_MS
+from memory_store import MemoryStore
+from ring_buffer import HotCache
+from response_cache import ResponseCache
 
 class TestBackend(unittest.TestCase):
     """Test suite for the backend functionality."""
     
     def setUp(self):
         """Set up test environment before each test."""
-        # Use a separate test database to avoid affecting production data
-        self.test_db = 'test_seizure_data.db'
-        self.store = DataStore(self.test_db)
+        # Serve an in-memory store, so no database file is touched
+        self.store = MemoryStore()
         
         # Configure Flask app for testing
-        app.config['TESTING'] = True
-        self.client = app.test_client()
+        self.app = create_app(self.store, ingest_mode='embedded')
+        self.app.config['TESTING'] = True
+        self.services = self.app.extensions['seizuresafe']
+        self.client = self.app.test_client()
 
     def tearDown(self):
         """Clean up after each test."""
-        # Close the database connection
-        if hasattr(self.store, 'conn'):
-            self.store.conn.close()
-        
-        # Remove test database file
-        if os.path.exists(self.test_db):
-            try:
-                os.remove(self.test_db)
-            except PermissionError:
-                # If we can't remove it now, it will be cleaned up in the next test run
-                pass
+        self.store.close()
 
     def test_save_and_retrieve_data(self):
         """Test that we can save data and retrieve it correctly."""
@@ -65,6 +60,160 @@ class TestBackend(unittest.TestCase):
         data = json.loads(response.data)
         self.assertIsInstance(data, list, "Response should be a list")
 
+    def test_history_resolution(self):
+        """Test that the history endpoint honours the resolution parameter."""
+        response = self.client.get('/api/history/168?resolution=1h')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['X-Resolution'], '1h')
+        self.assertIsInstance(json.loads(response.data), list)
+
+        response = self.client.get('/api/history/1?resolution=auto&points=1000000')
+        self.assertEqual(response.headers['X-Resolution'], 'raw')
+
+        response = self.client.get('/api/history/1?resolution=weekly')
+        self.assertEqual(response.status_code, 400, "Unknown resolution should be rejected")
+
+    def test_history_streaming_and_paging(self):
+        """Test NDJSON output and keyset pagination of the history endpoint."""
+        for heart_rate in (70.0, 71.0, 72.0):
+            self.store.save_data({
+                "heart_rate": heart_rate,
+                "previous_heart_rate": 70.0,
+                "fall_detected": False,
+                "seizure_detected": False
+            })
+
+        self.services.cache = None
+        self.services.responses = None
+        response = self.client.get('/api/history/1?format=ndjson')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)['heart_rate'] for line in lines],
+                         [70.0, 71.0, 72.0])
+
+        response = self.client.get('/api/history/1?limit=2')
+        self.assertEqual(len(json.loads(response.data)), 2)
+        cursor = response.headers['X-Next-Cursor']
+        response = self.client.get(f'/api/history/1?limit=2&after={cursor}')
+        self.assertEqual([row['heart_rate'] for row in json.loads(response.data)], [72.0])
+        self.assertNotIn('X-Next-Cursor', response.headers, "Last page has no cursor")
+
+        response = self.client.get('/api/history/1?limit=0')
+        self.assertEqual(response.status_code, 400)
+
+    def test_device_endpoints(self):
+        """Test the per-device history and latest routes."""
+        self.store.save_data({
+            "heart_rate": 99.0,
+            "previous_heart_rate": 80.0,
+            "fall_detected": False,
+            "seizure_detected": True,
+            "client_id": "bracelet-7"
+        })
+
+        self.services.cache = HotCache()
+        self.services.responses = None
+        response = self.client.get('/api/devices/bracelet-7/latest')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['heart_rate'], 99.0)
+
+        response = self.client.get('/api/devices/bracelet-7/history/1')
+        self.assertEqual(len(json.loads(response.data)), 1)
+        response = self.client.get('/api/devices/bracelet-8/history')
+        self.assertEqual(json.loads(response.data), [])
+        self.assertEqual(self.client.get('/api/devices/bracelet-8/latest').status_code, 404)
+
+        devices = json.loads(self.client.get('/api/devices').data)
+        self.assertEqual([d['device_id'] for d in devices], ['bracelet-7'])
+
+    def test_history_delta_and_etag(self):
+        """Test since= deltas, conditional requests and the response cache."""
+        def ingest(heart_rate):
+            rows = [self.store.prepare_row({"heart_rate": heart_rate,
+                                            "previous_heart_rate": 70.0,
+                                            "fall_detected": False,
+                                            "seizure_detected": False})]
+            self.store.save_batch(rows)
+            # What the ingest listeners do with every committed batch
+            responses.invalidate(rows, self.store.last_row_id())
+            cache.add_rows(rows)
+
+        cache = HotCache()
+        cache.load(self.store)
+        responses = ResponseCache()
+        responses.reset(self.store.last_row_id())
+        self.services.cache = cache
+        self.services.responses = responses
+        ingest(70.0)
+        ingest(71.0)
+        response = self.client.get('/api/history/1')
+        self.assertEqual(len(json.loads(response.data)), 2)
+        etag = response.headers['ETag']
+        modified = response.headers['Last-Modified']
+        cursor = response.headers['X-Cursor']
+        self.assertEqual(cursor, str(self.store.last_row_id()))
+
+        response = self.client.get('/api/history/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        response = self.client.get('/api/history/1', headers={'If-Modified-Since': modified})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(responses.hits, 2, "Repeated polls should be served from memory")
+
+        ingest(72.0)
+        response = self.client.get('/api/history/1', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)), 3)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        response = self.client.get(f'/api/history/1?since={cursor}')
+        self.assertEqual([row['heart_rate'] for row in json.loads(response.data)], [72.0])
+        response = self.client.get(f"/api/history/1?since={response.headers['X-Cursor']}")
+        self.assertEqual(json.loads(response.data), [])
+
+        response = self.client.get('/api/history/1?since=abc')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/history/24?since=2&resolution=1h')
+        self.assertEqual(response.status_code, 400)
+
+    def test_history_validators_follow_window(self):
+        """Test that a window that has moved on is not answered with a 304."""
+        self.store.save_data({"heart_rate": 70.0, "previous_heart_rate": 70.0,
+                              "fall_detected": False, "seizure_detected": False})
+        responses = ResponseCache()
+        responses.reset(self.store.last_row_id())
+        self.services.cache = None
+        self.services.responses = responses
+        now = now_ms()
+        with mock.patch('history.now_ms', return_value=now):
+            response = self.client.get('/api/history/1?resolution=1m')
+            etag, modified = response.headers['ETag'], response.headers['Last-Modified']
+            self.assertEqual(self.client.get('/api/history/1?resolution=1m',
+                                             headers={'If-None-Match': etag}).status_code, 304)
+        with mock.patch('history.now_ms', return_value=now + 2 * WINDOW_STEP_MS):
+            response = self.client.get('/api/history/1?resolution=1m',
+                                       headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+            response = self.client.get('/api/history/1?resolution=1m',
+                                       headers={'If-Modified-Since': modified})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(responses), 2, "Each window step has its own cache entry")
+
+    def test_metrics_endpoint(self):
+        """Test that /metrics serves the Prometheus text format."""
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        text = response.get_data(as_text=True)
+        self.assertIn('# TYPE seizuresafe_ingest_queue_depth gauge', text)
+        self.assertIn('seizuresafe_broker_to_commit_seconds_bucket{le="+Inf"}', text)
+
+    def test_latest_endpoint(self):
+        """Test that the latest endpoint answers without a server error."""
+        response = self.client.get('/api/latest')
+        self.assertIn(response.status_code, (200, 404))
+
     def test_invalid_data_handling(self):
         """Test that invalid data is handled gracefully."""
         # Create invalid test data
@@ -0,0 +1,50 @@
+import unittest
+import json
+import shutil
+import tempfile
+from benchmarks import concurrency_bench, datastore_bench
+
+class TestDataStoreBenchmarks(unittest.TestCase):
+    """Test suite for the DataStore/API benchmark harness (at toy sizes)."""
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_parse_size(self):
+        """Test the size shorthand used on the command line."""
+        self.assertEqual(datastore_bench.parse_size('1M'), 1000000)
+        self.assertEqual(datastore_bench.parse_size('50m'), 50000000)
+        self.assertEqual(datastore_bench.parse_size('2.5K'), 2500)
+        self.assertEqual(datastore_bench.format_size(10000000), '10M')
+
+    def test_suite_produces_json_results(self):
+        """Test that a small run covers every benchmark and serializes to JSON."""
+        report = datastore_bench.run([3000], self.data_dir, repeats=2, days=2,
+                                     single_writes=50, batched_writes=10000)
+        report = json.loads(json.dumps(report))
+        names = {result['name'] for result in report['results']}
+        self.assertEqual(names, {'save_data', 'save_batch', 'get_historical_data',
+                                 'get_latest_data', '/api/history', '/api/latest'})
+        windows = [r for r in report['results'] if r['name'] == 'get_historical_data']
+        self.assertEqual(windows[-1]['rows'], 3000, "The week window holds every reading")
+
+        # Unchanged numbers are not regressions; a slower p50 is
+        self.assertEqual(datastore_bench.compare(report, report), [])
+        slower = json.loads(json.dumps(report))
+        slower['results'][0]['p50_ms'] *= 2
+        self.assertEqual(len(datastore_bench.compare(report, slower)), 1)
+
+    def test_concurrency_modes(self):
+        """Test that both serving modes are measured for both routes."""
+        report = concurrency_bench.run(2000, self.data_dir, clients=4, duration=0.5, days=1)
+        report = json.loads(json.dumps(report))
+        measured = {(result['mode'], result['name']) for result in report['results']}
+        self.assertEqual(measured, {(mode, route) for mode in concurrency_bench.MODES
+                                    for route in ('/api/history', '/api/latest')})
+        self.assertEqual(sum(result['errors'] for result in report['results']), 0)
+
+if __name__ == '__main__':
+    unittest.main()
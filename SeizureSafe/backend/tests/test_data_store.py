@@ -1,6 +1,14 @@
 import unittest
 import os
-from data_store import DataStore
+import shutil
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from archive import read_archive, write_archive
+from data_store import (DAY_MS, MAX_CLOCK_SKEW_MS, NO_SEQUENCE, DataStore, MIGRATIONS,
+                        now_ms, parse_cursor, partition_table)
+from helpers import make_row
 
 class TestDataStore(unittest.TestCase):
     """Test suite for the data store functionality."""
@@ -13,9 +21,8 @@ class TestDataStore(unittest.TestCase):
 
     def tearDown(self):
         """Clean up after each test."""
-        # Close the database connection
-        if hasattr(self.store, 'conn'):
-            self.store.conn.close()
+        # Close the database connections
+        self.store.close()
         
         # Remove test database file
         if os.path.exists(self.test_db):
@@ -79,5 +86,378 @@ class TestDataStore(unittest.TestCase):
         with self.assertRaises(Exception):
             self.store.save_data(invalid_data)
 
+    def test_wal_mode_enabled(self):
+        """Test that the database is switched to WAL journaling."""
+        with self.store._read() as cursor:
+            mode = cursor.execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(mode, 'wal', "Database should use WAL journaling")
+
+    def test_reads_do_not_wait_for_writer(self):
+        """Test that readers can query while a write transaction is open."""
+        test_data = {
+            "heart_rate": 70.0,
+            "previous_heart_rate": 68.0,
+            "fall_detected": False,
+            "seizure_detected": False
+        }
+        self.store.save_data(test_data)
+
+        table = partition_table(now_ms() // DAY_MS)
+        result = []
+        with self.store._write() as cursor:
+            cursor.execute(f'DELETE FROM {table}')
+            # The reader sees the last committed snapshot, not the open delete
+            reader = threading.Thread(
+                target=lambda: result.append(self.store.get_historical_data(1)))
+            reader.start()
+            reader.join(timeout=2)
+            self.assertFalse(reader.is_alive(), "Reader should not block on the writer")
+        self.assertEqual(len(result[0]), 1, "Reader should see committed data")
+
+    def test_reader_connections_are_reused(self):
+        """Test that reader connections are returned to the pool."""
+        with self.store._read() as cursor:
+            first = cursor.connection
+        with self.store._read() as cursor:
+            second = cursor.connection
+        self.assertIs(first, second, "Idle reader should be reused")
+
+    def test_queries_use_time_index(self):
+        """Test that history and latest queries are index range scans."""
+        self.store.save_batch([make_row(70.0)])
+        table = partition_table(now_ms() // DAY_MS)
+        with self.store._read() as cursor:
+            history_plan = ' '.join(str(row[-1]) for row in cursor.execute(
+                f'EXPLAIN QUERY PLAN SELECT * FROM {table} '
+                'WHERE ts_ms >= ? ORDER BY ts_ms ASC', (0,)))
+            latest_plan = ' '.join(str(row[-1]) for row in cursor.execute(
+                f'EXPLAIN QUERY PLAN SELECT * FROM {table} '
+                'ORDER BY ts_ms DESC LIMIT 1'))
+        self.assertIn(f'idx_{table}_ts', history_plan)
+        self.assertIn(f'idx_{table}_ts', latest_plan)
+        self.assertNotIn('TEMP B-TREE', history_plan + latest_plan, "Should not sort")
+
+    def test_legacy_database_migration(self):
+        """Test that an old database gets the epoch column backfilled."""
+        self.store.close()
+        os.remove(self.test_db)
+
+        # Build a database with the original schema and local-time timestamps
+        conn = sqlite3.connect(self.test_db)
+        conn.execute('''
+            CREATE TABLE seizure_data (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp DATETIME,
+                heart_rate REAL,
+                previous_heart_rate REAL,
+                fall_detected INTEGER,
+                seizure_detected INTEGER
+            )
+        ''')
+        now = datetime.now()
+        conn.executemany(
+            'INSERT INTO seizure_data (timestamp, heart_rate, previous_heart_rate, '
+            'fall_detected, seizure_detected) VALUES (?, ?, ?, 0, 0)',
+            [(str(now - timedelta(minutes=m)), 60.0 + m, 60.0) for m in (120, 30, 10)])
+        conn.commit()
+        conn.close()
+
+        self.store = DataStore(self.test_db, backfill_chunk_size=2)
+        self.store.wait_for_backfill(timeout=5)
+
+        self.assertEqual(self.store.schema_version(), len(MIGRATIONS))
+        data = self.store.get_historical_data(1)
+        self.assertEqual([row['heart_rate'] for row in data], [90.0, 70.0],
+                         "Window should be based on the real age of each row")
+        self.assertEqual(self.store.get_latest_data()['heart_rate'], 70.0)
+        self.assertEqual(sum(b['count'] for b in self.store.get_history(3, '1m')), 3,
+                         "Backfilled rows should be rolled up")
+        with self.store._read() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM seizure_data')
+            self.assertEqual(cursor.fetchone()[0], 0,
+                             "Legacy rows should be moved into partitions")
+        self.store.save_batch([make_row(50.0)])
+        ids = [row[0] for row in self.store.iter_rows(0)]
+        self.assertEqual(len(set(ids)), 4, "New rows should not reuse legacy ids")
+        # Migrated partitions get the sequence column and its unique index
+        keyed = make_row(55.0, seq=7)
+        self.assertEqual(self.store.save_batch([keyed, keyed]), [keyed])
+
+    def test_prepare_row_uses_device_time(self):
+        """Test that rows keep the bracelet's sample time and sequence number."""
+        reading = {'heart_rate': 80, 'previous_heart_rate': 75, 'fall_detected': False,
+                   'seizure_detected': False, 'client_id': 'b1'}
+        sampled = now_ms() - 60000
+        row = DataStore.prepare_row(dict(reading, ts=sampled, seq=12))
+        self.assertEqual((row[1], row[6], row[7]), (sampled, 'b1', 12))
+        self.assertEqual(DataStore.prepare_row(dict(reading, device_ts=sampled))[7],
+                         NO_SEQUENCE, "A millisecond device time identifies the reading")
+
+        before = now_ms()
+        row = DataStore.prepare_row(dict(reading, ts=before + 2 * MAX_CLOCK_SKEW_MS, seq=1))
+        self.assertGreaterEqual(row[1], before, "A clock far ahead falls back to arrival time")
+        self.assertIsNone(row[7])
+        row = DataStore.prepare_row(dict(reading, timestamp='2024-01-01 12:00:00'))
+        self.assertEqual(row[0], datetime(2024, 1, 1, 12, 0, 0))
+        self.assertIsNone(row[7], "Second precision is too coarse to identify a reading")
+        self.assertIsNone(DataStore.prepare_row(reading)[7])
+
+    def test_duplicate_readings_skipped(self):
+        """Test that redelivered readings are written and rolled up only once."""
+        now = now_ms()
+        first = make_row(70.0, now - 2000, 'b1', seq=1)
+        second = make_row(72.0, now - 1000, 'b1', seq=2)
+        anonymous = make_row(74.0, now - 1000, 'b1')
+        self.assertEqual(self.store.save_batch([first, second]), [first, second])
+        last_id = self.store.last_row_id()
+
+        inserted = self.store.save_batch([second, anonymous, first, anonymous])
+        self.assertEqual(inserted, [anonymous, anonymous],
+                         "Rows without an identity are never deduplicated")
+        self.assertGreater(self.store.last_row_id(), last_id)
+        last_id = self.store.last_row_id()
+        self.assertEqual(self.store.save_batch([first, second]), [])
+        self.assertEqual(self.store.last_row_id(), last_id)
+        self.store.close()
+        self.store = DataStore(self.test_db)
+        self.assertEqual(self.store.last_row_id(), last_id)
+        self.assertEqual(len(self.store.get_historical_data(1, 'b1')), 4)
+        self.assertEqual(sum(b['count'] for b in self.store.get_history(1, '1m', 'b1')), 4)
+
+    def test_late_readings_stored_in_order(self):
+        """Test that readings buffered during a disconnect are read back in sample order."""
+        now = now_ms()
+        self.store.save_batch([make_row(70.0, now - 1000, 'b1', seq=10)])
+        self.store.save_batch([make_row(60.0 + seq, now - 10000 + seq, 'b1', seq=seq)
+                               for seq in range(3)])
+        self.assertEqual([r['heart_rate'] for r in self.store.get_historical_data(1, 'b1')],
+                         [60.0, 61.0, 62.0, 70.0])
+
+    def test_rollups_updated_on_save(self):
+        """Test that minute and hour rollups aggregate saved readings."""
+        for heart_rate, seizure in ((60.0, False), (90.0, True), (75.0, False)):
+            self.store.save_data({
+                "heart_rate": heart_rate,
+                "previous_heart_rate": 70.0,
+                "fall_detected": False,
+                "seizure_detected": seizure
+            })
+
+        for resolution in ('1m', '1h'):
+            buckets = self.store.get_history(1, resolution)
+            self.assertEqual(sum(b['count'] for b in buckets), 3)
+            self.assertEqual(sum(b['seizure_count'] for b in buckets), 1)
+            self.assertEqual(min(b['heart_rate_min'] for b in buckets), 60.0)
+            self.assertEqual(max(b['heart_rate_max'] for b in buckets), 90.0)
+
+        self.store.clear_data()
+        self.assertEqual(self.store.get_history(1, '1h'), [])
+
+    def test_auto_resolution(self):
+        """Test that auto picks the finest resolution within the point budget."""
+        reading = {
+            "heart_rate": 70.0,
+            "previous_heart_rate": 70.0,
+            "fall_detected": False,
+            "seizure_detected": False
+        }
+        self.store.save_batch([self.store.prepare_row(reading) for _ in range(5)])
+
+        self.assertEqual(self.store.resolve_resolution(1, 'auto', max_points=10), 'raw')
+        self.assertEqual(self.store.resolve_resolution(1, 'auto', max_points=4), '1m')
+        self.assertEqual(self.store.resolve_resolution(1, 'auto', max_points=0), '1h')
+        self.assertEqual(self.store.resolve_resolution(1, '1m'), '1m')
+        with self.assertRaises(ValueError):
+            self.store.resolve_resolution(1, '5m')
+
+    def test_keyset_pagination(self):
+        """Test that history pages join up without gaps or repeats."""
+        reading = {
+            "heart_rate": 70.0,
+            "previous_heart_rate": 70.0,
+            "fall_detected": False,
+            "seizure_detected": False
+        }
+        rows = [self.store.prepare_row(dict(reading, heart_rate=float(hr)))
+                for hr in range(25)]
+        self.store.save_batch(rows)
+
+        start = now_ms() - 3600 * 1000
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = self.store.get_history_page(
+                start, parse_cursor(cursor) if cursor else None, limit=10)
+            seen.extend(row['heart_rate'] for row in page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, [float(hr) for hr in range(25)])
+
+        streamed = self.store.iter_historical_data(start)
+        self.assertEqual(next(streamed)['heart_rate'], 0.0, "Should be a lazy generator")
+        self.assertEqual(len(list(streamed)), 24)
+
+    def test_parse_cursor(self):
+        """Test cursor parsing, including bare timestamps."""
+        self.assertEqual(parse_cursor('1700000000000:42'), (1700000000000, 42))
+        self.assertEqual(parse_cursor('1700000000000')[0], 1700000000000)
+        with self.assertRaises(ValueError):
+            parse_cursor('yesterday')
+
+    def test_per_device_queries(self):
+        """Test that readings are stored and queried per device."""
+        for device, heart_rate in (('bracelet-1', 60.0), ('bracelet-2', 90.0),
+                                   ('bracelet-1', 65.0)):
+            self.store.save_data({
+                "heart_rate": heart_rate,
+                "previous_heart_rate": 70.0,
+                "fall_detected": False,
+                "seizure_detected": False,
+                "client_id": device
+            })
+
+        history = self.store.get_historical_data(1, device_id='bracelet-1')
+        self.assertEqual([row['heart_rate'] for row in history], [60.0, 65.0])
+        self.assertEqual(self.store.get_latest_data('bracelet-2')['heart_rate'], 90.0)
+        self.assertEqual(self.store.get_latest_data('bracelet-3'), {})
+        self.assertEqual(self.store.get_latest_data()['device_id'], 'bracelet-1')
+
+        buckets = self.store.get_history(1, '1m', device_id='bracelet-1')
+        self.assertEqual(sum(b['count'] for b in buckets), 2)
+        self.assertEqual(sum(b['count'] for b in self.store.get_history(1, '1m')), 3)
+
+        devices = {d['device_id']: d['reading_count'] for d in self.store.list_devices()}
+        self.assertEqual(devices, {'bracelet-1': 2, 'bracelet-2': 1})
+
+        table = partition_table(now_ms() // DAY_MS)
+        with self.store._read() as cursor:
+            plan = ' '.join(str(row[-1]) for row in cursor.execute(
+                f'EXPLAIN QUERY PLAN SELECT * FROM {table} WHERE device_id = ? '
+                'AND ts_ms >= ? ORDER BY ts_ms ASC, id ASC', ('bracelet-1', 0)))
+        self.assertIn(f'idx_{table}_device_ts', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_readings_partitioned_by_day(self):
+        """Test that readings go to one table per day and are read back in order."""
+        now = now_ms()
+        for days_ago in (2, 1, 0):
+            self.store.save_batch([make_row(60.0 + days_ago, now - days_ago * DAY_MS)])
+        with self.store._read() as cursor:
+            cursor.execute('SELECT table_name FROM partitions ORDER BY day')
+            tables = [row[0] for row in cursor.fetchall()]
+        self.assertEqual(tables, [partition_table((now - d * DAY_MS) // DAY_MS)
+                                  for d in (2, 1, 0)])
+        self.assertEqual([r['heart_rate'] for r in self.store.get_historical_data(72)],
+                         [62.0, 61.0, 60.0])
+        page, cursor = self.store.get_history_page(now - 3 * DAY_MS, limit=2)
+        self.assertEqual(len(page), 2)
+        page, _ = self.store.get_history_page(now - 3 * DAY_MS, parse_cursor(cursor), 2)
+        self.assertEqual([r['heart_rate'] for r in page], [60.0])
+        self.assertEqual(self.store.get_latest_data()['heart_rate'], 60.0)
+
+    def test_rows_committed_since(self):
+        """Test that last_row_id() versions the data and ids= selects the delta."""
+        now = now_ms()
+        self.store.clear_data()
+        first = self.store.last_row_id()
+        self.store.save_batch([make_row(60.0, now - DAY_MS), make_row(61.0, now)])
+        version = self.store.last_row_id()
+        self.assertEqual(version, first + 2)
+        # Late data for yesterday is still newer than the version
+        self.store.save_batch([make_row(62.0, now - DAY_MS + 1, 'b1'), make_row(63.0, now)])
+        latest = self.store.last_row_id()
+        self.assertEqual(latest, version + 2)
+        self.assertEqual(len(self.store.get_historical_data(48)), 4)
+        delta = list(self.store.iter_historical_data(now - 2 * DAY_MS, ids=(version, latest)))
+        self.assertEqual([r['heart_rate'] for r in delta], [62.0, 63.0])
+        delta = list(self.store.iter_historical_data(now - 2 * DAY_MS, device_id='b1',
+                                                     ids=(version, version + 1)))
+        self.assertEqual([r['heart_rate'] for r in delta], [62.0])
+        with DataStore(self.test_db, read_only=True) as reader:
+            self.assertEqual(reader.last_row_id(), latest)
+
+    def test_row_ids_never_move_backwards(self):
+        """Test that last_row_id() survives clearing, expiry of the newest day and a restart."""
+        now = now_ms()
+        self.store.save_batch([make_row(60.0, now - 3 * DAY_MS), make_row(61.0, now - 3 * DAY_MS)])
+        self.store.save_batch([make_row(62.0, now)])
+        version = self.store.last_row_id()
+        self.store.clear_data()
+        self.store.save_batch([make_row(63.0, now - 3 * DAY_MS)])
+        self.store.retention_days = 1
+        self.store.enforce_retention(now)
+        self.assertEqual(self.store.last_row_id(), version + 1)
+        self.store.close()
+        self.store = DataStore(self.test_db)
+        self.assertEqual(self.store.last_row_id(), version + 1)
+        with DataStore(self.test_db, read_only=True) as reader:
+            self.assertEqual(reader.last_row_id(), version + 1)
+        self.store.save_batch([make_row(64.0, now)])
+        self.assertEqual(self.store.last_row_id(), version + 2)
+
+    def test_retention_drops_and_archives_partitions(self):
+        """Test that expired days are archived and dropped as whole tables."""
+        archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_dir)
+        now = now_ms()
+        for days_ago in (5, 4, 0):
+            self.store.save_batch([make_row(60.0 + days_ago, now - days_ago * DAY_MS, 'b1')])
+        self.store.retention_days = 2
+        self.store.archive_dir = archive_dir
+
+        expired = self.store.enforce_retention(now)
+        self.assertEqual(len(expired), 2)
+        with self.store._read() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE name = ?",
+                           (partition_table(expired[0]),))
+            self.assertIsNone(cursor.fetchone(), "Expired partition should be dropped")
+        self.assertEqual(len(os.listdir(archive_dir)), 2)
+
+        # Archived days are still readable
+        self.assertEqual([r['heart_rate'] for r in self.store.get_historical_data(24 * 6)],
+                         [65.0, 64.0, 60.0])
+        self.assertEqual(len(self.store.get_historical_data(24 * 6, device_id='b2')), 0)
+
+        # Readings older than the retention period are no longer accepted
+        self.store.save_batch([make_row(99.0, now - 3 * DAY_MS)])
+        self.assertEqual(len(self.store.get_historical_data(24 * 6)), 3)
+
+        self.store.clear_data()
+        self.assertEqual(os.listdir(archive_dir), [])
+
+    def test_retention_without_archive(self):
+        """Test that expired days are simply dropped when there is no archive."""
+        now = now_ms()
+        self.store.save_batch([make_row(60.0, now - 3 * DAY_MS)])
+        self.store.save_batch([make_row(70.0, now)])
+        self.store.retention_days = 1
+        self.store.rollup_retention_days = 1
+        self.store.enforce_retention(now)
+        self.assertEqual([r['heart_rate'] for r in self.store.get_historical_data(24 * 4)],
+                         [70.0])
+        self.assertEqual(sum(b['count'] for b in self.store.get_history(24 * 4, '1h')), 1,
+                         "Expired rollups should be removed too")
+
+    def test_archive_round_trip(self):
+        """Test that archived rows read back unchanged and can be filtered."""
+        path = os.path.join(tempfile.mkdtemp(), 'day.ssar.gz')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        rows = [(1, 1000, '', 60.0, None, 0, 1, 'a'),
+                (2, 2000, '', 70.0, 60.0, 1, 0, 'b'),
+                (3, 3000, '', 80.0, 70.0, 0, 0, 'a')]
+        self.assertEqual(write_archive(path, rows), 3)
+        read = list(read_archive(path))
+        self.assertEqual([row[:2] + row[3:] for row in read],
+                         [row[:2] + row[3:] for row in rows])
+        self.assertEqual([row[0] for row in read_archive(path, device_id='a')], [1, 3])
+        self.assertEqual([row[0] for row in read_archive(path, after=(1000, 1))], [2, 3])
+
+    def test_close(self):
+        """Test that a closed store rejects further use."""
+        self.store.close()
+        self.store.close()  # closing twice is harmless
+        with self.assertRaises(RuntimeError):
+            self.store.get_latest_data()
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file
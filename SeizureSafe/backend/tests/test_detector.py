@@ -0,0 +1,102 @@
+import unittest
+from detector import SeizureDetector
+from events import EventBroker
+from benchmarks import detector_bench
+from helpers import make_row
+
+class TestSeizureDetector(unittest.TestCase):
+    """Test suite for the streaming seizure detector."""
+
+    def setUp(self):
+        self.detector = SeizureDetector(window_size=20, min_samples=5, jump_bpm=20,
+                                        sustained_samples=3, correlation_ms=10000)
+
+    def feed(self, rates, device_id='a', start=0, falls=()):
+        events = []
+        for i, rate in enumerate(rates):
+            previous = rates[i - 1] if i else rate
+            events.extend(self.detector.process(device_id, start + i * 1000, rate,
+                                                previous, i in falls))
+        return [event['type'] for event in events]
+
+    def test_rolling_baseline(self):
+        """Test that the baseline is the mean and std of the last window."""
+        rates = [60.0 + i % 5 for i in range(50)]
+        self.feed(rates)
+        mean, std = self.detector.baseline('a')
+        window = rates[-20:]
+        expected_mean = sum(window) / len(window)
+        self.assertAlmostEqual(mean, expected_mean)
+        self.assertAlmostEqual(
+            std, (sum((r - expected_mean) ** 2 for r in window) / len(window)) ** 0.5)
+
+    def test_steady_heart_rate_is_quiet(self):
+        """Test that normal variation raises no events."""
+        self.assertEqual(self.feed([65.0 + (i % 3) for i in range(100)]), [])
+
+    def test_sustained_elevation_and_seizure(self):
+        """Test that a jump followed by sustained elevation is a suspected seizure."""
+        types = self.feed([65.0] * 10 + [100.0] * 5 + [65.0] * 5)
+        self.assertEqual(types, ['heart_rate_jump', 'sustained_elevation',
+                                 'seizure_suspected', 'heart_rate_jump'])
+        mean, _ = self.detector.baseline('a')
+        self.assertEqual(mean, 65.0, "Elevated samples should stay out of the baseline")
+
+    def test_slow_rise_is_not_a_seizure(self):
+        """Test that sustained elevation without a jump or fall is only reported as such."""
+        detector = SeizureDetector(min_samples=5, elevated_bpm=130, sustained_samples=3)
+        types = []
+        for i, rate in enumerate([65.0] * 10 + [130.0, 135.0, 140.0]):
+            types += [e['type'] for e in detector.process('a', i * 60000, rate, rate)]
+        self.assertEqual(types, ['sustained_elevation'])
+
+    def test_fall_correlation(self):
+        """Test that a fall right after a heart rate jump is flagged."""
+        types = self.feed([65.0] * 10 + [90.0, 70.0, 65.0], falls={11})
+        self.assertIn('fall_with_heart_rate_change', types)
+        self.assertNotIn('fall_with_heart_rate_change',
+                         self.feed([65.0] * 10, device_id='b', falls={9}))
+
+    def test_devices_are_independent(self):
+        """Test that each device has its own state."""
+        self.feed([65.0] * 10, device_id='a')
+        self.feed([120.0] * 10, device_id='b')
+        self.assertEqual(self.detector.device_count(), 2)
+        self.assertEqual(self.detector.baseline('a')[0], 65.0)
+        self.assertEqual(self.detector.baseline('b')[0], 120.0)
+
+    def test_idle_and_surplus_devices_forgotten(self):
+        """Test that idle devices and the least recently seen beyond max_devices are dropped."""
+        detector = SeizureDetector(max_devices=2, idle_ms=60000)
+        detector.process('a', 0, 65.0)
+        detector.process('b', 1000, 65.0)
+        detector.process('a', 2000, 66.0)
+        detector.process('c', 3000, 65.0)
+        self.assertIsNone(detector.baseline('b'), "b was the least recently seen device")
+        self.assertEqual(detector.device_count(), 2)
+        detector.process('c', 62500, 65.0)
+        self.assertEqual((detector.device_count(), detector.baseline('a')), (1, None),
+                         "a has been silent for over idle_ms")
+        # A late reading from the past evicts nothing
+        detector.process('d', 0, 65.0)
+        self.assertEqual(detector.device_count(), 2)
+
+    def test_process_rows_and_publish(self):
+        """Test that ingested rows produce events on the broker."""
+        rows = [make_row(65.0, i * 1000, 'bracelet-a') for i in range(10)]
+        rows.append(make_row(95.0, 10000, 'bracelet-a', previous=65.0))
+        broker = EventBroker()
+        subscription = broker.subscribe(['bracelet-a'])
+        broker.publish_detections(self.detector.process_rows(rows))
+        _, event_type, data = subscription.get(timeout=1)
+        self.assertEqual(event_type, 'heart_rate_jump')
+        self.assertEqual(data['heart_rate'], 95.0)
+
+    def test_benchmark_runs(self):
+        """Test that the throughput benchmark runs and reports a rate."""
+        result = detector_bench.run(devices=50, samples=10)
+        self.assertEqual(result['samples'], 500)
+        self.assertGreater(result['samples_per_second'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import json
+from unittest import mock
+from app import create_app
+from events import EventBroker, format_sse
+from memory_store import MemoryStore
+from helpers import make_row
+
+class TestEventBroker(unittest.TestCase):
+    """Test suite for the live event fan-out."""
+
+    def test_rows_become_events(self):
+        """Test that alert rows produce an extra seizure/fall event."""
+        broker = EventBroker()
+        subscription = broker.subscribe()
+        broker.publish_rows([make_row(95.0, device_id='bracelet-a', previous=80.0),
+                             make_row(95.0, device_id='bracelet-a', previous=80.0,
+                                      seizure=1, fall=1)])
+
+        types = []
+        while True:
+            event = subscription.get(timeout=0)
+            if event is None:
+                break
+            types.append(event[1])
+        self.assertEqual(types, ['reading', 'reading', 'seizure', 'fall'])
+
+    def test_alerts_published_ahead_of_rows(self):
+        """Test priority-lane alerts and rows that no longer repeat them."""
+        broker = EventBroker()
+        subscription = broker.subscribe()
+        broker.publish_alert({'device_id': 'bracelet-a', 'seizure_detected': True,
+                              'fall_detected': False, 'durable': False})
+        broker.publish_rows([make_row(95.0, device_id='bracelet-a', previous=80.0, seizure=1)],
+                            alerts=False)
+        events = [subscription.get(timeout=0), subscription.get(timeout=0)]
+        self.assertEqual([event[1] for event in events], ['seizure', 'reading'])
+        self.assertFalse(events[0][2]['durable'])
+        self.assertIsNone(subscription.get(timeout=0))
+
+    def test_device_filter(self):
+        """Test that filtered subscribers only see their devices."""
+        broker = EventBroker()
+        everything = broker.subscribe()
+        only_a = broker.subscribe(['bracelet-a'])
+        broker.publish('reading', {}, device='bracelet-a')
+        broker.publish('reading', {}, device='bracelet-b')
+
+        self.assertIsNotNone(only_a.get(timeout=0))
+        self.assertIsNone(only_a.get(timeout=0), "Should not see bracelet-b")
+        self.assertIsNotNone(everything.get(timeout=0))
+        self.assertIsNotNone(everything.get(timeout=0))
+
+        broker.unsubscribe(only_a)
+        broker.unsubscribe(everything)
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    def test_slow_consumer_dropped(self):
+        """Test that a full buffer drops the subscriber instead of growing."""
+        broker = EventBroker()
+        subscription = broker.subscribe(max_events=2)
+        for _ in range(3):
+            broker.publish('reading', {})
+        self.assertTrue(subscription.dropped)
+        self.assertIsNone(subscription.get(timeout=0))
+
+    def test_format_sse(self):
+        """Test the text/event-stream encoding."""
+        self.assertEqual(format_sse((7, 'seizure', {'heart_rate': 95.0})),
+                         'id: 7\nevent: seizure\ndata: {"heart_rate": 95.0}\n\n')
+
+class TestStreamEndpoint(unittest.TestCase):
+    """Test suite for the /api/stream endpoint."""
+
+    def setUp(self):
+        """Set up test environment before each test."""
+        app = create_app(MemoryStore(), ingest_mode='off')
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        self.broker = app.extensions['seizuresafe'].events
+
+    def test_stream_delivers_events_and_heartbeats(self):
+        """Test that the stream sends published events and heartbeats."""
+        with mock.patch('app.SSE_HEARTBEAT_SECONDS', 0.01):
+            response = self.client.get('/api/stream', buffered=False)
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            chunks = response.response
+            self.assertTrue(next(chunks).startswith(b'retry:'))
+            self.assertEqual(next(chunks), b': heartbeat\n\n')
+
+            self.broker.publish_rows([make_row(95.0, device_id='bracelet-a', previous=80.0,
+                                               seizure=1)])
+            reading = next(chunks).decode()
+            self.assertIn('event: reading', reading)
+            self.assertEqual(json.loads(reading.split('data: ')[1])['heart_rate'], 95.0)
+            self.assertIn('event: seizure', next(chunks).decode())
+            response.close()
+        self.assertEqual(self.broker.subscriber_count(), 0, "Closed stream should unsubscribe")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+import unittest
+import os
+import time
+from types import SimpleNamespace
+from data_store import DataStore, now_ms
+from dedupe import RecentKeys
+from ingest import IngestPipeline
+from payload import encode
+from helpers import make_reading
+
+class RecordingStore(DataStore):
+    """DataStore that remembers the size of every batch it writes."""
+
+    def __init__(self, db_path):
+        self.batches = []
+        super().__init__(db_path)
+
+    def save_batch(self, rows):
+        self.batches.append(len(rows))
+        return super().save_batch(rows)
+
+class TestIngestPipeline(unittest.TestCase):
+    """Test suite for the batched ingest pipeline."""
+
+    def setUp(self):
+        """Set up test environment before each test."""
+        self.test_db = 'test_seizure_data.db'
+        self.store = RecordingStore(self.test_db)
+
+    def tearDown(self):
+        """Clean up after each test."""
+        self.store.close()
+        if os.path.exists(self.test_db):
+            try:
+                os.remove(self.test_db)
+            except PermissionError:
+                pass
+
+    def test_flush_by_batch_size(self):
+        """Test that a full batch is written in one transaction."""
+        pipeline = IngestPipeline(self.store, batch_size=50, max_delay=5)
+        for _ in range(50):
+            pipeline.submit(make_reading())
+        pipeline.start()
+        pipeline.stop()
+
+        self.assertEqual(self.store.batches, [50], "Should write one batch of 50")
+        self.assertEqual(len(self.store.get_historical_data(1)), 50)
+
+    def test_commit_metrics(self):
+        """Test that commit time and receipt-to-commit latency are recorded."""
+        pipeline = IngestPipeline(self.store, batch_size=10, max_delay=5)
+        received = time.monotonic() - 0.2
+        for _ in range(10):
+            pipeline.submit(make_reading(), received)
+        pipeline.stop()
+        self.assertEqual(pipeline.commit_seconds.count, 1)
+        self.assertEqual(pipeline.commit_latency.count, 10)
+        self.assertGreaterEqual(pipeline.commit_latency.quantile(0.5), 0.2)
+        names = [metric.name for metric in pipeline.metrics()]
+        self.assertIn('seizuresafe_ingest_queue_depth', names)
+
+    def test_flush_by_deadline(self):
+        """Test that a partial batch is written once max_delay expires."""
+        pipeline = IngestPipeline(self.store, batch_size=500, max_delay=0.02).start()
+        pipeline.submit(make_reading())
+        pipeline.submit(make_reading())
+
+        deadline = time.monotonic() + 2
+        while pipeline.written < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(pipeline.written, 2, "Partial batch should be flushed")
+        pipeline.stop()
+
+    def test_stop_drains_queue(self):
+        """Test that stopping the pipeline writes everything still queued."""
+        pipeline = IngestPipeline(self.store, batch_size=10, max_delay=5)
+        for _ in range(25):
+            pipeline.submit(make_reading())
+        pipeline.stop()
+
+        self.assertEqual(pipeline.written, 25)
+        self.assertEqual(self.store.batches, [10, 10, 5])
+        with self.assertRaises(RuntimeError):
+            pipeline.submit(make_reading())
+
+    def test_drop_backpressure(self):
+        """Test that the drop policies keep the queue bounded."""
+        pipeline = IngestPipeline(self.store, max_queue=3, backpressure='drop')
+        results = [pipeline.submit(make_reading(hr)) for hr in range(60, 65)]
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(pipeline.dropped, 2)
+
+        pipeline = IngestPipeline(self.store, max_queue=3, backpressure='drop_oldest')
+        for hr in range(60, 65):
+            self.assertTrue(pipeline.submit(make_reading(hr)))
+        pipeline.stop()
+        rates = [row['heart_rate'] for row in self.store.get_historical_data(1)]
+        self.assertEqual(rates, [62.0, 63.0, 64.0], "Oldest readings should be dropped")
+
+    def test_priority_rows_bypass_queue(self):
+        """Test that alerts are never dropped and are written without the batching delay."""
+        pipeline = IngestPipeline(self.store, max_queue=2, max_delay=5, backpressure='drop')
+        self.assertTrue(pipeline.submit(make_reading(60)))
+        self.assertTrue(pipeline.submit(make_reading(61)))
+        self.assertFalse(pipeline.submit(make_reading(62)), "Queue should be full")
+        alert = self.store.prepare_row(dict(make_reading(95), seizure_detected=True))
+        self.assertTrue(pipeline.submit_row(alert, priority=True))
+        pipeline.start()
+        deadline = time.monotonic() + 2
+        while pipeline.written < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(pipeline.written, 3, "Alert should not wait for max_delay")
+        self.assertEqual(self.store.batches, [3], "Queued rows go with the alert")
+        self.assertEqual([row['heart_rate'] for row in self.store.get_historical_data(1)],
+                         [60.0, 61.0, 95.0])
+        self.assertEqual(pipeline.priority_commit_latency.count, 1)
+        pipeline.stop()
+
+    def test_priority_write_retried(self):
+        """Test that a failed commit of an alert is retried."""
+        pipeline = IngestPipeline(self.store)
+        save_batch = self.store.save_batch
+        failures = [RuntimeError('disk I/O error')]
+
+        def flaky(rows):
+            if failures:
+                raise failures.pop()
+            return save_batch(rows)
+        self.store.save_batch = flaky
+        alert = self.store.prepare_row(dict(make_reading(95), fall_detected=True))
+        pipeline.submit_row(alert, priority=True)
+        pipeline.start()
+        pipeline.stop()
+        self.assertEqual(pipeline.written, 1)
+        self.assertEqual(pipeline.failed, 0)
+
+    def test_priority_rows_kept_until_written(self):
+        """Test that alerts and the rows queued with them survive repeated
+        failed commits and are written a batch at a time."""
+        pipeline = IngestPipeline(self.store, batch_size=2, max_delay=5)
+        save_batch = self.store.save_batch
+        failures = [RuntimeError('disk I/O error')] * 4
+
+        def flaky(rows):
+            if failures:
+                raise failures.pop()
+            return save_batch(rows)
+        self.store.save_batch = flaky
+        for hr in range(60, 63):
+            pipeline.submit(make_reading(hr))
+        alert = self.store.prepare_row(dict(make_reading(95), seizure_detected=True))
+        pipeline.submit_row(alert, priority=True)
+        pipeline.start()
+        deadline = time.monotonic() + 10
+        while pipeline.written < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        pipeline.stop()
+        self.assertEqual((pipeline.written, pipeline.failed), (4, 0))
+        self.assertEqual(pipeline.retries, 4)
+        self.assertEqual(self.store.batches, [2, 2])
+        self.assertEqual([row['heart_rate'] for row in self.store.get_historical_data(1)],
+                         [60.0, 61.0, 62.0, 95.0])
+
+    def test_duplicates_counted(self):
+        """Test that rows already stored are counted as duplicates, not writes."""
+        pipeline = IngestPipeline(self.store, batch_size=10, max_delay=0.01)
+        delivered = []
+        pipeline.add_listener(delivered.extend)
+        reading = dict(make_reading(), ts=now_ms(), seq=3, client_id='b1')
+        pipeline.start()
+        for _ in range(3):
+            pipeline.submit(reading)
+        pipeline.stop()
+        self.assertEqual((pipeline.written, pipeline.duplicates), (1, 2))
+        self.assertEqual(len(delivered), 1)
+
+    def test_redelivered_messages_dropped(self):
+        """Test that the ingest daemon drops readings it has just seen."""
+        from ingestd import IngestService
+        service = IngestService(self.store)
+        service.pipeline = IngestPipeline(self.store)
+        sampled = now_ms()
+        readings = [dict(make_reading(), ts=sampled + i, seq=i) for i in range(3)]
+        msg = SimpleNamespace(topic='t', payload=encode(readings, 'binary', 'b1'))
+        service.on_message(None, None, msg)
+        service.on_message(None, None, msg)
+        self.assertEqual(service.pipeline.qsize(), 3)
+        self.assertEqual(service.readings_redelivered.value(), 3)
+
+    def test_dropped_reading_resend_accepted(self):
+        """Test that a reading dropped by backpressure is not remembered as seen."""
+        from ingestd import IngestService
+        service = IngestService(self.store)
+        service.pipeline = IngestPipeline(self.store, max_queue=1, backpressure='drop')
+        sampled = now_ms()
+        readings = [dict(make_reading(), ts=sampled + i, seq=i) for i in range(2)]
+        msg = SimpleNamespace(topic='t', payload=encode(readings, 'binary', 'b1'))
+        service.on_message(None, None, msg)
+        self.assertEqual(service.pipeline.dropped, 1)
+        service.pipeline.stop()
+        service.pipeline = IngestPipeline(self.store).start()
+        service.on_message(None, None, msg)
+        service.pipeline.stop()
+        self.assertEqual(service.readings_redelivered.value(), 1)
+        self.assertEqual([row['heart_rate'] for row in self.store.get_historical_data(1)],
+                         [80.0, 80.0])
+
+    def test_recent_keys_window(self):
+        """Test that the dedupe window forgets the least recently seen keys."""
+        recent = RecentKeys(capacity=2)
+        recent.add('a')
+        recent.add('b')
+        self.assertIn('a', recent)
+        recent.add('c')
+        self.assertNotIn('b', recent, "b was the least recently seen key")
+        self.assertIn('a', recent)
+        self.assertEqual(len(recent), 2)
+
+    def test_invalid_data_rejected_on_submit(self):
+        """Test that invalid readings are rejected before they are queued."""
+        pipeline = IngestPipeline(self.store)
+        with self.assertRaises(Exception):
+            pipeline.submit({"heart_rate": "invalid", "fall_detected": "yes"})
+        self.assertEqual(pipeline.qsize(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
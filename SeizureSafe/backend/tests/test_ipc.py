@@ -0,0 +1,123 @@
+import unittest
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+from data_store import DataStore, now_ms
+from events import EventBroker
+from ingest import IngestPipeline
+from ipc import EventPublisher, EventSubscriber
+from ring_buffer import HotCache
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+class TestIngestIPC(unittest.TestCase):
+    """Test suite for the daemon -> API worker live event channel."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.dir, 'ingest.sock')
+        self.test_db = 'test_seizure_data.db'
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        if os.path.exists(self.test_db):
+            try:
+                os.remove(self.test_db)
+            except PermissionError:
+                pass
+
+    def test_publish_and_resubscribe(self):
+        """Test that messages arrive in order and reconnects resync."""
+        received = []
+        connects = []
+        publisher = EventPublisher(self.socket_path)
+        subscriber = EventSubscriber(self.socket_path, received.append,
+                                     on_connect=lambda: connects.append(1),
+                                     retry_seconds=0.05).start()
+        self.assertTrue(subscriber.connected.wait(2))
+        self.assertTrue(wait_for(lambda: publisher.subscriber_count() == 1))
+
+        row = (datetime.now(), now_ms(), 80.0, 75.0, 0, 1, 'bracelet-1')
+        publisher.publish_rows([row])
+        publisher.publish_detections([])  # nothing to send
+        publisher.publish_detections([{'type': 'heart_rate_jump', 'device_id': 'bracelet-1'}])
+        self.assertTrue(wait_for(lambda: len(received) == 2))
+        self.assertEqual(received[0]['rows'][0][2:], [80.0, 75.0, 0, 1, 'bracelet-1'])
+        self.assertEqual(received[1]['type'], 'detections')
+
+        # Daemon restart: the worker reconnects and resyncs
+        publisher.close()
+        publisher = EventPublisher(self.socket_path)
+        self.assertTrue(wait_for(lambda: len(connects) == 2))
+        subscriber.stop(timeout=2)
+        publisher.close()
+
+    def test_worker_follows_ingest(self):
+        """Test a read-only worker store, cache and broker fed by the daemon."""
+        writer = DataStore(self.test_db)
+        pipeline = IngestPipeline(writer, max_delay=0.01)
+        publisher = EventPublisher(self.socket_path)
+        pipeline.add_listener(publisher.publish_rows)
+        pipeline.start()
+
+        reader = DataStore(self.test_db, read_only=True)
+        cache = HotCache()
+        broker = EventBroker()
+        subscription = broker.subscribe()
+
+        def handle(message):
+            cache.add_rows(message['rows'])
+            broker.publish_rows(message['rows'])
+
+        subscriber = EventSubscriber(self.socket_path, handle,
+                                     on_connect=lambda: cache.load(reader)).start()
+        self.assertTrue(subscriber.connected.wait(2))
+        self.assertTrue(wait_for(lambda: publisher.subscriber_count() == 1))
+
+        pipeline.submit({"heart_rate": 91.0, "previous_heart_rate": 70.0,
+                         "fall_detected": False, "seizure_detected": True,
+                         "client_id": "bracelet-9"})
+        _, event_type, data = subscription.get(timeout=2)
+        self.assertEqual((event_type, data['heart_rate']), ('reading', 91.0))
+        self.assertEqual(cache.latest()['heart_rate'], 91.0)
+        self.assertEqual(reader.get_latest_data()['heart_rate'], 91.0)
+
+        with self.assertRaises(RuntimeError):
+            reader.clear_data()
+
+        subscriber.stop(timeout=2)
+        pipeline.stop()
+        publisher.close()
+        reader.close()
+        writer.close()
+
+    def test_read_only_store_requires_migrated_schema(self):
+        """Test that a read-only store refuses a database it cannot read."""
+        sqlite3.connect(self.test_db).close()
+        with self.assertRaises(RuntimeError):
+            DataStore(self.test_db, read_only=True)
+
+    def test_cache_orders_late_rows(self):
+        """Test that the hot cache places late rows in time order and skips copies."""
+        cache = HotCache()
+        cache.load(DataStore(self.test_db))
+        now = now_ms()
+        row = lambda ts, hr: (datetime.fromtimestamp(ts / 1000), ts, hr, hr, 0, 0, 'a')
+        cache.add_rows([row(now, 70.0), row(now - 1000, 60.0), row(now + 1000, 80.0)])
+        # A row that load() picked up too arrives again live
+        cache.add_rows([row(now, 70.0), row(now + 1000, 80.0)])
+        self.assertEqual([r['heart_rate'] for r in cache.history(now - 5000)],
+                         [60.0, 70.0, 80.0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import os
+import importlib
+from loadgen import Bracelet, IngestSink, LocalBroker, LatencyRecorder, run_load
+
+class TestLoadGenerator(unittest.TestCase):
+    """Test suite for the fleet load generator."""
+
+    def setUp(self):
+        self.test_db = 'test_seizure_data.db'
+
+    def tearDown(self):
+        if os.path.exists(self.test_db):
+            try:
+                os.remove(self.test_db)
+            except PermissionError:
+                pass
+
+    def test_bracelet_model(self):
+        """Test that readings stay in range and seizures follow the interval."""
+        bracelet = Bracelet('b1', seizure_interval=20)
+        bracelet.last_seizure_time = 0
+        readings = [bracelet.reading(now=1000 + i) for i in range(41)]
+        seizures = [i for i, r in enumerate(readings) if r['seizure_detected']]
+        self.assertEqual(seizures, [0, 20, 40])
+        for reading in readings:
+            if not reading['seizure_detected']:
+                self.assertTrue(60 <= reading['heart_rate'] <= 70)
+            self.assertEqual(reading['client_id'], 'b1')
+
+    def test_latency_summary(self):
+        """Test the latency percentiles."""
+        recorder = LatencyRecorder()
+        self.assertIsNone(recorder.summary())
+        for latency in range(1, 101):
+            recorder.add(float(latency))
+        summary = recorder.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['p50'], 51.0)
+        self.assertEqual(summary['max'], 100.0)
+
+    def test_local_load_through_ingest(self):
+        """Test a short fleet run through the stand-in broker into the database."""
+        sink = IngestSink(self.test_db, max_delay=0.01)
+        report = run_load(LocalBroker(), 'test/topic', sink, devices=200, rate=10,
+                          duration=0.5, ramp_up=0.1, profile='storm', seed=1)
+        self.assertGreater(report['published'], 200)
+        self.assertEqual(report['publish_errors'], 0)
+        self.assertEqual(report['delivery_latency_ms']['count'], report['published'])
+        self.assertEqual(report['committed'], report['published'])
+        self.assertEqual(report['commit_latency_ms']['count'], report['published'])
+
+    def test_simulators_do_not_connect_on_import(self):
+        """Test that the single-bracelet simulators can be imported safely."""
+        for name in ('mock_bracelet', 'mqtt_test'):
+            module = importlib.import_module(name)
+            self.assertTrue(callable(module.main))
+
+if __name__ == '__main__':
+    unittest.main()
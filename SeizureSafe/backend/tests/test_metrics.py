@@ -0,0 +1,114 @@
+import unittest
+import json
+import urllib.request
+from types import SimpleNamespace
+from unittest import mock
+from metrics import Counter, Gauge, Histogram, Registry, serve
+from payload import encode_binary
+
+class TestMetrics(unittest.TestCase):
+    """Test suite for the metrics registry and its text exposition."""
+
+    def test_exposition_format(self):
+        """Test counters, labels, gauges and histograms in Prometheus text."""
+        registry = Registry()
+        readings = registry.register(Counter('readings_total', 'Readings', ('device',)))
+        readings.inc(labels=('b1',))
+        readings.inc(2, labels=('b"2',))
+        registry.register(Gauge('queue_depth', 'Queue', function=lambda: 7))
+        latency = registry.register(Histogram('latency_seconds', 'Latency', buckets=(0.1, 1)))
+        for value in (0.05, 0.1, 0.5, 3):
+            latency.observe(value)
+
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE readings_total counter', lines)
+        self.assertIn('readings_total{device="b1"} 1', lines)
+        self.assertIn('readings_total{device="b\\"2"} 2', lines)
+        self.assertIn('queue_depth 7', lines)
+        self.assertIn('# TYPE latency_seconds histogram', lines)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{le="1"} 3', lines)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_count 4', lines)
+        self.assertIn('latency_seconds_sum 3.65', lines)
+        self.assertEqual(latency.quantile(0.5), 0.1)
+
+    def test_label_cardinality_is_bounded(self):
+        """Test that label values beyond max_series share the overflow series."""
+        counter = Counter('device_total', 'Per device', ('device',), max_series=2)
+        for device in ('a', 'b', 'c', 'd', 'a'):
+            counter.inc(labels=(device,))
+        self.assertEqual(counter.value(('a',)), 2)
+        self.assertEqual(counter.value(('_other',)), 2)
+        self.assertEqual(len(counter.samples()), 3)
+
+    def test_ingest_service_metrics(self):
+        """Test that on_message counts messages, readings and failures."""
+        from ingestd import IngestService
+        from data_store import DataStore
+        service = IngestService(mock.Mock(prepare_row=DataStore.prepare_row))
+        service.pipeline = mock.Mock()
+        service.pipeline.metrics.return_value = []
+        readings = [{'heart_rate': 70, 'ts': 1700000000000}] * 3
+        service.on_message(None, None, SimpleNamespace(topic='t',
+                                                       payload=encode_binary(readings, 'b1')))
+        service.on_message(None, None, SimpleNamespace(topic='t', payload=b'garbage'))
+        # Readings are counted under device_id when a message carries one
+        reading = {'heart_rate': 70, 'previous_heart_rate': 70, 'fall_detected': False,
+                   'seizure_detected': False, 'device_id': 'b2'}
+        service.on_message(None, None, SimpleNamespace(topic='t',
+                                                       payload=json.dumps(reading).encode()))
+        self.assertEqual(service.messages_received.value(), 3)
+        self.assertEqual(service.messages_failed.value(), 1)
+        self.assertEqual(service.readings_parsed.value(), 4)
+        self.assertEqual(service.device_messages.value(('b1',)), 3)
+        self.assertEqual(service.device_messages.value(('b2',)), 1)
+        self.assertEqual(service.device_messages.value(('',)), 0)
+        self.assertEqual(len(service.metrics()), 15)
+
+    def test_alert_lane(self):
+        """Test that alerts are announced before they are written and timed."""
+        import time
+        from ingestd import ALERT_SLO_MS, IngestService
+        from data_store import DataStore
+        service = IngestService(mock.Mock(prepare_row=DataStore.prepare_row))
+        service.pipeline = mock.Mock()
+        alerts = []
+        service.add_alert_listener(
+            lambda alert: alerts.append((alert, service.pipeline.submit_row.call_count)))
+        now = int(time.time() * 1000)
+        readings = [
+            {'heart_rate': 70, 'previous_heart_rate': 70, 'ts': now - 1},
+            {'heart_rate': 95, 'previous_heart_rate': 70, 'seizure_detected': True, 'ts': now},
+            {'heart_rate': 96, 'previous_heart_rate': 95, 'fall_detected': True,
+             'ts': now - 2 * ALERT_SLO_MS},
+        ]
+        service.on_message(None, None, SimpleNamespace(topic='t',
+                                                       payload=encode_binary(readings, 'b1')))
+        self.assertEqual([submitted for _, submitted in alerts], [1, 2],
+                         "Listeners should run before the alert is queued")
+        self.assertEqual(alerts[0][0]['device_ts'], now)
+        self.assertFalse(alerts[0][0]['durable'])
+        priorities = [call.kwargs.get('priority', False)
+                      for call in service.pipeline.submit_row.call_args_list]
+        self.assertEqual(priorities, [False, True, True])
+        self.assertEqual(service.alerts.value(('seizure',)), 1)
+        self.assertEqual(service.alerts.value(('fall',)), 1)
+        self.assertEqual(service.alert_latency.count, 2)
+        self.assertEqual(service.alert_slo_breaches.value(), 1)
+
+    def test_http_server(self):
+        """Test the standalone /metrics server used by the ingestion daemon."""
+        registry = Registry()
+        registry.register(Counter('up_total', 'Up')).inc()
+        server = serve(registry, 0, host='127.0.0.1')
+        try:
+            port = server.server_address[1]
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics') as response:
+                self.assertIn('up_total 1', response.read().decode())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+if __name__ == '__main__':
+    unittest.main()
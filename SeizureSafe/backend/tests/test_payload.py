@@ -0,0 +1,114 @@
+import unittest
+import os
+import json
+import struct
+import tempfile
+import time
+from types import SimpleNamespace
+from payload import RECORD, decode_binary, decode_payload, encode, encode_binary
+from loadgen import IngestSink, LocalBroker, run_load
+
+class TestPayload(unittest.TestCase):
+    """Test suite for the JSON and binary bracelet payload formats."""
+
+    def setUp(self):
+        self.readings = [
+            {'heart_rate': 72.5, 'previous_heart_rate': 70, 'fall_detected': False,
+             'seizure_detected': False, 'ts': 1700000000000},
+            {'heart_rate': 91, 'previous_heart_rate': 72.5, 'fall_detected': True,
+             'seizure_detected': True, 'ts': 1700000001500},
+            {'heart_rate': 65, 'fall_detected': False, 'ts': 1700000003000},
+        ]
+
+    def test_binary_round_trip(self):
+        """Test that a binary batch decodes back to the encoded readings."""
+        payload = encode_binary(self.readings, 'bracelet-1')
+        self.assertEqual(len(payload), 15 + len('bracelet-1') + 3 * RECORD.size)
+        decoded = decode_payload(payload)
+        self.assertEqual(decoded, [
+            {'client_id': 'bracelet-1', 'heart_rate': 72.5, 'previous_heart_rate': 70.0,
+             'fall_detected': False, 'seizure_detected': False, 'device_ts': 1700000000000},
+            {'client_id': 'bracelet-1', 'heart_rate': 91.0, 'previous_heart_rate': 72.5,
+             'fall_detected': True, 'seizure_detected': True, 'device_ts': 1700000001500},
+            {'client_id': 'bracelet-1', 'heart_rate': 65.0, 'previous_heart_rate': None,
+             'fall_detected': False, 'seizure_detected': False, 'device_ts': 1700000003000},
+        ])
+
+    def test_binary_sequence_numbers(self):
+        """Test that consecutive sequence numbers survive the binary format."""
+        readings = [dict(reading, seq=41 + i) for i, reading in enumerate(self.readings)]
+        payload = encode_binary(readings, 'b1')
+        self.assertEqual(len(payload), 19 + len('b1') + 3 * RECORD.size)
+        self.assertEqual([r['seq'] for r in decode_payload(payload)], [41, 42, 43])
+        self.assertNotIn('seq', decode_payload(encode_binary(self.readings, 'b1'))[0])
+        with self.assertRaises(ValueError):
+            encode_binary([readings[0], readings[2]], 'b1')
+
+    def test_json_autodetect(self):
+        """Test that JSON objects and arrays are still accepted."""
+        reading = {'heart_rate': 80, 'previous_heart_rate': 75, 'client_id': 'b1'}
+        self.assertEqual(decode_payload(json.dumps(reading).encode()), [reading])
+        self.assertEqual(decode_payload(b'\n  ' + json.dumps([reading, reading]).encode()),
+                         [reading, reading])
+        self.assertEqual(decode_payload(encode([reading])), [reading])
+        self.assertEqual(decode_payload(encode([reading, reading])), [reading, reading])
+
+    def test_malformed_binary(self):
+        """Test that corrupt binary payloads are rejected."""
+        payload = encode_binary(self.readings, 'b1')
+        with self.assertRaises(ValueError):
+            decode_binary(payload[:-1])
+        with self.assertRaises(ValueError):
+            decode_binary(b'XX' + payload[2:])
+        with self.assertRaises(ValueError):
+            decode_binary(payload[:2] + struct.pack('B', 9) + payload[3:])
+        with self.assertRaises(ValueError):
+            decode_payload(b'')
+        with self.assertRaises(ValueError):
+            encode_binary([])
+        with self.assertRaises(ValueError):
+            encode([self.readings[0]], 'xml')
+
+    def test_ingest_service_accepts_batches(self):
+        """Test that one binary message stores every reading it carries,
+        including one without a previous heart rate."""
+        from ingestd import IngestService
+        from memory_store import MemoryStore
+        now = int(time.time() * 1000)
+        readings = [dict(reading, ts=now - 3000 + i) for i, reading in enumerate(self.readings)]
+        readings.append({'heart_rate': 150, 'fall_detected': False, 'seizure_detected': True,
+                         'ts': now})
+        store = MemoryStore()
+        service = IngestService(store)
+        service.pipeline.max_delay = 0.01
+        service.pipeline.start()
+        alerts = []
+        service.add_alert_listener(alerts.append)
+        msg = SimpleNamespace(topic='t', payload=encode_binary(readings, 'b1'))
+        service.on_message(None, None, msg)
+        service.on_message(None, None, SimpleNamespace(topic='t', payload=b'SS\x01'))
+        service.pipeline.stop()
+        self.assertEqual(service.readings_rejected.value(), 0)
+        self.assertEqual(service.messages_failed.value(), 1)
+        self.assertEqual([(row[3], row[4], row[6], row[7]) for row in store.iter_rows(0)],
+                         [(72.5, 70.0, 0, 'b1'), (91.0, 72.5, 1, 'b1'),
+                          (65.0, None, 0, 'b1'), (150.0, None, 1, 'b1')])
+        self.assertEqual([(alert['heart_rate'], alert['previous_heart_rate'])
+                          for alert in alerts], [(91.0, 72.5), (150.0, None)])
+        self.assertIsNone(store.get_latest_data('b1')['previous_heart_rate'])
+
+    def test_binary_load_through_ingest(self):
+        """Test a batched binary fleet run into the database."""
+        with tempfile.TemporaryDirectory() as directory:
+            sink = IngestSink(os.path.join(directory, 'load.db'), max_delay=0.01)
+            report = run_load(LocalBroker(), 'test/topic', sink, devices=50, rate=20,
+                              duration=0.5, profile='storm', seed=1,
+                              payload_format='binary', batch=5)
+        self.assertGreater(report['published'], report['messages'])
+        self.assertEqual(report['publish_errors'], 0)
+        self.assertLess(report['bytes_per_reading'], 20)
+        self.assertEqual(report['delivery_latency_ms']['count'], report['published'])
+        self.assertEqual(report['committed'], report['published'])
+
+if __name__ == '__main__':
+    unittest.main()
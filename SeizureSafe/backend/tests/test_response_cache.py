@@ -0,0 +1,39 @@
+import unittest
+from response_cache import ResponseCache
+
+class TestResponseCache(unittest.TestCase):
+    """Test suite for the rendered history response cache."""
+
+    def setUp(self):
+        self.now = 0.0
+        self.cache = ResponseCache(max_entries=2, ttl_seconds=5, clock=lambda: self.now)
+        self.cache.reset(10)
+
+    def test_invalidation_by_device(self):
+        """Test that committed rows drop their device's entries and all-device ones."""
+        self.cache.put(('b1', 1, 'raw', 'json'), b'[]', 'application/json', 10, 0)
+        self.cache.put((None, 1, 'raw', 'json'), b'[]', 'application/json', 10, 0)
+        self.cache.invalidate([('2024-01-01', 0, 70.0, 70.0, 0, 0, 'b2')], 11)
+        self.assertEqual(self.cache.version, 11)
+        self.assertIsNotNone(self.cache.get(('b1', 1, 'raw', 'json')))
+        self.assertIsNone(self.cache.get((None, 1, 'raw', 'json')))
+        self.cache.invalidate([('2024-01-01', 0, 70.0, 70.0, 0, 0, 'b1')], 12)
+        self.assertIsNone(self.cache.get(('b1', 1, 'raw', 'json')))
+
+    def test_stale_puts_are_ignored(self):
+        """Test that a response rendered before the last invalidation is not kept."""
+        self.cache.invalidate([], 11)
+        self.cache.put((None, 1, 'raw', 'json'), b'[]', 'application/json', 10, 0)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_expiry_and_eviction(self):
+        """Test the time to live and the entry limit."""
+        for n in range(3):
+            self.cache.put((None, n, 'raw', 'json'), b'[]', 'application/json', 10, 0)
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get((None, 0, 'raw', 'json')))
+        self.now = 5.0
+        self.assertIsNone(self.cache.get((None, 2, 'raw', 'json')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+import os
+from data_store import DataStore, now_ms
+from ring_buffer import RingBuffer, HotCache, FALL
+from helpers import make_row
+
+class TestRingBuffer(unittest.TestCase):
+    """Test suite for the fixed-size reading buffer."""
+
+    def test_wraps_around(self):
+        """Test that the oldest readings are overwritten once full."""
+        buffer = RingBuffer(3)
+        evicted = [buffer.append(ts, 60.0 + ts, 60.0, 0) for ts in range(1, 6)]
+        self.assertEqual(evicted, [None, None, None, 1, 2])
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual([row[0] for row in buffer.since(0)], [3, 4, 5])
+        self.assertEqual(buffer.latest(), (5, 65.0, 60.0, 0))
+
+    def test_since_binary_search(self):
+        """Test that since() starts at the first reading inside the window."""
+        buffer = RingBuffer(4)
+        for ts in (10, 20, 30, 40, 50, 60):
+            buffer.append(ts, 70.0, 70.0, FALL)
+        self.assertEqual([row[0] for row in buffer.since(35)], [40, 50, 60])
+        self.assertEqual([row[0] for row in buffer.since(61)], [])
+
+    def test_insert_late_readings(self):
+        """Test that late readings are slotted into time order."""
+        buffer = RingBuffer(4)
+        for ts in (10, 30, 40):
+            buffer.append(ts, 70.0, 70.0, 0)
+        self.assertEqual(buffer.insert(20, 71.0, 70.0, 0), (True, None))
+        self.assertEqual(buffer.insert(20, 71.0, 70.0, 0), (False, None),
+                         "An exact copy is not added twice")
+        self.assertEqual(buffer.insert(35, 72.0, 70.0, 0), (True, 10))
+        self.assertEqual([row[0] for row in buffer.since(0)], [20, 30, 35, 40])
+        self.assertEqual(buffer.insert(5, 72.0, 70.0, 0), (False, 5),
+                         "Readings older than a full buffer are not kept")
+        self.assertEqual(buffer.latest(), (40, 70.0, 70.0, 0))
+
+    def test_grows_on_demand(self):
+        """Test that the arrays start small and grow up to the capacity."""
+        buffer = RingBuffer(100)
+        self.assertLess(len(buffer._ts), 100)
+        buffer.append(0, 60.0, 60.0, 0)
+        for ts in range(2, 80):
+            buffer.append(ts, 60.0, 60.0, 0)
+        self.assertEqual(buffer.insert(1, 60.0, 60.0, 0), (True, None))
+        self.assertEqual([row[0] for row in buffer.since(0)], list(range(80)))
+        evicted = [buffer.append(ts, 60.0, 60.0, 0) for ts in range(80, 110)]
+        self.assertEqual(len(buffer._ts), 100)
+        self.assertEqual(evicted[-10:], list(range(10)))
+        self.assertEqual([row[0] for row in buffer.since(0)], list(range(10, 110)))
+
+class TestHotCache(unittest.TestCase):
+    """Test suite for the in-memory hot tier."""
+
+    def setUp(self):
+        """Set up test environment before each test."""
+        self.test_db = 'test_seizure_data.db'
+        self.store = DataStore(self.test_db)
+
+    def tearDown(self):
+        """Clean up after each test."""
+        self.store.close()
+        if os.path.exists(self.test_db):
+            try:
+                os.remove(self.test_db)
+            except PermissionError:
+                pass
+
+    def test_load_from_store(self):
+        """Test that the cache is rebuilt from recent stored readings."""
+        self.store.save_data({
+            "heart_rate": 88.0,
+            "previous_heart_rate": 80.0,
+            "fall_detected": True,
+            "seizure_detected": True
+        })
+        cache = HotCache(window_minutes=60)
+        cache.load(self.store)
+
+        latest = cache.latest()
+        self.assertEqual(latest['heart_rate'], 88.0)
+        self.assertEqual(latest['previous_heart_rate'], 80.0)
+        self.assertTrue(latest['seizure_detected'])
+        self.assertEqual(cache.history(now_ms() - 3600 * 1000),
+                         self.store.get_historical_data(1),
+                         "Cache should answer exactly like the database")
+
+    def test_uncovered_window_falls_back(self):
+        """Test that windows the cache cannot fully answer return None."""
+        cache = HotCache(window_minutes=60, capacity=2)
+        self.assertIsNone(cache.history(now_ms()), "Nothing is covered before load()")
+
+        cache.load(self.store)
+        now = now_ms()
+        cache.add_rows([make_row(ts=now + i, seizure=i == 2) for i in range(3)])
+        self.assertIsNone(cache.history(now - 1000), "Evicted readings are not covered")
+        data = cache.history(now + 1)
+        self.assertEqual(len(data), 2)
+        self.assertTrue(data[-1]['seizure_detected'])
+
+    def test_per_device_buffers(self):
+        """Test that each device gets its own buffer and latest reading."""
+        cache = HotCache(window_minutes=60, capacity=2)
+        cache.load(self.store)
+        now = now_ms()
+        cache.add_rows([make_row(60.0, now + 1, 'a'),
+                        make_row(61.0, now + 2, 'a'),
+                        make_row(90.0, now + 3, 'b')])
+
+        self.assertEqual(cache.latest('a')['heart_rate'], 61.0)
+        self.assertEqual(cache.latest()['device_id'], 'b')
+        self.assertIsNone(cache.latest('c'))
+        self.assertEqual([r['heart_rate'] for r in cache.history(now, 'a')], [60.0, 61.0])
+        self.assertEqual([r['device_id'] for r in cache.history(now)], ['a', 'a', 'b'])
+
+    def test_idle_and_surplus_devices_dropped(self):
+        """Test that idle devices and the least recently seen beyond
+        max_devices are dropped, and their windows no longer covered."""
+        cache = HotCache(window_minutes=60, max_devices=2)
+        cache.load(self.store)
+        now = now_ms()
+        cache.add_rows([make_row(ts=now - 2 * 3600 * 1000, device_id='idle'),
+                        make_row(ts=now - 3000, device_id='a'),
+                        make_row(ts=now - 2000, device_id='b')])
+        self.assertIsNone(cache.latest('idle'))
+        self.assertEqual(cache.latest('a')['device_id'], 'a')
+
+        cache.add_rows([make_row(ts=now - 1000, device_id='c')])
+        self.assertIsNone(cache.latest('a'), "The least recently seen device is dropped")
+        self.assertIsNone(cache.history(now - 3000))
+        self.assertEqual([r['device_id'] for r in cache.history(now - 2999)], ['b', 'c'])
+
+if __name__ == '__main__':
+    unittest.main()
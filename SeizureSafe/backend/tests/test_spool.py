@@ -0,0 +1,166 @@
+import unittest
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+from data_store import MAX_DEVICE_ID_LENGTH, DataStore, now_ms
+from ingest import IngestPipeline, _spool_record, _spooled_item
+from spool import MAGIC, RECORD, Spool, SpoolFull
+from helpers import make_reading
+
+class TestSpool(unittest.TestCase):
+    """Test suite for the memory-mapped ingest spool."""
+
+    def setUp(self):
+        """Set up test environment before each test."""
+        self.directory = tempfile.mkdtemp()
+        self.test_db = 'test_seizure_data.db'
+
+    def tearDown(self):
+        """Clean up after each test."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+        if os.path.exists(self.test_db):
+            try:
+                os.remove(self.test_db)
+            except PermissionError:
+                pass
+
+    def test_records_survive_reopen(self):
+        """Test that uncommitted records are handed out again after a restart."""
+        spool = Spool(self.directory, segment_bytes=64)
+        for i in range(10):
+            spool.append(b'record-%d' % i)
+        records, position = spool.read(4)
+        self.assertEqual(records, [b'record-0', b'record-1', b'record-2', b'record-3'])
+        spool.commit(position, len(records))
+        records, _ = spool.read(2)
+        spool.rewind()
+        self.assertEqual(spool.read(2)[0], records, "Rewind starts over at the checkpoint")
+        spool.close()
+
+        spool = Spool(self.directory, segment_bytes=64)
+        self.assertEqual(spool.pending(), 6)
+        self.assertEqual(spool.read(100)[0], [b'record-%d' % i for i in range(4, 10)])
+        spool.close()
+
+    def test_row_round_trip(self):
+        """Test that a spooled row reads back unchanged, an unknown previous heart rate included."""
+        row = DataStore.prepare_row(make_reading(previous=None, client_id='b1', ts=now_ms(), seq=3))
+        spooled, _, priority = _spooled_item(_spool_record(row, time.monotonic(), True))
+        self.assertEqual((spooled, priority), (row, True))
+        # The longest device id allowed, in characters, of 3-byte characters
+        row = DataStore.prepare_row(make_reading(client_id='\u20ac' * MAX_DEVICE_ID_LENGTH))
+        self.assertEqual(_spooled_item(_spool_record(row, time.monotonic(), False))[0], row)
+
+    def test_torn_record_discarded(self):
+        """Test that a record half written at a crash is dropped on recovery."""
+        spool = Spool(self.directory)
+        spool.append(b'complete')
+        spool.append(b'torn record')
+        segment, offset = spool._write
+        spool.close()
+        with open(os.path.join(self.directory, f'{segment:016d}.seg'), 'r+b') as f:
+            f.seek(offset - 4)
+            f.write(b'\0\0\0\0')
+
+        spool = Spool(self.directory)
+        self.assertEqual(spool.read(10)[0], [b'complete'])
+        spool.append(b'next')
+        self.assertEqual(spool.read(10)[0], [b'next'])
+        spool.close()
+
+    def test_bounded_disk_use(self):
+        """Test that appends fail once max_bytes of segments are in use."""
+        record = b'x' * 20
+        segment_bytes = len(MAGIC) + 2 * (RECORD.size + len(record))
+        spool = Spool(self.directory, segment_bytes=segment_bytes, max_bytes=2 * segment_bytes)
+        for _ in range(4):
+            spool.append(record)
+        with self.assertRaises(SpoolFull):
+            spool.append(record)
+        spool.append(record, force=True)
+
+        records, position = spool.read(4)
+        spool.commit(position, len(records))
+        self.assertEqual(len(os.listdir(self.directory)) - 1, 2,
+                         "Committed segments are deleted")
+        spool.append(record)
+        self.assertEqual(spool.pending(), 2)
+        spool.close()
+
+    def test_stalled_database(self):
+        """Test that readings outlive failed writes and are written once the database recovers."""
+        store = DataStore(self.test_db)
+        save_batch = store.save_batch
+        failures = [RuntimeError('database is locked')] * 2
+
+        def locked(rows):
+            if failures:
+                raise failures.pop()
+            return save_batch(rows)
+        store.save_batch = locked
+        pipeline = IngestPipeline(store, batch_size=50, max_delay=0.01,
+                                  spool=Spool(self.directory))
+        pipeline.start()
+        now = now_ms()
+        for i in range(100):
+            self.assertTrue(pipeline.submit(make_reading(60.0 + i % 10, client_id='bracelet-1',
+                                                         ts=now - 1000 + i, seq=i)))
+        deadline = time.monotonic() + 5
+        while pipeline.qsize() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        pipeline.stop()
+        self.assertEqual((pipeline.written, pipeline.failed, pipeline.retries), (100, 0, 2))
+        self.assertEqual(pipeline.spool.pending(), 0)
+        self.assertEqual(len(store.get_historical_data(1, 'bracelet-1')), 100)
+        pipeline.spool.close()
+        store.close()
+
+    def test_crash_recovery(self):
+        """Test that readings spooled by a process that crashed are written after restart."""
+        script = textwrap.dedent(f'''
+            import os, sys
+            sys.path[:0] = [{os.getcwd()!r}, {os.path.join(os.getcwd(), 'tests')!r}]
+            from ingest import IngestPipeline
+            from spool import Spool
+            from helpers import make_reading
+
+            class StalledStore:
+                def prepare_row(self, data):
+                    from data_store import DataStore
+                    return DataStore.prepare_row(data)
+
+                def save_batch(self, rows):
+                    raise RuntimeError('database is locked')
+
+            pipeline = IngestPipeline(StalledStore(), spool=Spool({self.directory!r}))
+            pipeline.start()
+            for i in range(200):
+                pipeline.submit(make_reading(70.0, client_id='bracelet-1',
+                                             ts={now_ms() - 5000} + i, seq=i))
+            os._exit(9)
+        ''')
+        result = subprocess.run([sys.executable, '-c', script], capture_output=True)
+        self.assertEqual(result.returncode, 9, result.stderr.decode())
+
+        store = DataStore(self.test_db)
+        pipeline = IngestPipeline(store, spool=Spool(self.directory))
+        self.assertEqual(pipeline.qsize(), 200)
+        pipeline.start()
+        pipeline.stop()
+        self.assertEqual(pipeline.written, 200)
+        data = store.get_historical_data(1, 'bracelet-1')
+        self.assertEqual([row['heart_rate'] for row in data], [70.0] * 200)
+
+        # The checkpoint has moved past every replayed reading
+        pipeline.spool.close()
+        pipeline = IngestPipeline(store, spool=Spool(self.directory))
+        self.assertEqual(pipeline.qsize(), 0)
+        pipeline.spool.close()
+        store.close()
+
+if __name__ == '__main__':
+    unittest.main()
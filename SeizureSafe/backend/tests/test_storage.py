@@ -0,0 +1,207 @@
+import unittest
+import json
+from unittest import mock
+import os
+from datetime import datetime
+import numpy as np
+from app import create_app
+from data_store import DAY_MS, DataStore, StorageBackend, format_cursor, now_ms
+from memory_store import MemoryStore
+from waveforms import encode_chunk, read_waveform
+from helpers import make_row
+
+class StorageContract:
+    """Behaviour every StorageBackend must share, run against each one."""
+
+    def make_store(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        """Set up test environment before each test."""
+        self.store = self.make_store()
+        self.now = now_ms()
+
+    def tearDown(self):
+        """Clean up after each test."""
+        self.store.close()
+
+    def heart_rates(self, **kwargs):
+        return [row[3] for row in self.store.iter_rows(self.now - DAY_MS, **kwargs)]
+
+    def test_save_and_range_query(self):
+        """Test that readings come back in time order, late ones included."""
+        inserted = self.store.save_batch([make_row(2.0, self.now - 2000),
+                                          make_row(1.0, self.now - 3000)])
+        self.assertEqual(len(inserted), 2)
+        self.store.save_batch([make_row(4.0, self.now)])
+        self.store.save_batch([make_row(3.0, self.now - 1000)])
+        self.assertEqual(self.heart_rates(), [1.0, 2.0, 3.0, 4.0])
+        self.assertEqual([row[3] for row in self.store.iter_rows(self.now - 1500)], [3.0, 4.0])
+        self.assertEqual(self.heart_rates(limit=2), [1.0, 2.0])
+        self.assertEqual(self.store.last_row_id(), 4)
+
+        page, cursor = self.store.get_history_page(self.now - DAY_MS, limit=3)
+        self.assertEqual([row['heart_rate'] for row in page], [1.0, 2.0, 3.0])
+        rows = list(self.store.iter_rows(self.now - DAY_MS))
+        self.assertEqual(cursor, format_cursor(rows[2][1], rows[2][0]))
+        self.assertEqual(self.heart_rates(after=(rows[2][1], rows[2][0])), [4.0])
+        self.assertEqual(self.heart_rates(ids=(2, 4)), [3.0, 4.0])
+        self.assertEqual(rows[0][2], str(datetime.fromtimestamp((self.now - 3000) / 1000)))
+
+    def test_duplicates_skipped(self):
+        """Test that a reading with a stored (device_id, ts_ms, seq) is skipped."""
+        row = make_row(70.0, self.now, 'b1', seq=5)
+        self.assertEqual(len(self.store.save_batch([row, row])), 1)
+        version = self.store.last_row_id()
+        self.assertEqual(self.store.save_batch([row]), [])
+        self.assertEqual(self.store.last_row_id(), version,
+                         "A batch of duplicates leaves the version alone")
+        self.assertEqual(len(self.store.save_batch([make_row(70.0, self.now, 'b1')] * 2)), 2)
+        self.assertEqual(len(self.heart_rates()), 3)
+
+    def test_unknown_previous_heart_rate(self):
+        """Test that a reading without a previous heart rate is stored as NULL."""
+        row = StorageBackend.prepare_row({'heart_rate': 65.0, 'previous_heart_rate': None,
+                                          'fall_detected': False, 'seizure_detected': True,
+                                          'client_id': 'b1', 'device_ts': self.now})
+        self.assertEqual(len(self.store.save_batch([row])), 1)
+        self.assertEqual([row[4] for row in self.store.iter_rows(0)], [None])
+        self.assertIsNone(self.store.get_latest_data('b1')['previous_heart_rate'])
+
+    def test_devices_and_latest(self):
+        """Test per-device queries, the latest reading and the device list."""
+        self.store.save_batch([make_row(60.0, self.now - 1000, 'b1'),
+                               make_row(80.0, self.now - 500, 'b2', seizure=1),
+                               make_row(61.0, self.now - 2000, 'b1'),
+                               make_row(50.0, self.now - 100)])
+        self.assertEqual(self.heart_rates(device_id='b1'), [61.0, 60.0])
+        self.assertEqual(self.heart_rates(device_id='b3'), [])
+        self.assertEqual(self.store.get_latest_data()['heart_rate'], 50.0)
+        latest = self.store.get_latest_data('b2')
+        self.assertEqual((latest['device_id'], latest['heart_rate'], latest['seizure_detected']),
+                         ('b2', 80.0, True))
+        self.assertEqual(self.store.get_latest_data('b1')['heart_rate'], 60.0)
+        self.assertEqual(self.store.get_latest_data('b3'), {})
+        self.assertEqual([(device['device_id'], device['reading_count'])
+                          for device in self.store.list_devices()], [('b1', 2), ('b2', 1)])
+
+    def test_rollups_and_resolution(self):
+        """Test that rollups aggregate each bucket and 'auto' fits the point budget."""
+        minute = self.now - self.now % 60000
+        self.store.save_batch([make_row(60.0, minute - 60000, 'b1'),
+                               make_row(70.0, minute, 'b1', fall=1),
+                               make_row(90.0, minute + 1, 'b2', seizure=1)])
+        buckets = self.store.get_rollup_data(1, '1m')
+        self.assertEqual([(bucket['count'], bucket['heart_rate']) for bucket in buckets],
+                         [(1, 60.0), (2, 80.0)])
+        last = buckets[-1]
+        self.assertEqual((last['heart_rate_min'], last['heart_rate_max'], last['fall_count'],
+                          last['seizure_count']), (70.0, 90.0, 1, 1))
+        by_device = self.store.get_rollup_data(1, '1m', 'b1')
+        self.assertEqual([bucket['count'] for bucket in by_device], [1, 1])
+        self.assertEqual(self.store.resolve_resolution(1, 'auto', max_points=3), 'raw')
+        self.assertEqual(self.store.resolve_resolution(1, 'auto', max_points=2), '1m')
+        self.assertEqual(self.store.resolve_resolution(1, 'auto', max_points=2,
+                                                       device_id='b2'), 'raw')
+
+    def test_retention_and_clear(self):
+        """Test that whole expired days are purged and clear_data() purges everything."""
+        old = self.now - 10 * DAY_MS
+        self.store.save_batch([make_row(1.0, old, 'b1', seq=1), make_row(2.0, self.now, 'b1')])
+        self.store.retention_days = 7
+        self.assertEqual(self.store.enforce_retention(self.now), [old // DAY_MS])
+        self.assertEqual([row[3] for row in self.store.iter_rows(0)], [2.0])
+        self.assertEqual(self.store.save_batch([make_row(1.0, old, 'b1', seq=1)]), [],
+                         "Readings past retention are not stored")
+
+        version = self.store.last_row_id()
+        self.store.clear_data()
+        self.assertEqual(self.store.last_row_id(), version, "Versions never move backwards")
+        self.assertEqual(list(self.store.iter_rows(0)), [])
+        self.assertEqual(self.store.get_latest_data(), {})
+        self.assertEqual(self.store.list_devices(), [])
+
+    def test_waveform_chunks(self):
+        """Test that waveform chunks are stored once and read back by window."""
+        samples = np.arange(100, dtype='<i2')
+        chunks = [('b1', 'ppg', start, start + 1000, 100.0, 100, *encode_chunk(samples))
+                  for start in (self.now - 1000, self.now - 2000)]
+        self.assertEqual(self.store.save_waveform_chunks(chunks), 2)
+        self.assertEqual(self.store.save_waveform_chunks(chunks[:1]), 0)
+        self.assertEqual(self.store.list_waveform_channels('b1'), ['ppg'])
+        self.assertEqual(self.store.list_waveform_channels('b2'), [])
+        waveform = read_waveform(self.store, 'b1', 'ppg', self.now - 1500, self.now)
+        np.testing.assert_array_equal(waveform.samples,
+                                      np.concatenate([samples[50:], samples]))
+
+class TestStorageBackend(unittest.TestCase):
+    """Test suite for the StorageBackend base class."""
+
+    def test_primitives_required(self):
+        """Test that a backend missing a primitive cannot be created."""
+        class Partial(StorageBackend):
+            def save_batch(self, rows):
+                return rows
+        with self.assertRaises(TypeError):
+            Partial()
+
+    def test_create_store(self):
+        """Test that STORAGE_BACKEND picks the backend create_store() opens."""
+        import storage
+        with mock.patch('storage.STORAGE_BACKEND', 'memory'):
+            store = storage.create_store()
+        self.assertIsInstance(store, MemoryStore)
+        store.close()
+        with mock.patch('storage.STORAGE_BACKEND', 'cassandra'):
+            with self.assertRaises(ValueError):
+                storage.create_store()
+
+class TestDataStoreContract(StorageContract, unittest.TestCase):
+    """Test suite for the storage contract on the SQLite backend."""
+
+    def make_store(self):
+        self.test_db = 'test_seizure_data.db'
+        return DataStore(self.test_db)
+
+    def tearDown(self):
+        """Clean up after each test."""
+        super().tearDown()
+        if os.path.exists(self.test_db):
+            try:
+                os.remove(self.test_db)
+            except PermissionError:
+                pass
+
+class TestMemoryStoreContract(StorageContract, unittest.TestCase):
+    """Test suite for the storage contract on the in-memory backend."""
+
+    def make_store(self):
+        return MemoryStore()
+
+    def test_snapshot_survives_merge(self):
+        """Test that a reader keeps its view while late readings are merged in."""
+        for ts in range(self.now - 5000, self.now):
+            self.store.save_batch([make_row(1.0, ts)])
+        rows = self.store.iter_rows(self.now - DAY_MS)
+        first = next(rows)
+        self.store.save_batch([make_row(2.0, self.now - 10000)])
+        self.assertEqual(1 + sum(1 for _ in rows), 5000)
+        self.assertEqual(first[1], self.now - 5000)
+        self.assertEqual(len(self.heart_rates()), 5001)
+
+    def test_app_factory(self):
+        """Test that the API serves a MemoryStore like any other backend."""
+        self.store.save_batch([make_row(77.0, self.now - 1000, 'b1')])
+        app = create_app(self.store, ingest_mode='off')
+        app.config['TESTING'] = True
+        client = app.test_client()
+        self.assertEqual(json.loads(client.get('/api/latest').data)['heart_rate'], 77.0)
+        self.assertEqual([row['heart_rate'] for row in
+                          json.loads(client.get('/api/devices/b1/history/1').data)], [77.0])
+        response = client.get('/api/history/1?resolution=1m')
+        self.assertEqual(json.loads(response.data)[0]['count'], 1)
+        with self.assertRaises(ValueError):
+            create_app(self.store, ingest_mode='sideways')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+from app import create_app
+from data_store import DataStore
+
+class TestTracing(unittest.TestCase):
+    """Test suite for request tracing, the slow query log and the profiler."""
+
+    def setUp(self):
+        """Set up test environment before each test."""
+        # Query timing and the slow query log are the SQLite backend's
+        self.directory = tempfile.mkdtemp()
+        self.store = DataStore(os.path.join(self.directory, 'tracing.db'), slow_query_ms=0)
+        app = create_app(self.store, ingest_mode='off')
+        app.config['TESTING'] = True
+        self.services = app.extensions['seizuresafe']
+        self.services.cache = None
+        self.services.responses = None
+        self.tracer = self.services.tracer
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Clean up after each test."""
+        self.store.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def save_readings(self, count):
+        for i in range(count):
+            self.store.save_data({'heart_rate': 60.0 + i % 40, 'previous_heart_rate': 60.0,
+                                  'fall_detected': False, 'seizure_detected': False})
+
+    def test_request_split(self):
+        """Test that a streamed history request is timed to its last row and split."""
+        self.save_readings(50)
+        with mock.patch.object(self.tracer, '_finish',
+                               wraps=self.tracer._finish) as finish:
+            response = self.client.get('/api/history/1')
+            self.assertEqual(len(json.loads(response.data)), 50)
+            response.close()
+        self.assertIn('db;dur=', response.headers['Server-Timing'])
+
+        trace = finish.call_args[0][0]
+        self.assertEqual((trace.method, trace.route, trace.status),
+                         ('GET', '/api/history/<int:hours>', 200))
+        self.assertGreaterEqual(trace.queries, 2)
+        self.assertGreater(trace.db, 0)
+        self.assertGreater(trace.serialize, 0)
+        self.assertGreaterEqual(trace.total, trace.db + trace.serialize)
+
+    def test_slow_query_log(self):
+        """Test that slow statements are kept with their row count and query plan."""
+        self.save_readings(3)
+        self.store.slow_queries.clear()
+        response = self.client.get('/api/history/1')
+        self.assertEqual(len(json.loads(response.data)), 3)
+        response.close()
+
+        scans = [entry for entry in self.store.slow_queries
+                 if entry['sql'].startswith('SELECT id, ts_ms') and 'seizure_data_' in entry['sql']]
+        self.assertEqual(len(scans), 1)
+        self.assertEqual(scans[0]['rows'], 3)
+        self.assertEqual(scans[0]['request'], 'GET /api/history/<int:hours>')
+        self.assertTrue(any('ts_ms' in detail for detail in scans[0]['plan']), scans[0]['plan'])
+        self.assertEqual(len(scans[0]['params']), scans[0]['sql'].count('?'))
+
+        self.store.slow_queries.clear()
+        self.save_readings(1)
+        inserts = [entry for entry in self.store.slow_queries if entry['sql'].startswith('INSERT')]
+        self.assertEqual(inserts[0]['rows'], 1)
+        self.assertIsNone(inserts[0]['request'])
+
+    def test_admin_routes_require_token(self):
+        """Test that the admin routes are refused without the admin token."""
+        self.assertEqual(self.client.get('/api/admin/slow-queries').status_code, 403)
+        with mock.patch('app.ADMIN_TOKEN', 'secret'):
+            response = self.client.get('/api/admin/slow-queries',
+                                       headers={'Authorization': 'Bearer wrong'})
+            self.assertEqual(response.status_code, 403)
+            response = self.client.get('/api/admin/slow-queries',
+                                       headers={'Authorization': 'Bearer secret'})
+            self.assertEqual(response.status_code, 200)
+            self.assertIsInstance(json.loads(response.data), list)
+
+    def test_profiler_samples_live_requests(self):
+        """Test that a profile aggregates the stacks of requests served while it runs."""
+        def slow_devices():
+            time.sleep(0.3)
+            return []
+        headers = {'Authorization': 'Bearer secret'}
+        with mock.patch('app.ADMIN_TOKEN', 'secret'), \
+                mock.patch.object(self.store, 'list_devices', slow_devices):
+            response = self.client.post('/api/admin/profile?seconds=0.5&interval_ms=2',
+                                        headers=headers)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(self.client.post('/api/admin/profile',
+                                              headers=headers).status_code, 409)
+            self.client.get('/api/devices')
+            self.tracer.profiler.wait()
+            report = json.loads(self.client.get('/api/admin/profile', headers=headers).data)
+
+        self.assertFalse(report['running'])
+        self.assertGreater(report['samples'], 10)
+        top = report['stacks'][0]
+        self.assertTrue(top['stack'].startswith('GET /api/devices;'), top)
+        self.assertTrue(top['stack'].endswith('test_tracing.py:slow_devices'), top)
+        self.assertEqual(report['functions'][0]['function'], 'test_tracing.py:slow_devices')
+
+if __name__ == '__main__':
+    unittest.main()
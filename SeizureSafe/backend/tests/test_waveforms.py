@@ -0,0 +1,153 @@
+import unittest
+import json
+import os
+from types import SimpleNamespace
+import numpy as np
+from data_store import DAY_MS, DataStore, now_ms
+from waveforms import WaveformWriter, decode_chunk, encode_chunk, read_waveform
+
+START = 1700000000000
+
+class TestWaveforms(unittest.TestCase):
+    """Test suite for chunked storage of raw sensor samples."""
+
+    def setUp(self):
+        """Set up test environment before each test."""
+        self.test_db = 'test_seizure_data.db'
+        self.store = DataStore(self.test_db)
+
+    def tearDown(self):
+        """Clean up after each test."""
+        self.store.close()
+        if os.path.exists(self.test_db):
+            try:
+                os.remove(self.test_db)
+            except PermissionError:
+                pass
+
+    def test_codec_round_trip(self):
+        """Test that chunks decode to exactly the samples encoded."""
+        ppg = np.array([32767, -32768, 0, 12, -7], dtype='<i2')
+        accel = np.random.default_rng(0).normal(size=(100, 3)).astype('<f4')
+        for samples in (ppg, accel, np.arange(1000, dtype='<i4') * 3):
+            dtype, width, codec, data = encode_chunk(samples)
+            decoded = decode_chunk(dtype, width, codec, data)
+            self.assertEqual(decoded.dtype, samples.dtype)
+            np.testing.assert_array_equal(decoded, samples)
+        self.assertEqual(encode_chunk(accel)[1:3], (3, 'zlib'))
+        self.assertEqual(encode_chunk(ppg)[2], 'delta+zlib')
+
+    def test_chunked_and_read_back(self):
+        """Test that one-second messages become fixed-length chunks and read back exactly."""
+        writer = WaveformWriter(self.store, chunk_ms=10000)
+        signal = (np.arange(25 * 50) % 300).astype('<i2')
+        for second in range(25):
+            writer.add_samples('b1', 'ppg', START + second * 1000, 50.0,
+                               signal[second * 50:(second + 1) * 50])
+        writer.stop()
+
+        chunks = list(self.store.iter_waveform_chunks('b1', 'ppg', START, START + 25000))
+        self.assertEqual([(chunk[0], chunk[1], chunk[3]) for chunk in chunks],
+                         [(START, START + 10000, 500), (START + 10000, START + 20000, 500),
+                          (START + 20000, START + 25000, 250)])
+        self.assertEqual(writer.chunks_written.value(), 3)
+
+        waveform = read_waveform(self.store, 'b1', 'ppg', START + 9500, START + 10500)
+        np.testing.assert_array_equal(waveform.samples, signal[475:525])
+        np.testing.assert_array_equal(waveform.ts, START + 9500 + np.arange(50) * 20.0)
+        self.assertEqual(len(read_waveform(self.store, 'b1', 'ppg', START, START + 30000)),
+                         1250)
+        self.assertEqual(self.store.list_waveform_channels('b1'), ['ppg'])
+
+    def test_redelivery_and_gaps(self):
+        """Test that repeated samples are dropped and a gap starts a new chunk."""
+        writer = WaveformWriter(self.store, chunk_ms=10000)
+        samples = np.arange(100, dtype='<f4')
+        writer.add_samples('b1', 'accel', START, 25.0, samples[:50])
+        writer.add_samples('b1', 'accel', START, 25.0, samples[:50])
+        writer.add_samples('b1', 'accel', START + 1000, 25.0, samples[25:75])
+        writer.add_samples('b1', 'accel', START + 10000, 25.0, samples[:10])
+        writer.stop()
+        self.assertEqual(writer.samples_duplicate.value(), 75)
+
+        chunks = list(self.store.iter_waveform_chunks('b1', 'accel', START, START + 20000))
+        self.assertEqual([(chunk[0], chunk[3]) for chunk in chunks],
+                         [(START, 75), (START + 10000, 10)])
+        waveform = read_waveform(self.store, 'b1', 'accel', START, START + 20000)
+        np.testing.assert_array_equal(waveform.samples,
+                                      np.concatenate([samples[:75], samples[:10]]))
+
+        # A second writer, e.g. after a restart, cannot store a chunk twice
+        writer = WaveformWriter(self.store, chunk_ms=10000)
+        writer.add_samples('b1', 'accel', START + 10000, 25.0, samples[:10])
+        writer.stop()
+        self.assertEqual(writer.chunks_written.value(), 0)
+
+    def test_invalid_waveforms_rejected(self):
+        """Test that malformed waveform objects are rejected as a whole."""
+        writer = WaveformWriter(self.store)
+        ok = {'ts': START, 'rate': 50, 'samples': [1, 2, 3], 'dtype': 'int16'}
+        for waveforms in ({'PPG!': ok}, {'ppg': dict(ok, rate=0)},
+                          {'ppg': dict(ok, dtype='float64')}, {'ppg': dict(ok, samples=[])},
+                          {'ppg': dict(ok, samples=[70000])},
+                          {'ppg': dict(ok, ts=now_ms() + DAY_MS)},
+                          {'ppg': ok, 'accel': {'ts': START}}, {'ppg': [1, 2, 3]},
+                          {'ppg': ok, 'accel': None}, [ok]):
+            with self.assertRaises(ValueError):
+                writer.add('b1', waveforms)
+        self.assertEqual(writer.samples_received.value(), 0)
+        self.assertEqual(writer.rejected.value(), 10)
+
+    def test_retention(self):
+        """Test that waveform chunks expire with the raw readings."""
+        self.store.retention_days = 7
+        now = now_ms()
+        writer = WaveformWriter(self.store, chunk_ms=1000)
+        for start in (now - 10 * DAY_MS, now - DAY_MS):
+            writer.add_samples('b1', 'ppg', start, 10.0, np.ones(10, dtype='<i2'))
+        writer.stop()
+        self.assertEqual(writer.chunks_written.value(), 1, "Expired chunks are not written")
+
+        self.store.retention_days = None
+        self.store.save_waveform_chunks([('b1', 'ppg', now - 9 * DAY_MS, now - 9 * DAY_MS + 100,
+                                          10.0, 1, *encode_chunk(np.ones(1, dtype='<i2')))])
+        self.store.retention_days = 7
+        self.store.enforce_retention(now)
+        self.assertEqual(len(read_waveform(self.store, 'b1', 'ppg', now - 30 * DAY_MS, now)), 10)
+
+    def test_ingest_service(self):
+        """Test that the ingest daemon stores waveforms alongside readings."""
+        from ingestd import IngestService
+        service = IngestService(self.store)
+        service.waveforms.start()
+        ts = now_ms() - 2000
+        messages = [
+            {'client_id': 'b1', 'heart_rate': 72.0, 'previous_heart_rate': 70.0,
+             'fall_detected': False, 'seizure_detected': False, 'ts': ts, 'seq': 1,
+             'waveforms': {'ppg': {'ts': ts, 'rate': 50, 'dtype': 'int16',
+                                   'samples': list(range(50))}}},
+            {'client_id': 'b1', 'waveforms': {'accel': {'ts': ts, 'rate': 25,
+                                                        'samples': [[0.0, 0.0, 1.0]] * 25}}},
+            # Broken waveforms do not cost the heart rate reading they came with
+            {'client_id': 'b1', 'heart_rate': 73.0, 'previous_heart_rate': 72.0,
+             'fall_detected': False, 'seizure_detected': False, 'ts': ts + 1000, 'seq': 2,
+             'waveforms': {'ppg': [1, 2, 3]}},
+        ]
+        for message in messages:
+            service.on_message(None, None, SimpleNamespace(topic='t',
+                                                           payload=json.dumps(message).encode()))
+        service.pipeline.start()
+        service.pipeline.stop()
+        service.waveforms.stop()
+
+        self.assertEqual(service.readings_rejected.value(), 0)
+        self.assertEqual(service.waveforms.rejected.value(), 1)
+        self.assertEqual(len(self.store.get_historical_data(1, 'b1')), 2)
+        self.assertEqual(self.store.list_waveform_channels('b1'), ['accel', 'ppg'])
+        accel = read_waveform(self.store, 'b1', 'accel', ts, ts + 1000)
+        self.assertEqual(accel.samples.shape, (25, 3))
+        np.testing.assert_array_equal(
+            read_waveform(self.store, 'b1', 'ppg', ts, ts + 1000).samples, np.arange(50))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,280 @@
+"""Request tracing and sampling profiling for the API.
+
+TracingMiddleware wraps the Flask WSGI app and times every request from
+its arrival until its response body is closed, so a streamed history
+response is timed to its last row. The time is split three ways:
+
+  * db: time spent executing SQL and fetching rows, recorded by the
+    DataStore's cursors through record_query();
+  * serialize: time spent encoding JSON, in jsonify() and in the history
+    row chunks (see serialized()), less any database time inside it;
+  * total.
+
+The split is exported as histograms, sent as a Server-Timing header (as
+far as it is known when the response starts) and logged for requests
+slower than slow_request_ms.
+
+SamplingProfiler samples the stacks of the threads serving traced
+requests every few milliseconds for a fixed duration and aggregates them
+as collapsed stacks (route;file:function;...), the input format of
+flame graph tools.
+"""
+import collections
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('trace', default=None)
+
+# Thread id -> Trace of the request that thread is working on
+_active = {}
+
+
+class Trace:
+    """Timings of one request, in seconds."""
+
+    __slots__ = ('method', 'route', 'started', 'total', 'db', 'queries', 'serialize',
+                 'status')
+
+    def __init__(self, method, route):
+        self.method = method
+        self.route = route
+        self.started = time.perf_counter()
+        self.total = 0.0
+        self.db = 0.0
+        self.queries = 0
+        self.serialize = 0.0
+        self.status = None
+
+    def server_timing(self):
+        elapsed = time.perf_counter() - self.started
+        return (f'db;dur={self.db * 1000:.1f}, serialize;dur={self.serialize * 1000:.1f}, '
+                f'app;dur={elapsed * 1000:.1f}')
+
+
+def current():
+    """Trace of the request being served on this thread, or None."""
+    return _current.get()
+
+
+def record_query(seconds, statements=0):
+    """Add database time to the current request, if any."""
+    trace = _current.get()
+    if trace is not None:
+        trace.db += seconds
+        trace.queries += statements
+
+
+@contextmanager
+def serializing():
+    """Count the time spent in the block as serialization."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started, db = time.perf_counter(), trace.db
+    try:
+        yield
+    finally:
+        trace.serialize += time.perf_counter() - started - (trace.db - db)
+
+
+def serialized(chunks):
+    """Count the time taken to produce each chunk as serialization, less
+    the database time spent fetching the rows it encodes."""
+    trace = _current.get()
+    if trace is None:
+        return chunks
+
+    def timed():
+        iterator = iter(chunks)
+        while True:
+            started, db = time.perf_counter(), trace.db
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                trace.serialize += time.perf_counter() - started - (trace.db - db)
+            yield chunk
+    return timed()
+
+
+def _enter(trace):
+    _active[threading.get_ident()] = trace
+    return _current.set(trace)
+
+
+def _leave(token):
+    _active.pop(threading.get_ident(), None)
+    _current.reset(token)
+
+
+class _TracedBody:
+    """Response body iterated with its request's trace current."""
+
+    def __init__(self, body, trace, finish):
+        self._body = body
+        self._iterator = iter(body)
+        self._trace = trace
+        self._finish = finish
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        token = _enter(self._trace)
+        try:
+            return next(self._iterator)
+        finally:
+            _leave(token)
+
+    def close(self):
+        token = _enter(self._trace)
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            _leave(token)
+            self._finish(self._trace)
+
+
+class TracingMiddleware:
+    """WSGI middleware timing every request; see the module docstring."""
+
+    def __init__(self, wsgi_app, slow_request_ms=None):
+        self.wsgi_app = wsgi_app
+        self.slow_request_ms = slow_request_ms
+        self.profiler = SamplingProfiler()
+        self.total_seconds = Histogram('seizuresafe_request_seconds',
+                                       'Time from request to the end of its response body')
+        self.db_seconds = Histogram('seizuresafe_request_db_seconds',
+                                    'Time per request spent in database queries')
+        self.serialize_seconds = Histogram('seizuresafe_request_serialize_seconds',
+                                           'Time per request spent encoding JSON')
+
+    def metrics(self):
+        return [self.total_seconds, self.db_seconds, self.serialize_seconds]
+
+    def __call__(self, environ, start_response):
+        trace = Trace(environ['REQUEST_METHOD'], environ.get('PATH_INFO', ''))
+
+        def traced_start_response(status, headers, exc_info=None):
+            trace.status = int(status.split(' ', 1)[0])
+            return start_response(status, list(headers) +
+                                  [('Server-Timing', trace.server_timing())], exc_info)
+
+        token = _enter(trace)
+        try:
+            body = self.wsgi_app(environ, traced_start_response)
+        except BaseException:
+            self._finish(trace)
+            raise
+        finally:
+            _leave(token)
+        return _TracedBody(body, trace, self._finish)
+
+    def _finish(self, trace):
+        trace.total = time.perf_counter() - trace.started
+        self.total_seconds.observe(trace.total)
+        self.db_seconds.observe(trace.db)
+        self.serialize_seconds.observe(trace.serialize)
+        if self.slow_request_ms is not None and trace.total * 1000 >= self.slow_request_ms:
+            logger.warning(f"Slow request {trace.method} {trace.route} ({trace.status}): "
+                           f"{trace.total * 1000:.0f} ms total, {trace.db * 1000:.0f} ms in "
+                           f"{trace.queries} queries, {trace.serialize * 1000:.0f} ms "
+                           f"serializing")
+
+
+# Frames at which a sampled stack starts: the request's entry into the app
+_ENTRY_CODES = frozenset({TracingMiddleware.__call__.__code__,
+                          _TracedBody.__next__.__code__, _TracedBody.close.__code__})
+
+
+class SamplingProfiler:
+    """Samples the stacks of requests in flight for a fixed duration."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stacks = collections.Counter()
+        self._leaves = collections.Counter()
+        self._until = 0.0
+        self._thread = None
+        self.interval = 0.005
+        self.seconds = 0.0
+        self.samples = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, interval=0.005):
+        """Sample for seconds, replacing any earlier results. Returns
+        False if a run is already in progress."""
+        with self._lock:
+            if self.running:
+                return False
+            self._stacks.clear()
+            self._leaves.clear()
+            self.samples = 0
+            self.seconds = seconds
+            self.interval = interval
+            self._until = time.monotonic() + seconds
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler',
+                                            daemon=True)
+            self._thread.start()
+        logger.info(f"Profiling live requests for {seconds} s")
+        return True
+
+    def wait(self, timeout=None):
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while time.monotonic() < self._until:
+            frames = sys._current_frames()
+            for ident, trace in list(_active.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None and frame.f_code not in _ENTRY_CODES:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                stack.append(f'{trace.method} {trace.route}')
+                with self._lock:
+                    self._stacks[';'.join(reversed(stack))] += 1
+                    self._leaves[stack[0]] += 1
+                    self.samples += 1
+            del frames
+            time.sleep(self.interval)
+
+    def report(self, limit=25):
+        """Status and the most sampled stacks and functions so far."""
+        with self._lock:
+            samples = self.samples
+            stacks = self._stacks.most_common(limit)
+            leaves = self._leaves.most_common(limit)
+        return {
+            'running': self.running,
+            'seconds': self.seconds,
+            'seconds_left': max(0.0, self._until - time.monotonic()) if self.running else 0.0,
+            'interval_ms': self.interval * 1000,
+            'samples': samples,
+            'stacks': [{'stack': stack, 'samples': n, 'share': n / samples}
+                       for stack, n in stacks],
+            'functions': [{'function': function, 'samples': n, 'share': n / samples}
+                          for function, n in leaves],
+        }
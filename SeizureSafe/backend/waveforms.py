@@ -0,0 +1,310 @@
+"""Storage of high-rate sensor samples (PPG, accelerometer) as array chunks.
+
+A bracelet sends samples as arrays inside an ordinary JSON message:
+
+    {"client_id": "b1",
+     "waveforms": {"ppg": {"ts": 1700000000000, "rate": 50, "dtype": "int16",
+                           "samples": [2041, 2055, ...]},
+                   "accel": {"ts": 1700000000000, "rate": 25,
+                             "samples": [[0.01, -0.98, 0.12], ...]}}}
+
+ts is the epoch ms of the first sample and rate the sampling rate in Hz;
+samples are one value or one row of values (e.g. x, y, z) per sample.
+The message may carry a heart rate reading as well.
+
+WaveformWriter joins the arrays of each device and channel into
+contiguous runs and cuts them into chunks of chunk_ms, which are written
+as one compressed BLOB each (waveform_chunks, see data_store.py), many
+chunks per transaction on a writer thread of its own. Samples that were
+already received are trimmed, a gap or a change of rate starts a new
+chunk, and a stream that goes quiet has its partial chunk written after
+idle_seconds. Samples buffered in memory, at most one chunk per stream,
+are lost if the process crashes.
+
+read_waveform() decodes the chunks overlapping a window straight into
+NumPy arrays, never building a Python object per sample.
+"""
+import logging
+import math
+import queue
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from data_store import MAX_CLOCK_SKEW_MS, MAX_WAVEFORM_CHUNK_MS, now_ms
+from metrics import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+# Sample types a bracelet may send, as little-endian NumPy dtypes
+DTYPES = {'int16': '<i2', 'int32': '<i4', 'float32': '<f4'}
+MAX_SAMPLE_RATE = 1000.0
+CHANNEL_PATTERN = re.compile(r'[a-z][a-z0-9_]{0,31}')
+
+# Streams unheard of for this long are forgotten
+FORGET_SECONDS = 600.0
+
+_STOP = object()
+
+
+def encode_chunk(samples):
+    """(dtype, width, codec, data) of an array of samples. Integer samples
+    are delta encoded first, which leaves slowly changing signals mostly
+    small numbers that compress well."""
+    width = samples.shape[1] if samples.ndim == 2 else 0
+    if samples.dtype.kind == 'i':
+        # Wraps around on overflow, and the cumulative sum wraps back
+        deltas = np.diff(samples, axis=0, prepend=np.zeros_like(samples[:1]))
+        return samples.dtype.str, width, 'delta+zlib', zlib.compress(deltas.tobytes())
+    return samples.dtype.str, width, 'zlib', zlib.compress(samples.tobytes())
+
+
+def decode_chunk(dtype, width, codec, data):
+    """Samples of a chunk written by encode_chunk()."""
+    samples = np.frombuffer(zlib.decompress(data), dtype=dtype)
+    if width:
+        samples = samples.reshape(-1, width)
+    if codec == 'delta+zlib':
+        return np.cumsum(samples, axis=0, dtype=samples.dtype)
+    if codec != 'zlib':
+        raise ValueError(f"Unknown waveform codec: {codec}")
+    return samples
+
+
+class Waveform:
+    """Samples of one channel and their times (epoch ms, float64)."""
+
+    def __init__(self, ts, samples):
+        self.ts = ts
+        self.samples = samples
+
+    def __len__(self):
+        return len(self.ts)
+
+
+def read_waveform(store, device_id, channel, start_ms, end_ms):
+    """The samples of a channel with start_ms <= t < end_ms, in time order.
+    Where chunks overlap, the later one only contributes samples after
+    the end of the earlier one."""
+    times, parts = [], []
+    covered = -math.inf
+    for start, _, rate, count, dtype, width, codec, data in \
+            store.iter_waveform_chunks(device_id, channel, start_ms, end_ms):
+        ts = start + np.arange(count) * (1000.0 / rate)
+        first = np.searchsorted(ts, max(start_ms, covered))
+        last = np.searchsorted(ts, end_ms)
+        if first >= last:
+            continue
+        times.append(ts[first:last])
+        parts.append(decode_chunk(dtype, width, codec, data)[first:last])
+        covered = ts[last - 1] + 1e-6
+    if not parts:
+        return Waveform(np.empty(0), np.empty(0, dtype=np.float32))
+    return Waveform(np.concatenate(times), np.concatenate(parts))
+
+
+class _Stream:
+    __slots__ = ('start', 'end', 'rate', 'dtype', 'width', 'parts', 'count', 'seen')
+
+    def __init__(self, start, rate, dtype, width):
+        self.start = self.end = start
+        self.rate = rate
+        self.dtype = dtype
+        self.width = width
+        self.parts = []
+        self.count = 0
+        self.seen = time.monotonic()
+
+
+class WaveformWriter:
+    """Chunks incoming sample arrays and writes them to the store."""
+
+    def __init__(self, store, chunk_ms=10000, idle_seconds=None, max_queue=10000):
+        if not 0 < chunk_ms <= MAX_WAVEFORM_CHUNK_MS:
+            raise ValueError(f"chunk_ms must be between 1 and {MAX_WAVEFORM_CHUNK_MS}")
+        self.store = store
+        self.chunk_ms = chunk_ms
+        self.idle_seconds = chunk_ms / 1000 if idle_seconds is None else idle_seconds
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+
+        self.samples_received = Counter('seizuresafe_waveform_samples_received_total',
+                                        'Waveform samples received')
+        self.samples_duplicate = Counter('seizuresafe_waveform_samples_duplicate_total',
+                                         'Waveform samples received twice, dropped')
+        self.chunks_written = Counter('seizuresafe_waveform_chunks_written_total',
+                                      'Waveform chunks committed')
+        self.chunks_dropped = Counter('seizuresafe_waveform_chunks_dropped_total',
+                                      'Waveform chunks lost to a full queue or failed write')
+        self.rejected = Counter('seizuresafe_waveforms_rejected_total',
+                                'Waveform objects that failed validation')
+
+    def metrics(self):
+        """The writer's metrics, for a metrics.Registry."""
+        return [self.samples_received, self.samples_duplicate, self.chunks_written,
+                self.chunks_dropped, self.rejected,
+                Gauge('seizuresafe_waveform_streams', 'Device channels being buffered',
+                      function=lambda: len(self._streams))]
+
+    def add(self, device_id, waveforms):
+        """Add the 'waveforms' object of a message. Raises ValueError for
+        an invalid one, having added none of its channels."""
+        try:
+            parsed = self._parse(waveforms)
+        except ValueError:
+            self.rejected.inc()
+            raise
+        for channel, ts, rate, samples in parsed:
+            self.add_samples(device_id, channel, ts, rate, samples)
+
+    @staticmethod
+    def _parse(waveforms):
+        """(channel, ts, rate, samples) of each channel of a 'waveforms' object."""
+        if not isinstance(waveforms, dict):
+            raise ValueError("waveforms must be an object of channels")
+        parsed = []
+        limit = now_ms() + MAX_CLOCK_SKEW_MS
+        for channel, spec in waveforms.items():
+            if not CHANNEL_PATTERN.fullmatch(channel):
+                raise ValueError(f"Invalid waveform channel name: {channel!r}")
+            if not isinstance(spec, dict):
+                raise ValueError(f"Waveform {channel!r} must be an object")
+            try:
+                dtype = DTYPES[spec.get('dtype', 'float32')]
+                rate = float(spec['rate'])
+                ts = float(spec['ts'])
+                # One conversion of the whole list, in C
+                samples = np.asarray(spec['samples'], dtype=dtype)
+            except (KeyError, TypeError, OverflowError) as e:
+                raise ValueError(f"Invalid waveform {channel!r}: {e!r}")
+            if not 0 < rate <= MAX_SAMPLE_RATE:
+                raise ValueError(f"Sample rate of {channel!r} must be in (0, {MAX_SAMPLE_RATE}]")
+            if samples.ndim not in (1, 2) or not len(samples):
+                raise ValueError(f"Samples of {channel!r} must be a non-empty list of "
+                                 f"values or of rows of values")
+            if ts > limit:
+                raise ValueError(f"Waveform {channel!r} starts in the future")
+            parsed.append((channel, ts, rate, samples))
+        return parsed
+
+    def add_samples(self, device_id, channel, ts, rate, samples):
+        """Add samples taken at rate Hz from ts (epoch ms) on."""
+        period = 1000.0 / rate
+        width = samples.shape[1] if samples.ndim == 2 else 0
+        self.samples_received.inc(len(samples))
+        key = (device_id, channel)
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is not None and (stream.rate, stream.dtype, stream.width) != \
+                    (rate, samples.dtype, width):
+                self._cut(key, stream, stream.count)
+                stream = None
+            if stream is None:
+                stream = self._streams[key] = _Stream(ts, rate, samples.dtype, width)
+            elif ts + len(samples) * period <= stream.end + period / 2:
+                self.samples_duplicate.inc(len(samples))
+                return
+            elif ts < stream.end - period / 2:
+                # Overlaps what was received already; keep the new part
+                skip = int(round((stream.end - ts) / period))
+                self.samples_duplicate.inc(skip)
+                samples = samples[skip:]
+                ts += skip * period
+            elif ts > stream.end + period / 2:
+                self._cut(key, stream, stream.count)
+                stream.start = stream.end = ts
+            stream.parts.append(samples)
+            stream.count += len(samples)
+            stream.end = stream.start + stream.count * period
+            stream.seen = time.monotonic()
+            chunk_samples = max(1, int(round(self.chunk_ms / period)))
+            while stream.count >= chunk_samples:
+                self._cut(key, stream, chunk_samples)
+
+    def _cut(self, key, stream, count):
+        """Queue the first count buffered samples of stream as a chunk."""
+        if not count:
+            return
+        samples = stream.parts[0] if len(stream.parts) == 1 else np.concatenate(stream.parts)
+        rest = samples[count:]
+        stream.parts = [rest] if len(rest) else []
+        stream.count -= count
+        start = stream.start
+        stream.start += count * 1000.0 / stream.rate
+        chunk = (key[0], key[1], int(round(start)), int(math.ceil(stream.start)),
+                 stream.rate, count, samples[:count])
+        try:
+            self._queue.put_nowait(chunk)
+        except queue.Full:
+            self.chunks_dropped.inc()
+            logger.warning(f"Waveform queue full, dropping a chunk of {key[1]!r} "
+                           f"from {key[0]!r}")
+
+    def flush_idle(self, now=None):
+        """Queue the partial chunks of streams quiet for idle_seconds."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            for key, stream in list(self._streams.items()):
+                quiet = now - stream.seen
+                if quiet >= self.idle_seconds:
+                    self._cut(key, stream, stream.count)
+                if quiet >= FORGET_SECONDS:
+                    del self._streams[key]
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='waveform-writer',
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """Write every buffered sample, then stop the writer thread."""
+        self.flush_idle(now=math.inf)
+        if self._thread is None:
+            self._write(self._take())
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _take(self, first=None):
+        chunks = [] if first is None else [first]
+        while len(chunks) < 500:
+            try:
+                chunk = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if chunk is _STOP:
+                self._queue.put(_STOP)
+                break
+            chunks.append(chunk)
+        return chunks
+
+    def _run(self):
+        while True:
+            try:
+                chunk = self._queue.get(timeout=min(1.0, self.idle_seconds))
+            except queue.Empty:
+                chunk = None
+            if chunk is _STOP:
+                self._write(self._take())
+                return
+            self._write(self._take(chunk))
+            self.flush_idle()
+
+    def _write(self, chunks):
+        if not chunks:
+            return
+        rows = [(device_id, channel, start, end, rate, count, *encode_chunk(samples))
+                for device_id, channel, start, end, rate, count, samples in chunks]
+        try:
+            self.chunks_written.inc(self.store.save_waveform_chunks(rows))
+        except Exception as e:
+            self.chunks_dropped.inc(len(rows))
+            logger.error(f"Failed to write {len(rows)} waveform chunks: {e}")